@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Carryover-balanced trial orders: every condition is followed by every other
+condition (about) equally often, so that first-order transitions do not
+confound time-resolved decoding. Orders are Eulerian paths through a
+transition multigraph with the desired transition counts.
+"""
+import numpy as np
+
+
+def transition_matrix(sequence, n_conditions=None):
+    ''' counts of first-order transitions, entry (i, j) counts i followed by j'''
+    sequence = np.asarray(sequence, dtype=np.intp)
+    if n_conditions is None:
+        n_conditions = sequence.max() + 1 if len(sequence) else 0
+    transitions = np.zeros((n_conditions, n_conditions), dtype=int)
+    np.add.at(transitions, (sequence[:-1], sequence[1:]), 1)
+    return transitions
+
+
+def label_transitions(labels):
+    ''' conditions (in order of appearance) and transition matrix of a
+        sequence of condition labels, e.g. trial["map"] of a block'''
+    keys = [repr(label) for label in labels]
+    conditions = list(dict.fromkeys(keys))
+    codes = [conditions.index(key) for key in keys]
+    first = [labels[keys.index(key)] for key in conditions]
+    return first, transition_matrix(codes, len(conditions))
+
+
+def expected_transitions(counts, allow_repeats=True, n_iter=1000):
+    ''' real-valued transition counts proportional to the condition counts,
+        with row and column sums equal to counts (circular sequence)'''
+    counts = np.asarray(counts, dtype=float)
+    expected = np.outer(counts, counts) / counts.sum()
+    if not allow_repeats:
+        np.fill_diagonal(expected, 0.)
+        # iterative proportional fitting to the margins
+        for _ in range(n_iter):
+            if np.allclose(expected.sum(axis=1), counts, rtol=0, atol=1e-9):
+                break
+            rows = expected.sum(axis=1)
+            expected *= np.divide(counts, rows, out=np.zeros_like(rows),
+                                  where=rows > 0)[:, None]
+            cols = expected.sum(axis=0)
+            expected *= np.divide(counts, cols, out=np.zeros_like(cols),
+                                  where=cols > 0)[None, :]
+    return expected
+
+
+def round_transitions(expected, counts, allow_repeats=True, rng=None):
+    ''' integer transition counts close to expected with row and column sums
+        equal to counts (controlled rounding, ties broken at random)'''
+    if rng is None:
+        rng = np.random
+    counts = np.asarray(counts, dtype=int)
+    transitions = np.floor(expected + 1e-9).astype(int)
+    # expected may miss the margins slightly, remove excess transitions
+    for axis in [1, 0]:
+        excess = transitions.sum(axis=axis) - counts
+        for i in np.flatnonzero(excess > 0):
+            for _ in range(excess[i]):
+                line = transitions[i] if axis == 1 else transitions[:, i]
+                line[np.argmax(line)] -= 1
+    row_left = counts - transitions.sum(axis=1)
+    col_left = counts - transitions.sum(axis=0)
+    # fill the cells with the largest remainders first
+    remainder = expected - transitions + 1e-6 * rng.random(expected.shape)
+    if not allow_repeats:
+        np.fill_diagonal(remainder, -np.inf)
+    filled = True
+    while filled:
+        filled = False
+        for cell in np.argsort(-remainder, axis=None):
+            i, j = np.unravel_index(cell, expected.shape)
+            if row_left[i] > 0 and col_left[j] > 0 and remainder[i, j] > -np.inf:
+                transitions[i, j] += 1
+                remainder[i, j] -= 1
+                row_left[i] -= 1
+                col_left[j] -= 1
+                filled = True
+    # only self-transitions may be left over: route i -> b through a -> i -> b
+    for i in np.flatnonzero(row_left):
+        for _ in range(row_left[i]):
+            a, b = np.argwhere(transitions > 0)[rng.permutation(
+                np.count_nonzero(transitions > 0))].T
+            ok = (a != i) & (b != i)
+            if not ok.any():
+                raise ValueError(f"Counts {counts.tolist()} cannot be ordered "
+                                 f"without immediate repeats")
+            a, b = a[ok][0], b[ok][0]
+            transitions[a, b] -= 1
+            transitions[a, i] += 1
+            transitions[i, b] += 1
+    return transitions
+
+
+def connect_components(transitions, rng=None):
+    ''' rewire edges a -> b and c -> d of two disconnected components of the
+        transition graph to a -> d and c -> b, which keeps all degrees'''
+    if rng is None:
+        rng = np.random
+    transitions = transitions.copy()
+    nodes = np.flatnonzero(transitions.sum(axis=1) + transitions.sum(axis=0))
+    while True:
+        # label weakly connected components
+        label = {node: node for node in nodes}
+
+        def find(node):
+            while label[node] != node:
+                node = label[node]
+            return node
+        for a, b in np.argwhere(transitions > 0):
+            label[find(a)] = find(b)
+        roots = sorted({find(node) for node in nodes})
+        if len(roots) <= 1:
+            return transitions
+        edges = np.argwhere(transitions > 0)
+        first = [e for e in edges if find(e[0]) == roots[0]]
+        other = [e for e in edges if find(e[0]) == roots[1]]
+        (a, b), (c, d) = first[rng.choice(len(first))], other[rng.choice(len(other))]
+        transitions[a, b] -= 1
+        transitions[c, d] -= 1
+        transitions[a, d] += 1
+        transitions[c, b] += 1
+
+
+def eulerian_circuit(transitions, start=None, rng=None):
+    ''' random Eulerian circuit through the multigraph with transitions[i, j]
+        edges from i to j (in-degrees equal out-degrees, connected), returns
+        the visited nodes including the final return to start'''
+    if rng is None:
+        rng = np.random
+    out_edges = [list(rng.permutation(np.repeat(np.arange(len(row)), row)))
+                 for row in transitions]
+    if start is None:
+        start = rng.choice(np.flatnonzero(transitions.sum(axis=1)))
+    # Hierholzer's algorithm
+    stack, circuit = [start], []
+    while stack:
+        node = stack[-1]
+        if out_edges[node]:
+            stack.append(out_edges[node].pop())
+        else:
+            circuit.append(stack.pop())
+    return np.array(circuit[::-1], dtype=np.intp)
+
+
+def balanced_cycle(counts, allow_repeats=True, rng=None):
+    ''' cyclic sequence of condition codes (the last element is followed by
+        the first) with balanced transitions, see balanced_sequence'''
+    counts = np.asarray(counts, dtype=int)
+    if counts.sum() == 0:
+        return np.zeros(0, dtype=np.intp)
+    expected = expected_transitions(counts, allow_repeats=allow_repeats)
+    transitions = round_transitions(expected, counts,
+                                    allow_repeats=allow_repeats, rng=rng)
+    transitions = connect_components(transitions, rng=rng)
+    # the circuit visits each condition counts[k] times before returning
+    return eulerian_circuit(transitions, rng=rng)[:-1]
+
+
+def balanced_sequence(counts, allow_repeats=True, rng=None):
+    ''' sequence of condition codes with counts[k] instances of code k whose
+        first-order transitions are as balanced as possible, i.e. i is
+        followed by j about counts[i] * counts[j] / n times. For equal counts
+        that are multiples of the number of conditions every transition
+        occurs equally often (type-1 index-1) except for one.
+
+        without repeats raises ValueError if a condition has more than
+        (n+1)//2 instances'''
+    counts = np.asarray(counts, dtype=int)
+    n = counts.sum()
+    if allow_repeats or n == 0 or counts.max() <= n // 2:
+        return balanced_cycle(counts, allow_repeats=allow_repeats, rng=rng)
+    if counts.max() > (n + 1) // 2:
+        raise ValueError(f"Counts {counts.tolist()} cannot be ordered "
+                         f"without immediate repeats")
+    # the most frequent condition needs both ends: order the others as a
+    # cycle with one instance less of it and open the cycle before another
+    # condition
+    most = np.argmax(counts)
+    counts = counts.copy()
+    counts[most] -= 1
+    cycle = balanced_cycle(counts, allow_repeats=False, rng=rng)
+    cut = np.flatnonzero(cycle != most)[0] if len(cycle) else 0
+    return np.concatenate(([most], cycle[cut:], cycle[:cut])).astype(np.intp)
+
+
+def debruijn_sequence(n_conditions, repeats=1, rng=None):
+    ''' random type-1 index-1 sequence: every ordered pair of conditions
+        (including repeats) occurs exactly repeats times, length
+        repeats * n_conditions**2 + 1'''
+    transitions = np.full((n_conditions, n_conditions), repeats, dtype=int)
+    return eulerian_circuit(transitions, rng=rng)
+
+
+def balanced_order(labels, allow_repeats=True, rng=None):
+    ''' permutation of the trials with the given condition labels (any
+        hashable values) such that transitions between conditions are
+        balanced, trials of the same condition are assigned at random'''
+    if rng is None:
+        rng = np.random
+    keys = [label if isinstance(label, (str, int, tuple)) else repr(label)
+            for label in labels]
+    conditions = list(dict.fromkeys(keys))
+    codes = np.array([conditions.index(key) for key in keys], dtype=np.intp)
+    sequence = balanced_sequence(np.bincount(codes, minlength=len(conditions)),
+                                 allow_repeats=allow_repeats, rng=rng)
+    # the k-th occurrence of a condition gets its k-th (shuffled) trial
+    trials = [list(rng.permutation(np.flatnonzero(codes == c)))
+              for c in range(len(conditions))]
+    return np.array([trials[c].pop() for c in sequence], dtype=np.intp)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Counterbalanced assignment of textual cues, visual cues and stimulus images
+to their roles (map or stimulus letter = position in the mapping list) across
+a cohort: each list follows a randomized Latin square, so within every cycle
+of n participants (n items) each item takes each position exactly once. Every
+cycle and every list gets a square of its own (random row, column and symbol
+permutations), the association between the lists is randomized by the
+independent row orders.
+"""
+import os
+import glob
+import argparse
+import numpy as np
+
+# lists of the mapping lists, in the order of their random streams
+LISTS = ["tcue", "vcue", "stim"]
+
+
+def latin_square(n, rng=None):
+    ''' randomized Latin square of order n: the cyclic square with rows,
+        columns and symbols permuted at random'''
+    if rng is None:
+        rng = np.random
+    rows, cols, symbols = rng.permutation(n), rng.permutation(n), rng.permutation(n)
+    return symbols[(rows[:, None] + cols[None, :]) % n]
+
+
+def cycle_square(n, cycle, seed, stream):
+    ''' Latin square of a cycle of n participants of the list with index
+        stream'''
+    seed_seq = np.random.SeedSequence(seed, spawn_key=(stream, cycle))
+    return latin_square(n, rng=np.random.default_rng(seed_seq))
+
+
+def assign(items, participant, seed, stream=0):
+    ''' items in the order of participant (numbered from 1), the row of its
+        cycle's Latin square'''
+    items = np.asarray(sorted(items))
+    n = len(items)
+    cycle, row = divmod(participant - 1, n)
+    return items[cycle_square(n, cycle, seed, stream)[row]]
+
+
+def assign_mappinglists(lists, participant, seed):
+    ''' counterbalanced mapping lists (dict name -> items, see LISTS) of a
+        participant'''
+    return {name: assign(lists[name], participant, seed, stream=LISTS.index(name))
+            for name in lists}
+
+
+def position_counts(assignments):
+    ''' (n_items, n_positions) counts of item (sorted) x position over a
+        list of assignments of the same items'''
+    items = sorted(assignments[0])
+    counts = np.zeros((len(items), len(items)), dtype=int)
+    for assignment in assignments:
+        counts[[items.index(item) for item in assignment],
+               np.arange(len(assignment))] += 1
+    return items, counts
+
+
+def main(argv=None):
+    import GenerateTrialLists
+    parser = argparse.ArgumentParser(
+        description="Report the balance of the mapping lists of a cohort.")
+    parser.add_argument("--dir", default=GenerateTrialLists.trial_list_dir,
+                        help="trial list directory")
+    args = parser.parse_args(argv)
+
+    participants = sorted({int(os.path.basename(f).split("_")[0]) for f in
+                           glob.glob(os.path.join(args.dir, "*_trials.bundle"))
+                           + glob.glob(os.path.join(args.dir, "*_seed.json"))})
+    lists = [GenerateTrialLists.load_block(i, "mappinglists", trial_list_dir=args.dir)
+             for i in participants]
+    print(f"{len(lists)} participant(s)")
+    for name in LISTS:
+        items, counts = position_counts([[str(item) for item in m[name]]
+                                         for m in lists])
+        print(f"{name}: item x position counts "
+              f"{counts.min()}-{counts.max()} (rows: {', '.join(items)})")
+        print(counts)
+
+
+if __name__ == "__main__":
+    main()
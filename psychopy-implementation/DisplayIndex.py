@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Precomputed display-outcome index: enumerates every possible input display
+once per map, so that displays for a required correct response and target can
+be drawn by masking instead of rejection sampling
+"""
+import os
+import hashlib
+import numpy as np
+import SpellEngine
+
+
+class DisplayIndex:
+    def __init__(self, stimuli, display_size, cache_dir=None,
+                 max_displays=2**18, sep='-'):
+        self.stimuli = np.asarray(stimuli)
+        self.n_stim = len(self.stimuli)
+        self.display_size = display_size
+        self.cache_dir = cache_dir
+        self.sep = sep
+        self.n_displays = self.n_stim ** display_size
+        # too large display spaces are left to rejection sampling
+        self.enumerable = self.n_displays <= max_displays
+        self._entries = {}
+        self._displays = None
+        self._counts_in = None
+
+
+    @property
+    def displays(self):
+        ''' all input displays in lexicographic order, shape (n_displays, display_size)'''
+        if self._displays is None:
+            shape = (self.n_stim,) * self.display_size
+            self._displays = np.indices(shape, dtype=np.uint8).reshape(
+                self.display_size, -1).T.copy()
+            self._counts_in = SpellEngine.count_items(self._displays, self.n_stim)
+        return self._displays
+
+
+    @property
+    def counts_in(self):
+        ''' instances of each stimulus per input display'''
+        self.displays
+        return self._counts_in
+
+
+    def cache_fname(self, general_map):
+        key = "|".join([",".join(self.stimuli.tolist()),
+                        str(self.display_size), "+".join(general_map),
+                        self.sep, f"engine{SpellEngine.ENGINE_VERSION}"])
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"display-index_{digest}.npz")
+
+
+    def entry(self, general_map):
+        ''' outcomes of all displays under general_map (built lazily, cached)'''
+        if isinstance(general_map, str):
+            general_map = [general_map]
+        general_map = tuple(general_map)
+        if general_map in self._entries:
+            return self._entries[general_map]
+        if not self.enumerable:
+            raise ValueError(f"{self.n_displays} displays are too many to enumerate")
+
+        fname = self.cache_fname(general_map) if self.cache_dir else None
+        if fname is not None and os.path.exists(fname):
+            with np.load(fname, allow_pickle=False) as f:
+                entry = {key: f[key] for key in f.files}
+        else:
+            entry = self.build(general_map)
+            if fname is not None:
+                # write atomically, other processes may read the cache
+                os.makedirs(self.cache_dir, exist_ok=True)
+                tmp_fname = f"{fname}.{os.getpid()}.tmp"
+                with open(tmp_fname, "wb") as f:
+                    np.savez(f, **entry)
+                os.replace(tmp_fname, fname)
+        self._entries[general_map] = entry
+        return entry
+
+
+    def build(self, general_map):
+        ''' apply general_map to every display and summarize the outcomes'''
+        tables = SpellEngine.composition_tables(general_map, self.stimuli,
+                                                sep=self.sep)
+        display_out, intermediate_display, trans_ub, trans_lb = \
+            SpellEngine.apply_tables(self.displays, tables)
+        counts = SpellEngine.count_items(display_out, self.n_stim)
+        return {"output_disp": display_out,
+                "intermediate_disp": intermediate_display,
+                "counts": counts.astype(np.uint8),
+                "max_count": counts.max(axis=1).astype(np.uint8),
+                "trans_ub": trans_ub.astype(np.uint8),
+                "trans_lb": trans_lb.astype(np.uint8)}
+
+
+    def valid_rows(self, general_map, necessary=None, max_duplicates=3):
+        ''' mask of displays that contain the necessary items (codes) and
+            whose output has at most max_duplicates instances per stimulus'''
+        entry = self.entry(general_map)
+        mask = entry["max_count"] <= max_duplicates
+        if necessary is not None and len(necessary) > 0:
+            needed = np.bincount(necessary, minlength=self.n_stim)
+            mask &= np.all(self.counts_in >= needed, axis=1)
+        return mask
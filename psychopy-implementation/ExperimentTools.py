@@ -31,8 +31,6 @@ class Experiment:
 
         # directory for trial lists, stimuli and instructions
         self.trial_list_dir = os.path.join(self.main_dir, "trial-lists")
-        if not os.path.exists(self.trial_list_dir):
-            import GenerateTrialLists
         self.stim_dir = os.path.join(self.main_dir, "stimuli")
         sys.path.insert(0, './stimuli')
         import Instructions_EN
@@ -199,40 +197,55 @@ class Experiment:
         print("Loading trials...")
         pid = self.expInfo["participant"]
 
+        # all lists of a participant are read at once from its bundle
+        import GenerateTrialLists
+        bundle = GenerateTrialLists.open_bundle(
+            int(pid), trial_list_dir=self.trial_list_dir, preload=True)
+        # Generate the lists of this participant if (some are) missing, stale
+        # lists are kept so that a running study uses consistent lists
+        generated, _ = GenerateTrialLists.generate_participant(
+            int(pid), trial_list_dir=self.trial_list_dir, only_missing=True,
+            bundle=bundle)
+        # the bundle was rewritten if lists were generated or moved into it
+        if generated or bundle is None or \
+                any(block not in bundle for block in GenerateTrialLists.BLOCKS):
+            bundle = GenerateTrialLists.open_bundle(
+                int(pid), trial_list_dir=self.trial_list_dir, preload=True)
+
         # Instructions
         self.instructions = pickle.load(
             open(f"{self.stim_dir}{os.sep}instructions_en.pkl", "rb"))
 
         # Object decoder trials
-        self.trials_obj_dec = pickle.load(
-            open(f"{self.trial_list_dir}{os.sep}{pid}_trials_obj_dec.pkl", "rb"))
+        self.trials_obj_dec = GenerateTrialLists.load_block(
+            int(pid), "trials_obj_dec", trial_list_dir=self.trial_list_dir, bundle=bundle)
 
-        self.trials_prim_dec = pickle.load(
-            open(f"{self.trial_list_dir}{os.sep}{pid}_trials_prim_dec.pkl", "rb"))
+        self.trials_prim_dec = GenerateTrialLists.load_block(
+            int(pid), "trials_prim_dec", trial_list_dir=self.trial_list_dir, bundle=bundle)
 
         # Practice trials
-        self.trials_prim_cue = pickle.load(
-            open(f"{self.trial_list_dir}{os.sep}{pid}_trials_prim_cue.pkl", "rb"))
+        self.trials_prim_cue = GenerateTrialLists.load_block(
+            int(pid), "trials_prim_cue", trial_list_dir=self.trial_list_dir, bundle=bundle)
 
-        self.trials_prim_prac_c = pickle.load(
-            open(f"{self.trial_list_dir}{os.sep}{pid}_trials_prim_prac_c.pkl", "rb"))
+        self.trials_prim_prac_c = GenerateTrialLists.load_block(
+            int(pid), "trials_prim_prac_c", trial_list_dir=self.trial_list_dir, bundle=bundle)
 
-        self.trials_prim_prac_p = pickle.load(
-            open(f"{self.trial_list_dir}{os.sep}{pid}_trials_prim_prac_p.pkl", "rb"))
+        self.trials_prim_prac_p = GenerateTrialLists.load_block(
+            int(pid), "trials_prim_prac_p", trial_list_dir=self.trial_list_dir, bundle=bundle)
 
         # Main trials
-        self.trials_prim = pickle.load(
-            open(f"{self.trial_list_dir}{os.sep}{pid}_trials_prim.pkl", "rb"))
+        self.trials_prim = GenerateTrialLists.load_block(
+            int(pid), "trials_prim", trial_list_dir=self.trial_list_dir, bundle=bundle)
 
-        self.trials_bin = pickle.load(
-            open(f"{self.trial_list_dir}{os.sep}{pid}_trials_binary.pkl", "rb"))
+        self.trials_bin = GenerateTrialLists.load_block(
+            int(pid), "trials_binary", trial_list_dir=self.trial_list_dir, bundle=bundle)
         
-        self.trials_auto = pickle.load(
-            open(f"{self.trial_list_dir}{os.sep}{pid}_trials_auto.pkl", "rb"))
+        self.trials_auto = GenerateTrialLists.load_block(
+            int(pid), "trials_auto", trial_list_dir=self.trial_list_dir, bundle=bundle)
 
         # Individual mappings for each participant
-        self.mappinglists = pickle.load(
-            open(f"{self.trial_list_dir}{os.sep}{pid}_mappinglists.pkl", "rb"))
+        self.mappinglists = GenerateTrialLists.load_block(
+            int(pid), "mappinglists", trial_list_dir=self.trial_list_dir, bundle=bundle)
         self.item_names = [name[2:] for name in self.mappinglists["stim"]]
 
         # convert mappinglists to file links
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Declarative factorial designs: factors are expanded into columns (one array
+per factor, one row per trial) in a single pass, and per-trial randomization
+such as jitter, catch trials or response option orders is applied to whole
+columns at once.
+"""
+import numpy as np
+
+
+def factorial(factors, repeats=1):
+    ''' full crossing of factor levels (dict name -> levels, the first factor
+        varies slowest), repeated repeats times, returns dict name -> column'''
+    names = list(factors)
+    levels = [np.asarray(factors[name]) for name in names]
+    grid = np.indices([len(lev) for lev in levels]).reshape(len(levels), -1)
+    return {name: np.tile(lev[idx], repeats)
+            for name, lev, idx in zip(names, levels, grid)}
+
+
+def concat(*designs):
+    ''' stack designs with the same columns'''
+    return {name: np.concatenate([design[name] for design in designs])
+            for name in designs[0]}
+
+
+def n_rows(design):
+    return len(next(iter(design.values()))) if design else 0
+
+
+def jitter(n, interval=range(-30, 30), size=(), rng=None):
+    ''' jitter in s, drawn uniformly from interval (ms)'''
+    if rng is None:
+        rng = np.random
+    return rng.choice(interval, size=(n,) + tuple(size), replace=True) / 1000
+
+
+def draw_other(n_items, exclude, rng=None):
+    ''' draw an item code other than exclude for every row'''
+    if rng is None:
+        rng = np.random
+    exclude = np.asarray(exclude)
+    draw = rng.integers(0, n_items - 1, size=len(exclude)) \
+        if hasattr(rng, "integers") else rng.randint(0, n_items - 1, len(exclude))
+    return draw + (draw >= exclude)
+
+
+def bernoulli(n, p=0.5, rng=None):
+    ''' n random booleans that are True with probability p'''
+    if rng is None:
+        rng = np.random
+    return rng.random(n) < p
+
+
+def options_with_correct(n_items, correct_items, correct_slots, rng=None):
+    ''' random order of all item codes per row, with correct_items[i] moved
+        to slot correct_slots[i] (swapped with the item that was there)'''
+    if rng is None:
+        rng = np.random
+    n = len(correct_items)
+    rows = np.arange(n)
+    options = np.argsort(rng.random((n, n_items)), axis=1)
+    current = np.argmax(options == np.asarray(correct_items)[:, None], axis=1)
+    options[rows, current] = options[rows, correct_slots]
+    options[rows, correct_slots] = correct_items
+    return options
+
+
+def place_items(n, size, positions, items, fill):
+    ''' displays (n, size) filled with fill, items[i] at positions[i]'''
+    displays = np.full((n, size), fill, dtype=np.asarray(items).dtype
+                       if fill is not None else object)
+    displays[np.arange(n), positions] = items
+    return displays
+
+
+def to_dicts(design, constants=None):
+    ''' one dictionary per row, with constant entries added to every row,
+        entries of 1d columns become Python scalars and rows of 2d columns
+        arrays of their own'''
+    constants = {} if constants is None else constants
+    columns = {name: column.tolist() if column.ndim == 1 else list(column.copy())
+               for name, column in design.items()}
+    return [dict(constants, **{name: column[i] for name, column in columns.items()})
+            for i in range(n_rows(design))]
+
+
+def stratified_sample(strata, n, rng=None):
+    ''' draw n row indices balanced over nested strata (list of code columns,
+        outermost first): n is split as evenly as possible over the levels of
+        the first stratum, each share over the levels of the next one within
+        it and so on; rows of a cell are drawn without replacement until the
+        cell is exhausted'''
+    if rng is None:
+        rng = np.random
+    codes = np.asarray(strata[0])
+    levels = np.unique(codes)
+    if n > 0 and len(levels) == 0:
+        raise ValueError("No rows to sample from")
+    share = np.full(len(levels), n // len(levels))
+    share[rng.choice(len(levels), n % len(levels), replace=False)] += 1
+    rows = []
+    for level, k in zip(levels, share):
+        idx = np.flatnonzero(codes == level)
+        if len(strata) > 1:
+            rows.append(idx[stratified_sample([np.asarray(s)[idx] for s in strata[1:]],
+                                              k, rng=rng)])
+        else:
+            n_rounds = -(-k // len(idx))
+            draw = np.concatenate([rng.permutation(len(idx))
+                                   for _ in range(max(n_rounds, 1))]).astype(np.intp)
+            rows.append(idx[draw[:k]])
+    return rng.permutation(np.concatenate(rows).astype(np.intp))
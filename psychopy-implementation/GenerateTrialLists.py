@@ -9,17 +9,40 @@ import os
 import glob
 import string
 import csv
+import json
 import pickle
+import shutil
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial, lru_cache
 from pathlib import Path
-from itertools import product, combinations, groupby
+from itertools import product, combinations, groupby, permutations
 import numpy as np
+import SpellEngine
+import SpellAlgebra
+import TrialAllocation
+import FactorialDesign
+import CohortAssignment
+import RunPartition
+from DisplayIndex import DisplayIndex
+from TrialTable import TrialTable, TrialTableWriter, BucketShuffle, as_trial_list
+from TrialBundle import TrialBundle, write_bundle, block_digest
+from GenerationConfig import GenerationConfig
 
 # ==============================================================================
 # User settings
 first_participant = 1
 n_participants = 10
 save_this = True
-ending = 'pkl'
+seed = None  # root seed of new participants, None draws fresh entropy
+# assignment of cues and stimulus images: counterbalanced across the cohort by
+# Latin squares ("latin-square") or permuted per participant ("random")
+mapping_assignment = "latin-square"
+cohort_seed = 2021  # seed of the cohort's Latin squares, keep it for a cohort
+n_workers = 1  # number of participants generated in parallel
+ending = 'trials'  # trial lists are TrialTable directories, mapping lists .npz
 sep = '-'
 n_stim = 4  # >= 4, otherwise no parallelizable compositions
 display_size = 4
@@ -37,15 +60,25 @@ n_exposure_loc_quick = round(n_exposure_loc * (1.-percentage_catch))
 n_exposure_loc_catch = round(n_exposure_loc * percentage_catch)
 stimuli = np.array(list(string.ascii_uppercase)[:n_stim])
 resp_list = list(range(4))
+# decoder and generic lists are partitioned into runs (between two pauses) of
+# at most run_length s, keep in sync with the experiment's runLength; runs are
+# balanced over the design factors and their number follows from the expected
+# trial durations (s) per trial type, plus the binary cue and catch response
+run_length = 300
+trial_durations = {"object_decoder": 1.8,  # fixation, display, wait
+                   "prim_decoder": 5.4,  # self-paced input and response
+                   "generic": 5.7,
+                   "binary": 0.5,
+                   "catch": 1.5}
 
 # ==============================================================================
 # Directories
 main_dir = os.path.dirname(os.path.abspath(__file__))
-os.chdir(main_dir)
 stim_dir = os.path.join(main_dir, "stimuli")
 trial_list_dir = os.path.join(main_dir, "trial-lists")
-if not os.path.exists(trial_list_dir):
-    os.makedirs(trial_list_dir)
+# generated blocks and display indices, kept next to the trial lists they
+# belong to (see default_cache_dir)
+cache_dir = os.path.join(trial_list_dir, ".cache")
 
 # =============================================================================
 # Functions
@@ -65,6 +98,10 @@ def save_object(obj, fname, ending='pkl'):
     elif ending == 'pkl':
         with open(fname + '.pkl', "wb") as f:
             pickle.dump(obj, f)
+    elif ending == 'trials':
+        obj.save(fname + '.trials')
+    elif ending == 'npz':
+        np.savez(fname + '.npz', **obj)
 
 
 def cartesian_product(items, discard_reps=True,
@@ -88,34 +125,10 @@ def analyze_map_type(general_map, sep='-'):
         X-Y-Y-Z (transitive maps) = X-Z-Y-Z (OR-map)
         X-Y-Z-X (rotation-maps)
         X-Y-Z-Y (OR-maps)
-        X-Y-Z-O (generic maps = parallelisable maps)'''
-
-    t = np.concatenate(np.char.split(general_map, sep=sep))
-    if len(t) == 2:
-        map_type = 'primitive'
-    else:
-        if t[0] == t[2]:
-            map_type = 'first-only'
-        elif t[0] == t[3] and t[1] == t[2]:
-            map_type = 'second-only'
-        elif t[0] != t[3] and t[1] == t[2]:
-            map_type = 'transitive'
-        elif t[0] == t[3] and t[1] != t[2]:
-            map_type = 'rotation'
-        elif t[1] == t[3]:
-            map_type = 'OR'
-        elif t[0] != t[1] != t[2] != t[3]:
-            map_type = 'generic'
-        else:
-            map_type = 'unclear'
-    return map_type
-
-
-def get_arg_set(general_map, sep='-'):
-    ''' takes map and generates a (mathematical) set of unique arguments that
-        it contains'''
-    t = np.concatenate(np.char.split(general_map, sep=sep))
-    return set(t)
+        X-Y-Z-O (generic maps = parallelisable maps)
+        deeper compositions are classified by their canonical pattern, e.g.
+        X-Y-Y-Z-Z-X -> "ABBCCA" (see SpellAlgebra)'''
+    return SpellAlgebra.classify(general_map, sep=sep)
 
 
 def split_into_categories(List, sep='-'):
@@ -126,275 +139,381 @@ def split_into_categories(List, sep='-'):
     assumes that the following cases do not occur:
         X-X-?-? or ?-?-X-X (elementary auto-maps)
         X-Y-X-Y (duplicate maps)'''
-    maps_first_only, maps_second_only, maps_trans, maps_rot, maps_or,\
-        maps_generic = [], [], [], [], [], []
-
+    categories = ["first-only", "second-only", "transitive", "rotation",
+                  "OR", "generic"]
+    indices = {category: [] for category in categories}
     for i in range(len(List)):
-        map_type = analyze_map_type(List[i], sep='-')
-        if map_type == 'first-only':
-            maps_first_only.append(i)
-        elif map_type == 'second-only':
-            maps_second_only.append(i)
-        elif map_type == 'transitive':
-            maps_trans.append(i)
-        elif map_type == 'rotation':
-            maps_rot.append(i)
-        elif map_type == 'OR':
-            maps_or.append(i)
-        elif map_type == 'generic':
-            maps_generic.append(i)
+        map_type = analyze_map_type(List[i], sep=sep)
+        if map_type not in ["primitive", "unclear"]:
+            # deeper compositions are stored by their pattern
+            indices.setdefault(map_type, []).append(i)
 
     # Store maps in dictionary
-    binary_comps_dict = {"first-only": List[maps_first_only],
-                         "second-only": List[maps_second_only],
-                         "transitive": List[maps_trans],
-                         "rotation": List[maps_rot],
-                         "OR": List[maps_or],
-                         "generic": List[maps_generic]
-                         }
+    binary_comps_dict = {category: List[idx] for category, idx in indices.items()}
     return binary_comps_dict
 
 
-def io_dist(List, sep='-'):
-    ''' takes list with string elements interleaved by sep and
-    analyzes the spread of the item distribution'''
-    items = np.concatenate(np.char.split(List, sep=sep))
-    instances, instance_count = np.unique(items, return_counts=True)
-    return np.std(instance_count)
+def pair_categories(T_unique, sep='-'):
+    ''' composition type (see analyze_map_type) of every ordered pair of maps
+        in T_unique, shape (N, N), the diagonal (duplicate maps) is empty'''
+    n = len(T_unique)
+    categories = np.full((n, n), '', dtype=object)
+    for a, b in product(range(n), range(n)):
+        if a != b:
+            categories[a, b] = analyze_map_type([T_unique[a], T_unique[b]],
+                                                sep=sep)
+    return categories
+
+
+def sd_lower_bound(counts, n_free, n_total):
+    ''' lower bound of the sd of each row of item counts after n_free more
+        items are added (n_total items in the end): a maximum count m over k
+        present items has an sd of at least (m - n_total/k) / sqrt(k-1)'''
+    n_present = np.count_nonzero(counts, axis=1)[:, None]
+    k = np.arange(2, counts.shape[1] + 1)[None, :]
+    feasible = (k >= n_present) & (k <= n_present + n_free)
+    excess = np.maximum(counts.max(axis=1)[:, None] - n_total / k, 0.)
+    bound = np.where(feasible, excess / np.sqrt(k - 1), np.inf)
+    return bound.min(axis=1)
+
+
+def search_primitive_sets(T_unique, n_primitives=5, min_type=2, sd_max=0.5,
+                          k=None, sep='-'):
+    ''' Enumerate all selections of n_primitives maps from T_unique whose
+        binary compositions contain at least min_type second-only and
+        min_type generic maps and whose item distribution has
+        an sd of the item counts <= sd_max (see gen_binary_compositions)
+
+        Selections are extended one map at a time (in the order of T_unique)
+        for all partial selections at once, composition and item counts are
+        updated incrementally from precomputed pair categories, and partial
+        selections that cannot reach min_type compositions or sd_max are
+        pruned.
+
+        Returns the qualifying selections (or the best k) as an array of shape
+        (n_selections, n_primitives), sorted by sd and then by position in
+        T_unique, and their sds'''
+    T_unique = np.asarray(T_unique)
+    n = len(T_unique)
+    categories = pair_categories(T_unique, sep=sep)
+    # compositions added by a map together with an already selected map
+    so_pairs = (categories == "second-only").astype(int)
+    so_pairs += so_pairs.T
+    generic_pairs = (categories == "generic").astype(int)
+    generic_pairs += generic_pairs.T
+    items = np.array([general_map.split(sep) for general_map in T_unique])
+    alphabet, codes = np.unique(items, return_inverse=True)
+    codes = codes.reshape(-1, 2)
+    n_total = 2 * n_primitives
+    eps = 1e-9
+    if not 0 < n_primitives <= n:
+        return np.zeros((0, max(n_primitives, 0)), dtype=T_unique.dtype), np.zeros(0)
+
+    # partial selections (rows of indices into T_unique) and their counts
+    selected = np.zeros((1, 0), dtype=np.intp)
+    counts = np.zeros((1, len(alphabet)), dtype=int)
+    n_so = np.zeros(1, dtype=int)
+    n_generic = np.zeros(1, dtype=int)
+    sd = np.zeros(1)
+    for depth in range(n_primitives):
+        n_rest = n_primitives - depth - 1
+        # all extensions by a later map that leaves room for the rest
+        start = selected[:, -1] + 1 if depth else np.zeros(1, dtype=np.intp)
+        n_ext = np.maximum(n - n_rest - start, 0)
+        rows = np.repeat(np.arange(len(selected)), n_ext)
+        offsets = np.cumsum(n_ext) - n_ext
+        cands = start[rows] + np.arange(len(rows)) - offsets[rows]
+
+        n_so = n_so[rows] + so_pairs[cands[:, None], selected[rows]].sum(axis=1)
+        n_generic = n_generic[rows] + \
+            generic_pairs[cands[:, None], selected[rows]].sum(axis=1)
+        selected = np.column_stack((selected[rows], cands))
+        counts = counts[rows]
+        ext = np.arange(len(rows))
+        np.add.at(counts, (ext, codes[cands, 0]), 1)
+        np.add.at(counts, (ext, codes[cands, 1]), 1)
+
+        if n_rest > 0:
+            # pairs that can still be added by the remaining maps
+            max_new = n_rest * (depth + 1) * 2 + n_rest * (n_rest - 1)
+            keep = (n_so + max_new >= min_type) & \
+                (n_generic + max_new >= min_type) & \
+                (sd_lower_bound(counts, 2 * n_rest, n_total) <= sd_max + eps)
+        else:
+            present = counts > 0
+            mean = n_total / present.sum(axis=1)
+            sd = np.sqrt((((counts - mean[:, None])**2) * present).sum(axis=1)
+                         / present.sum(axis=1))
+            keep = (n_so >= min_type) & (n_generic >= min_type) & \
+                (sd <= sd_max + eps)
+            sd = sd[keep]
+        selected, counts = selected[keep], counts[keep]
+        n_so, n_generic = n_so[keep], n_generic[keep]
+
+    # selections are in lexicographic order, a stable sort keeps it for ties
+    order = np.argsort(np.round(sd, 9), kind="stable")[:k]
+    return T_unique[selected[order]], sd[order]
 
 
 def gen_binary_compositions(T_unique, n_primitives=5, min_type=2,
-                            sd_max=0.5, sep='-'):
+                            sd_max=0.5, k=None, sep='-', rng=None):
     ''' Select n_primitives transmuters from T_unique, such that at least
         min_type binary compositions of each composition type listed below
         are composed from them AND the distribution of of primitive maps is
         balanced in terms of categories
 
+        The selection is drawn uniformly from all qualifying selections (or
+        the k best balanced ones), see search_primitive_sets
+
         Returns T_selection and a dictionary with all derived compositions 
         '''
-    sd = 99
-    binary_comps_dict = {"second-only": [],
-                         "transitive": [],
-                         "generic": []
-                         }
-
-    while len(binary_comps_dict["second-only"]) < min_type or \
-            len(binary_comps_dict["generic"]) < min_type or \
-            sd > sd_max:
-        T_selection = np.random.choice(T_unique,
-                                       size=n_primitives,
-                                       replace=False)
-        sd = io_dist(T_selection, sep=sep)
-
-        T_comp_unique = cartesian_product(T_selection,
-                                          discard_reps=True,
-                                          strcat=False,
+    if rng is None:
+        rng = np.random
+    selections, _ = search_primitive_sets(T_unique,
+                                          n_primitives=n_primitives,
+                                          min_type=min_type,
+                                          sd_max=sd_max,
+                                          k=k,
                                           sep=sep)
-        # Extract special types
-        binary_comps_dict = split_into_categories(T_comp_unique)
+    if len(selections) == 0:
+        raise ValueError(f"No selection of {n_primitives} maps yields "
+                         f"{min_type} second-only and generic compositions "
+                         f"with an item sd <= {sd_max}")
+    T_selection = rng.permutation(selections[rng.choice(len(selections))])
+
+    T_comp_unique = cartesian_product(T_selection,
+                                      discard_reps=True,
+                                      strcat=False,
+                                      sep=sep)
+    # Extract special types
+    binary_comps_dict = split_into_categories(T_comp_unique)
     return T_selection, binary_comps_dict
 
 
-def select_binary_compositions(binary_comps_dict):
+def rank_binary_compositions(binary_comps_dict, n_second_only=2, n_generic=2):
+    '''Scores every combination of n_second_only second-only maps with every
+       combination of n_generic generic maps: a combination is feasible if
+       the first primitive of exactly one second-only map does not appear in
+       the generic maps
+
+       Returns the feasible selections, shape (n, n_second_only + n_generic, 2),
+       ranked by the occurrence counts of the first primitives in the generic
+       maps (lexicographically, highest first), and the counts'''
+    maps_second_only = np.asarray(binary_comps_dict["second-only"])
+    maps_generic = np.asarray(binary_comps_dict["generic"])
+    idx_so = np.array(list(combinations(range(len(maps_second_only)),
+                                        n_second_only)), dtype=np.intp)
+    idx_g = np.array(list(combinations(range(len(maps_generic)), n_generic)),
+                     dtype=np.intp)
+    n_maps = n_second_only + n_generic
+    if len(idx_so) == 0 or len(idx_g) == 0:
+        return np.zeros((0, n_maps, 2), dtype=maps_generic.dtype), \
+            np.zeros((0, n_second_only), dtype=int)
+    idx_so = idx_so.reshape(len(idx_so), n_second_only)
+    idx_g = idx_g.reshape(len(idx_g), n_generic)
+
+    # occurrences of the first primitive of each second-only map in each
+    # generic map, shape (n_second_only_maps, n_generic_maps)
+    first_prims = maps_second_only[:, 0]
+    occurrences = (maps_generic[None] == first_prims[:, None, None]).sum(axis=2)
+    # counts per combination, shape (n_so_combinations, n_g_combinations, n_second_only)
+    counts = occurrences[idx_so[:, None, :, None],
+                         idx_g[None, :, None, :]].sum(axis=3)
+    feasible = np.count_nonzero(counts == 0, axis=2) == 1
+    i_so, i_g = np.nonzero(feasible)  # in loop order of the combinations
+    counts = counts[i_so, i_g]
+    # stable lexicographic sort, highest counts first
+    order = np.lexsort(-counts.T[::-1])
+    i_so, i_g, counts = i_so[order], i_g[order], counts[order]
+    selections = np.concatenate((maps_second_only[idx_so[i_so]],
+                                 maps_generic[idx_g[i_g]]), axis=1)
+    return selections, counts
+
+
+def select_binary_compositions(binary_comps_dict, n_second_only=2, n_generic=2):
     '''Takes dictionary of binary compositions and two second-only maps, such
        that the first primitive of only one second-only map does not appear in
        other compositions, returns a list of selected compositions'''
-    maps_second_only = binary_comps_dict["second-only"]
-    maps_generic = binary_comps_dict["generic"]
-
-    idx_so = list(combinations([i for i in range(len(maps_second_only))], 2))
-    idx_g = list(combinations([i for i in range(len(maps_generic))], 2))
-
-    working_indices = []
-
-    for idx_1 in idx_so:
-        selection_second_only = maps_second_only[idx_1, :]
-        prim_so_1, prim_so_2 = selection_second_only[0,
-                                                     0], selection_second_only[1, 0]
-
-        for idx_2 in idx_g:
-            selection_rest = maps_generic[idx_2, :]
-            count_1 = np.count_nonzero(selection_rest == prim_so_1)
-            count_2 = np.count_nonzero(selection_rest == prim_so_2)
-
-            if count_1 > 0 and count_2 == 0 or count_2 > 0 and count_1 == 0:
-                working_indices.append([[idx_1, idx_2],
-                                        [count_1, count_2]])
-
-    working_indices = np.array(working_indices, dtype=object)
-    best_idx = working_indices[np.argmax(working_indices[:, 1])]
-    maps_selection = np.concatenate((maps_second_only[best_idx[0][0], :],
-                                     maps_generic[best_idx[0][1], :]))
-    return maps_selection
-
-
-def apply_map(display, general_map, past_transforms=0, sep='-'):
-    ''' recursively apply maps to an initial display and return final image '''
-    display_in = display.copy()
-    intermediate_display = display_in.copy()
-    if isinstance(general_map, str):
-        general_map = [general_map]
-    if len(general_map) > 0:
-        map_tmp = general_map[0]
-        remaining_maps = general_map[1:]
-        t_in = map_tmp.split(sep)[0]
-        t_out = map_tmp.split(sep)[1]
-        past_transforms += sum(display_in == t_in)
-        display_in[display_in == t_in] = t_out
-        intermediate_display = display_in.copy()
-        display_in, _, past_transforms = apply_map(display_in, remaining_maps,
-                                                past_transforms=past_transforms,
-                                                sep=sep)
-    return display_in, intermediate_display, past_transforms 
-
-
-def draw_count_target(stimuli, resp, instances, instance_count, p=None):
-    '''draw a target item with an adaptive probability distr. depending on
-        previous target draws, the correct response and output display'''
-    target = None
-    if p is None:
-        p = np.tile(1/len(stimuli), len(stimuli))
-    if resp in instance_count:
-        p_idx = [item in instances[resp == instance_count] for item in stimuli]
-        p_tmp = p[p_idx]
-        if sum(p_tmp) > 0:
-            p = p_tmp/sum(p_tmp)
-            target = np.random.choice(instances[resp == instance_count], p=p)
-        else:
-            target = instances[resp == instance_count][0]
-    elif resp == 0:
-        remainder = list(set(stimuli)-set(instances))
-        p_idx = [item in remainder for item in stimuli]
-        p_tmp = p[p_idx]
-        if sum(p_tmp) > 0:
-            p = p_tmp/sum(p_tmp)
-            target = np.random.choice(remainder, p=p)
-        else:
-            target = remainder[0]
-    return target
-
-
-def draw_position_target(stimuli, resp, display_out,
-                         display_size=6, n_options=4, p=None):
-    '''randomly draw a target position,
-    put corresponding item from display_out into ordered response_options
-    randomly fill the remaining options up with distinct categories'''
-    target_position = None
-    target_position = np.random.choice(
-        range(display_size), p=p)  # randomly draw position
-    target_item = display_out[target_position]
-    # init ordered response options
-    response_options = np.tile(None, n_options)
-    response_options[resp] = target_item
-    remaining_categories = np.delete(stimuli, stimuli == target_item, axis=0)
-    other_options = np.random.choice(remaining_categories, size=n_options-1,
-                                     replace=False)
-    response_options[response_options == None] = other_options
-    return target_position, response_options
-
-
-def gen_trial_dict_object_dec(stimuli, stim_idx, pos_idx, jitter_interval=range(-30, 30), catch=False):
-    """ subroutine to generate a trial dictionary for object decoding task"""
-    # input display
-    stim = stimuli[stim_idx]
-    input_disp = [None] * display_size
-    input_disp[pos_idx] = stim
-    jitter = np.random.choice(jitter_interval)/1000
-    
-    # catch trial specifics
-    target = None
-    correct_resp = None
-    if catch:
-        correct_resp = np.random.choice([True, False])
-        if correct_resp:
-            target = stim
+    selections, _ = rank_binary_compositions(binary_comps_dict,
+                                             n_second_only=n_second_only,
+                                             n_generic=n_generic)
+    if len(selections) == 0:
+        raise ValueError("No feasible selection of binary compositions")
+    return selections[0]
+
+
+def draw_weighted_rows(weights, rng=None):
+    ''' draw one column index per row of a non-negative weight matrix'''
+    if rng is None:
+        rng = np.random
+    cum = np.cumsum(weights, axis=1)
+    u = rng.random(len(weights)) * cum[:, -1]
+    return np.minimum((cum <= u[:, None]).sum(axis=1), weights.shape[1] - 1)
+
+
+def necessary_item_codes(codes, map_type):
+    ''' input items that have to be in the display for the map to apply'''
+    necessary = [codes[0, 0]]
+    if map_type == "second-only":
+        necessary.append(codes[1, 0])
+    return np.array(necessary, dtype=np.uint8)
+
+
+def gen_trials_batch(stimuli, map_list, jitter,
+                     resp_list=list(range(4)), test_type="count",
+                     trial_type="generic", display_size=4, max_duplicates=3,
+                     max_rounds=20, n_probe=4096, sep='-', index=None, rng=None):
+    ''' generate the trials for a whole block at once: correct responses and
+        targets are allocated up front over the feasible cells (exactly
+        counterbalanced, see TrialAllocation), then displays are drawn for
+        all trials in vectorized batches and only the failing rows are
+        resampled; without an enumerable index feasibility is estimated from
+        n_probe random displays per map and trials whose allocated cell
+        stays infeasible after max_rounds get the most underrepresented
+        feasible target instead'''
+    if rng is None:
+        rng = np.random
+    if test_type not in ["count", "position"]:
+        raise Exception("Test type not implemented")
+    n_stim = len(stimuli)
+    num_trials = len(map_list)
+    codes, map_idx = SpellEngine.parse_maps(map_list, stimuli, sep=sep)
+    tables = SpellEngine.map_tables(codes, n_stim)
+    first_rows = [np.flatnonzero(map_idx == u)[0] for u in range(len(codes))]
+    unique_maps = [list(np.atleast_1d(map_list[r])) for r in first_rows]
+    map_types = [analyze_map_type(m, sep=sep) for m in unique_maps]
+    necessary = [necessary_item_codes(codes[u], map_types[u])
+                 for u in range(len(codes))]
+    n_targets = n_stim if test_type == "count" else display_size
+    use_index = index is not None and index.enumerable
+
+    # feasible (map, correct response, target) cells
+    feasible = np.zeros((len(codes), len(resp_list), n_targets), dtype=bool)
+    for u in range(len(codes)):
+        if use_index:
+            valid = index.valid_rows(unique_maps[u], necessary[u], max_duplicates)
+            counts = index.entry(unique_maps[u])["counts"][valid]
         else:
-            choice_set = np.delete(stimuli, stim_idx)
-            target = np.random.choice(choice_set)
-    
-    # trial dictionary
-    trial_dict = {"trial_type": "object_decoder",
-                  "input_disp": input_disp,
-                  "is_catch_trial": catch,
-                  "target": target,
-                  "correct_resp": correct_resp,
-                  "jitter": jitter} 
-    return trial_dict
-
-
-def gen_trial_dict(stimuli, general_map, resp,
-                   resp_list=None, test_type="count", trial_type="generic",
-                   p=None, display_size=5, max_duplicates=3, jitter=0.0,
-                   sep='-'):
-    ''' takes a set of stimuli, a general map and a fixed correct response,
-        then generates a dict containing adequate input, output displays,
-        a target item and the (max) number of mental transformations'''
-    if isinstance(general_map, str):
-        general_map = [general_map]
-    map_type = analyze_map_type(general_map, sep=sep)
-    target = None
-    max_ic = 99  # initialization
-
-    # generate displays until criteria for counting are met
-    while target is None or max_ic > max_duplicates:
-        necessary_items = np.concatenate(
-            np.char.split(general_map, sep=sep))[0]
-        if map_type == "second-only":
-            necessary_items = np.append(
-                necessary_items,
-                np.concatenate(np.char.split(general_map, sep=sep))[2]
-            )
-
-        other_items = np.random.choice(
-            stimuli,
-            size=display_size-len(necessary_items),
-            replace=True,
-            )
-        display_in = np.append(necessary_items, other_items)
-        display_in = np.random.permutation(display_in)
-        display_out, intermediate_display, past_transforms = apply_map(
-            display_in, general_map, sep=sep)
-        instances, instance_count = np.unique(display_out,
-                                              return_counts=True)
-        max_ic = instance_count.max()
+            probe = SpellEngine.random_displays(
+                n_probe, display_size, n_stim, necessary=necessary[u], rng=rng)
+            probe_out = SpellEngine.apply_tables(
+                probe, tables, np.full(n_probe, u))[0]
+            counts = SpellEngine.count_items(probe_out, n_stim)
+            counts = counts[counts.max(axis=1) <= max_duplicates]
         if test_type == "count":
-            response_options = np.array(resp_list)
-            target = draw_count_target(
-                stimuli, resp, instances, instance_count, p=p)
-        elif test_type == "position":
-            target, response_options = draw_position_target(
-                stimuli, resp, display_out,
-                display_size=display_size,
-                n_options=len(resp_list),
-                p=p,
-                )
+            for k, r in enumerate(resp_list):
+                feasible[u, k] = (counts == r).any(axis=0)
         else:
-            raise Exception("Test type not implemented")
-
-    # compile down
-    compiled_map = compile_down(general_map,
-                                map_type=map_type,
-                                display=display_in,
-                                sep=sep)
-    if np.array_equal(compiled_map, general_map):
-        past_transforms_sparse = past_transforms
+            feasible[u] = len(counts) > 0
+    resp_idx, targets, _ = TrialAllocation.allocate_trials(
+        map_idx, len(resp_list), feasible, rng=rng)
+    resp = np.asarray(resp_list)[resp_idx]
+    quota = np.full(n_targets, num_trials / n_targets)
+    displays_in = np.zeros((num_trials, display_size), dtype=np.uint8)
+    if use_index:
+        max_rounds = 1  # index draws are valid by construction
+
+    def draw(rows, relaxed=False):
+        ''' draw displays for rows, returns the mask of accepted rows'''
+        drawn = np.ones(num_trials, dtype=bool)
+        for u in np.unique(map_idx[rows]):
+            rows_u = rows[map_idx[rows] == u]
+            if use_index and not relaxed:
+                displays_in[rows_u], drawn[rows_u] = draw_from_index(rows_u, u)
+            else:
+                displays_in[rows_u] = SpellEngine.random_displays(
+                    len(rows_u), display_size, n_stim, necessary=necessary[u],
+                    rng=rng)
+        display_out = SpellEngine.apply_tables(
+            displays_in[rows], tables, map_idx[rows])[0]
+        counts = SpellEngine.count_items(display_out, n_stim)
+        ok = (counts.max(axis=1) <= max_duplicates) & drawn[rows]
+        if test_type == "position":
+            return ok
+        if relaxed:
+            # reassign targets, preferring those below their quota
+            used = np.bincount(targets[done], minlength=n_targets)
+            deficit = np.maximum(quota - used, 0) + 1e-3
+            feasible = (counts == resp[rows, None]) & ok[:, None]
+            ok = feasible.any(axis=1)
+            targets[rows[ok]] = draw_weighted_rows(
+                feasible[ok] * deficit, rng=rng)
+            return ok
+        return ok & (counts[np.arange(len(rows)), targets[rows]] == resp[rows])
+
+    def draw_from_index(rows_u, u):
+        ''' draw displays for rows of the same map by masking the index,
+            returns the displays and which rows could be drawn'''
+        general_map = unique_maps[u]
+        valid = index.valid_rows(general_map, necessary[u], max_duplicates)
+        out = np.zeros((len(rows_u), display_size), dtype=np.uint8)
+        drawn = np.ones(len(rows_u), dtype=bool)
+        if test_type == "position":
+            out[:] = index.displays[rng.choice(np.flatnonzero(valid),
+                                               size=len(rows_u))]
+            return out, drawn
+        counts = index.entry(general_map)["counts"]
+        for r in np.unique(resp[rows_u]):
+            for t in np.unique(targets[rows_u]):
+                sel = (resp[rows_u] == r) & (targets[rows_u] == t)
+                hits = np.flatnonzero(valid & (counts[:, t] == r))
+                if len(hits) > 0:
+                    out[sel] = index.displays[rng.choice(hits, size=sel.sum())]
+                else:
+                    drawn[sel] = False
+        return out, drawn
+
+    done = np.zeros(num_trials, dtype=bool)
+    for round_idx in range(max_rounds):
+        rows = np.flatnonzero(~done)
+        if len(rows) == 0:
+            break
+        done[rows[draw(rows)]] = True
+    n_relaxed = 0
+    while not done.all():
+        rows = np.flatnonzero(~done)
+        done[rows[draw(rows, relaxed=True)]] = True
+        n_relaxed += 1
+        if n_relaxed > 1000:
+            raise ValueError("Could not find displays for all correct responses")
+
+    # transform all displays at once
+    displays_out, intermediate_displays, trans_ub, trans_lb = \
+        SpellEngine.apply_tables(displays_in, tables, map_idx)
+
+    # response options
+    if test_type == "count":
+        response_options = np.tile(np.array(resp_list), (num_trials, 1))
     else:
-        _, _, past_transforms_sparse = apply_map(
-            display_in, compiled_map, sep=sep)
-    output_dict = {"trial_type": trial_type,
-                   "map_type": map_type,
-                   "test_type": test_type,
-                   "map": np.array(general_map),
-                   "input_disp": display_in,
-                   "intermediate_disp": intermediate_display,
-                   "output_disp": display_out,
-                   "target": target,
-                   "resp_options": response_options,
-                   "correct_resp": resp,
-                   "trans_ub": past_transforms,
-                   "trans_lb": past_transforms_sparse,
-                   "jitter": jitter}
-    return output_dict
+        n_options = len(resp_list)
+        target_items = displays_out[np.arange(num_trials), targets]
+        keys = rng.random((num_trials, n_stim))
+        keys[np.arange(num_trials), target_items] = np.inf
+        others = np.argsort(keys, axis=1)[:, :n_options - 1]
+        response_options = np.zeros((num_trials, n_options), dtype=np.uint8)
+        slots = np.arange(n_options) != resp[:, None]
+        response_options[slots] = others.ravel()
+        response_options[np.arange(num_trials), resp] = target_items
+        response_options = SpellEngine.decode(response_options, stimuli)
+    target_labels = stimuli[targets] if test_type == "count" else targets
+
+    trials = []
+    for i in range(num_trials):
+        trials.append({"trial_type": trial_type,
+                       "map_type": map_types[map_idx[i]],
+                       "test_type": test_type,
+                       "map": np.array(unique_maps[map_idx[i]]),
+                       "input_disp": SpellEngine.decode(displays_in[i], stimuli),
+                       "intermediate_disp": SpellEngine.decode(
+                           intermediate_displays[i], stimuli),
+                       "output_disp": SpellEngine.decode(displays_out[i], stimuli),
+                       "target": target_labels[i],
+                       "resp_options": response_options[i],
+                       "correct_resp": resp[i],
+                       "trans_ub": trans_ub[i],
+                       "trans_lb": trans_lb[i],
+                       "jitter": jitter[i]})
+    return trials
 
 
 def gen_trials(stimuli,
@@ -405,106 +524,113 @@ def gen_trials(stimuli,
                display_size=4,
                jitter_interval=[-30, 30],
                randomize=False,
-               sep='-'):
+               sep='-',
+               index=None,
+               rng=None):
     ''' takes a list of maps and generates a datafreame (input display, map,
         output display, target, correct response)'''
-
-    if test_type == "count":
-        target_list = stimuli.copy()
-    elif test_type == "position":
-        target_list = np.array(range(display_size))
-    else:
-        raise Exception("Test type not implemented")
-    trials = []
+    if rng is None:
+        rng = np.random
     num_trials = len(map_list)
-    num_tiles_r = np.ceil(num_trials/len(resp_list)).astype('int')
-    resp_sequence = np.random.permutation(np.tile(resp_list, num_tiles_r))
-    target_urn = np.tile(num_trials/len(target_list), len(target_list))
     sample_interval = list(range(jitter_interval[0], jitter_interval[1]+1))
-    jitter = np.random.choice(
+    jitter = rng.choice(
         sample_interval,
         replace=True,
         size=(num_trials, 3),
         ) / 1000
-
-    for i in range(num_trials):
-        trial_dict = gen_trial_dict(stimuli, map_list[i], resp_sequence[i],
-                                    test_type=test_type,
-                                    trial_type=trial_type,
-                                    resp_list=resp_list,
-                                    p=target_urn/sum(target_urn),
-                                    display_size=display_size,
-                                    jitter=jitter[i,],
-                                    sep=sep)
-        if target_urn[target_list == trial_dict["target"]] >= 1:
-            # remove instance-specific counter from target urn
-            target_urn[target_list == trial_dict["target"]] -= 1
-        trials.append(trial_dict)
+    trials = gen_trials_batch(stimuli, map_list, jitter,
+                              resp_list=resp_list,
+                              test_type=test_type,
+                              trial_type=trial_type,
+                              display_size=display_size,
+                              sep=sep,
+                              index=index,
+                              rng=rng)
     if randomize:
-        trials = np.random.permutation(trials).tolist()
+        trials = [trials[k] for k in rng.permutation(num_trials)]
     return trials
 
 
-def gen_autonomous_trials(test_type, num_trials, discriminative=False):
+@lru_cache(maxsize=None)
+def autonomous_candidates(test_type, stimuli, selection, display_size,
+                          sep='-'):
+    ''' all (display, target) pairs of autonomous trials: base displays
+        (the first display_size-1 stimuli plus any one stimulus, in any order)
+        with every target, returns the encoded displays, the outputs of each
+        primitive in selection (n_prim, n_displays, display_size), the
+        display and target index of each pair and its correct responses
+        (n_pairs, n_prim); count responses are counts, position responses
+        item codes'''
+    base = list(range(display_size - 1))
+    displays = np.unique(np.array(
+        [perm for extra in range(len(stimuli))
+         for perm in permutations(base + [extra])], dtype=np.uint8), axis=0)
+    codes, _ = SpellEngine.parse_maps(list(selection), np.array(stimuli), sep=sep)
+    final, _, _ = SpellEngine.map_tables(codes, len(stimuli))
+    outputs = final[:, displays]
+    n_targets = len(stimuli) if test_type == "count" else display_size
+    disp_idx, target_idx = np.divmod(np.arange(len(displays) * n_targets), n_targets)
+    if test_type == "count":
+        correct = (outputs[:, disp_idx] == target_idx[:, None]).sum(axis=2).T
+    else:
+        correct = outputs[:, disp_idx, target_idx].T
+    return displays, outputs, disp_idx, target_idx, correct
+
+
+def gen_autonomous_trials(test_type, num_trials, discriminative=False, rng=None):
+    ''' autonomous trials, display and target sampled from all candidates
+        balanced over targets and, within targets, over the combination of
+        correct responses. Discriminative trials have distinct correct
+        responses for all primitives (count) or not the same for all
+        (position). Raises ValueError for designs without such candidates'''
+    if rng is None:
+        rng = np.random
+    if display_size - 1 > len(stimuli):
+        raise ValueError(f"Autonomous trials need display_size - 1 distinct "
+                         f"stimuli, display_size={display_size} is too large "
+                         f"for n_stim={len(stimuli)}")
+    displays, outputs, disp_idx, target_idx, correct = autonomous_candidates(
+        test_type, tuple(stimuli), tuple(selection_prim), display_size, sep=sep)
+    valid = np.ones(len(correct), dtype=bool)
+    if discriminative:
+        ordered = np.sort(correct, axis=1)
+        if test_type == "count":
+            valid = np.all(ordered[:, 1:] != ordered[:, :-1], axis=1)
+        else:
+            valid = ordered[:, 0] != ordered[:, -1]
+    valid = np.flatnonzero(valid)
+    if len(valid) == 0:
+        raise ValueError(f"No {test_type} display discriminates between the "
+                         f"{len(selection_prim)} primitives {selection_prim} "
+                         f"(display_size={display_size}, n_stim={len(stimuli)})")
+    _, resp_idx = np.unique(correct[valid], axis=0, return_inverse=True)
+    rows = valid[FactorialDesign.stratified_sample(
+        [target_idx[valid], resp_idx.ravel()], num_trials, rng=rng)]
+    jitter = FactorialDesign.jitter(num_trials, size=(3,), rng=rng)
+
     trials = []
-    jitter = np.random.choice(range(-30, 30), replace=True, size=(num_trials, 3)) / 1000
-    base_display = stimuli[:3]
-    i = 0
-    
-    while len(trials) < num_trials:
-        # init
-        # display_in is base display with one additional item
-        display_in = base_display.copy()
-        display_in = np.append(display_in, np.random.choice(stimuli))
-        display_in = np.random.permutation(display_in)
-        target = np.random.choice(stimuli) if test_type == "count" else np.random.choice(range(display_size))
-        response_options = np.arange(display_size) if test_type == "count" else np.random.permutation(stimuli)
-        
-        # apply the selection primitive to the display
-        displays_out = []
-        correct_responses = []
-        for spell in selection_prim:
-            _, display_out, _ = apply_map(display_in, spell)
-            displays_out.append(display_out)
-            if test_type == "count":
-                correct_responses.append(np.count_nonzero(display_out == target))
-            else:
-                correct_responses.append(display_out[target])
-        
-        # optionally test if the correct response is not the same for all displays
-        if discriminative:
-            if test_type == "count" and len(np.unique(correct_responses)) != len(correct_responses):
-                continue
-            elif test_type == "position" and len(np.unique(correct_responses)) == 1:
-                continue
-            
+    for i, row in enumerate(rows):
+        d, t = disp_idx[row], target_idx[row]
+        if test_type == "count":
+            target, response_options = stimuli[t], np.arange(display_size)
+            correct_responses = correct[row].tolist()
+        else:
+            target, response_options = t, rng.permutation(stimuli)
+            correct_responses = stimuli[correct[row]]
         trial_dict = {"trial_type": "autonomous",
                       "map_type": "primitive",
-                    "test_type": test_type,
-                    "input_disp": display_in,
-                    "output_disp_0": displays_out[0],
-                    "output_disp_1": displays_out[1],
-                    "output_disp_2": displays_out[2],
-                    "target": target,
-                    "resp_options": response_options,
-                    "correct_resp_0": correct_responses[0],
-                    "correct_resp_1": correct_responses[1],
-                    "correct_resp_2": correct_responses[2],
-                    "jitter": jitter[i,]}
+                      "test_type": test_type,
+                      "input_disp": stimuli[displays[d]]}
+        for k in range(len(selection_prim)):
+            trial_dict[f"output_disp_{k}"] = stimuli[outputs[k, d]]
+        trial_dict.update({"target": target, "resp_options": response_options})
+        for k in range(len(selection_prim)):
+            trial_dict[f"correct_resp_{k}"] = correct_responses[k]
+        trial_dict["jitter"] = jitter[i]
         trials.append(trial_dict)
-        i += 1
     return trials
 
 
-def map_to_integers(general_map, sep='-'):
-    ''' takes map and generates a list of corresponding integers'''
-    categories = general_map.split(sep=sep)
-    categories_int = []
-    for i in range(len(categories)):
-        categories_int.append(ord(categories[i]) - 65)
-    return categories_int
-
-
 def correct_cue_trial_resp(general_map, resp_options, sep='-'):
     ''' takes map and an ordered list of response options
     and generates a list of integers corresponding to the position of the map
@@ -517,13 +643,15 @@ def correct_cue_trial_resp(general_map, resp_options, sep='-'):
 
 
 def gen_cue_trials(map_list, stimuli,
-                   display_size=6, sep='-'):
+                   display_size=6, sep='-', rng=None):
     ''' takes a list of maps and generates a datafreame (map, target, correct response)'''
+    if rng is None:
+        rng = np.random
     trials = []
     num_trials = len(map_list)
     for i in range(num_trials):
         general_map = [map_list[i]]
-        resp_options = np.random.permutation(stimuli)
+        resp_options = rng.permutation(stimuli)
         correct_resp = correct_cue_trial_resp(
             general_map[0], resp_options, sep=sep)
         trial_dict = {"trial_type": "cue_memory",
@@ -534,92 +662,99 @@ def gen_cue_trials(map_list, stimuli,
     return trials
 
 
-def compile_down(general_map, map_type=None, display=None, sep='-'):
-    ''' takes map and generates sparser but equivalent version of it'''
-    compiled_map = general_map
-    if map_type is None:
-        map_type = analyze_map_type(general_map, sep=sep)
-    if map_type == "first-only":
-        compiled_map = general_map[0]
-    elif map_type == "second-only":
-        compiled_map = general_map[1]
-    elif display is not None and map_type == "transitive":
-        if general_map[0][2] not in display:
-            compiled_map = f"{general_map[0][0]}{sep}{general_map[1][2]}"
-    return compiled_map
-
-
-def insert_with_different_neighbors(thisList, element):
-    # easiest cases: first or last element
-    if thisList[0] != element:
-        thisList.insert(0, element)
-        return True
-    n = len(thisList)
-    if thisList[-1] != element:
-        thisList.append(element)
+def no_repeat_feasible(counts, prev=None):
+    ''' whether items (counts per item code) can be ordered without immediate
+        repeats, and without item prev at the start'''
+    counts = np.asarray(counts)
+    n = counts.sum()
+    if n == 0:
         return True
-    # hard case: somewhere in the middle
-    for i in range(1, n+1):
-        if thisList[i] != element and thisList[i-1] != element:
-            thisList.insert(i, element)
-            return True
-    return False
-
-
-def get_map_list(selection, n_repeats=1, allow_repeats=False, inary_maps=False):
-    ''' generate a list of n_repeats * selections such that no two selections are immediately adjacent '''
-    if inary_maps:
-        selection = inery2prim(selection)
-    goal_length = len(selection) * n_repeats
-    tile = np.random.permutation(
-        np.repeat(selection, n_repeats, axis=0)).tolist()
+    if counts.max() > (n + 1) // 2:
+        return False
+    return prev is None or counts[prev] <= n // 2
+
+
+def shuffle_no_repeats(counts, exclude_first=None, rng=None):
+    ''' random sequence of item codes (counts[k] instances of code k) without
+        immediate repeats, that does not start with exclude_first
+
+        each position is drawn proportional to the remaining counts among the
+        items that keep the rest feasible, i.e. O(n) for a fixed number of
+        items; raises ValueError for infeasible counts'''
+    if rng is None:
+        rng = np.random
+    counts = np.array(counts, dtype=int)
+    if not no_repeat_feasible(counts, exclude_first):
+        raise ValueError(f"Items with counts {counts.tolist()} cannot be "
+                         f"ordered without immediate repeats")
+    seq = np.empty(counts.sum(), dtype=np.intp)
+    prev = exclude_first
+    for pos in range(len(seq)):
+        weights = np.zeros(len(counts))
+        for item in np.flatnonzero(counts):
+            if item == prev:
+                continue
+            counts[item] -= 1
+            if no_repeat_feasible(counts, item):
+                weights[item] = counts[item] + 1
+            counts[item] += 1
+        cum_weights = np.cumsum(weights)
+        item = np.searchsorted(cum_weights, rng.random() * cum_weights[-1],
+                               side='right')
+        seq[pos] = item
+        counts[item] -= 1
+        prev = item
+    return seq
+
+
+def get_map_list(selection, n_repeats=1, allow_repeats=False, inary_maps=False,
+                 exclude_first=None, rng=None):
+    ''' generate a list of n_repeats * selections such that no two selections
+        are immediately adjacent (and the list does not start with
+        exclude_first, e.g. the last map of the preceding list)'''
+    if rng is None:
+        rng = np.random
     if allow_repeats:
-        out = tile
+        codes = rng.permutation(np.repeat(np.arange(len(selection)), n_repeats))
     else:
-        out = [e for i, e in enumerate(
-            tile) if i == 0 or (i > 0 and tile[i-1] != e)]
-        repeated_selections = [e for i, e in enumerate(
-            tile) if i > 0 and tile[i-1] == e]
-        while len(out) < goal_length:
-            s = repeated_selections.pop()
-            succesful = insert_with_different_neighbors(out, s)
-            if not succesful:
-                repeated_selections.append(s)
+        first = None
+        if exclude_first is not None:
+            matches = [k for k, general_map in enumerate(selection)
+                       if np.array_equal(general_map, exclude_first)]
+            first = matches[0] if matches else None
+        codes = shuffle_no_repeats([n_repeats] * len(selection),
+                                   exclude_first=first, rng=rng)
     if inary_maps:
-        return prim2inary(out)
-    return out
-
-
-def inery2prim(inery_list, sep_2='+'):
-    prims = []
-    for inary in inery_list:
-        prims.append(sep_2.join(inary))
-    return np.array(prims)
-
-
-def prim2inary(prim_list, len_inary=2, sep_2='+'):
-    inaries = []
-    for prims in prim_list:
-        inaries.append([prims.split(sep_2, 1)[j] for j in range(len_inary)])
-    return np.array(inaries)
+        return np.asarray(selection)[codes]
+    return [selection[k] for k in codes]
 
 
 # ============================================================================
 # Selection of maps
-print("Generating map selections...")
-# Generate all transmuters and compose binary maps from a selection thereof
-unique_prim = cartesian_product(stimuli, discard_reps=True,
-                                strcat=True, sep=sep)
-selection_prim, comps_dict_binary = gen_binary_compositions(
-    unique_prim,
-    n_primitives=n_primitives,
-    min_type=min_type,
-    sd_max=0.5,
-    sep=sep)
-    
-# Select binary maps such that the first primitive of only one second-only map
-# does not appear in other compositions
-selection_binary = select_binary_compositions(comps_dict_binary)
+def select_maps(rng=None):
+    ''' generate all transmuters and compose binary maps from a selection
+        thereof, then select binary maps such that the first primitive of only
+        one second-only map does not appear in other compositions'''
+    unique_prim = cartesian_product(stimuli, discard_reps=True,
+                                    strcat=True, sep=sep)
+    selection_prim, comps_dict_binary = gen_binary_compositions(
+        unique_prim,
+        n_primitives=n_primitives,
+        min_type=min_type,
+        sd_max=0.5,
+        sep=sep,
+        rng=rng)
+    selection_binary = select_binary_compositions(comps_dict_binary)
+    return selection_prim, selection_binary
+
+
+def binary_selection(selection_prim):
+    ''' binary maps selected from the compositions of the primitives in
+        selection_prim (see select_binary_compositions)'''
+    comps = cartesian_product(np.asarray(selection_prim), discard_reps=True,
+                              strcat=False, sep=sep)
+    return select_binary_compositions(split_into_categories(comps))
+
 
 # # Generate structural conjugates for the selected binary maps (second draft)
 # unique_prim_rest = np.setdiff1d(unique_prim, selection_prim)
@@ -630,204 +765,923 @@ selection_binary = select_binary_compositions(comps_dict_binary)
 #     sd_max=0.5,
 #     sep=sep)
 # selection_binary_conj = select_binary_compositions(comps_dict_binary_conj)
+
+# Fixed selection used in the study (instead of a new one from select_maps)
 selection_prim = ['A-B', 'B-A', 'C-D']
 selection_binary = [['B-A', 'A-B'],
                     ['A-B', 'C-D'],
                     ['C-D', 'B-A']]
 
-print("Primitives:", selection_prim)
-print("Binaries:", selection_binary)
-    
 # Localizer lists
-print("Generating localizer lists...")
 selection_prim_loc = np.tile(selection_prim, n_exposure_loc_quick)
 selection_prim_loc_query = np.tile(selection_prim, n_exposure_loc_catch)
 stimuli_loc = np.tile(stimuli, n_exposure_loc_quick)
 stimuli_loc_query = np.tile(stimuli, n_exposure_loc_catch)
 
+# Outcomes of all possible displays per map (falls back to sampling if the
+# display space is too large)
+display_index = DisplayIndex(stimuli, display_size, cache_dir=cache_dir, sep=sep)
+
+
+# ============================================================================
+# Configuration
+# Settings derived from the user settings, recomputed by configure
+DERIVED_SETTINGS = ["min_type", "n_exposure_loc_quick", "n_exposure_loc_catch",
+                    "stimuli", "selection_prim", "selection_binary",
+                    "selection_prim_loc", "selection_prim_loc_query",
+                    "stimuli_loc", "stimuli_loc_query", "display_index"]
+
+
+def current_config():
+    ''' the user settings as a GenerationConfig'''
+    return GenerationConfig(**{name: globals()[name] for name in
+                               GenerationConfig.names() if name in globals()})
+
+
+def configure(settings, map_seed=0):
+    ''' set user settings (dict name -> value, e.g. GenerationConfig.settings)
+        and recompute the settings derived from them, unless given; map
+        selections of None are drawn anew from map_seed (select_maps), the
+        binary maps from the given primitives if only they are set.
+        Returns the previous values, configure(old) restores them'''
+    global min_type, n_exposure_loc_quick, n_exposure_loc_catch, stimuli, \
+        selection_prim, selection_binary, selection_prim_loc, \
+        selection_prim_loc_query, stimuli_loc, stimuli_loc_query, display_index
+    unknown = [name for name in settings if name not in globals()]
+    if unknown:
+        raise ValueError(f"Unknown settings: {', '.join(unknown)}")
+    old = {name: globals()[name] for name in list(settings) + DERIVED_SETTINGS}
+    globals().update(settings)
+    if "min_type" not in settings:
+        min_type = np.floor(n_primitives/3)
+    if "n_exposure_loc_quick" not in settings:
+        n_exposure_loc_quick = round(n_exposure_loc * (1.-percentage_catch))
+    if "n_exposure_loc_catch" not in settings:
+        n_exposure_loc_catch = round(n_exposure_loc * percentage_catch)
+    if "stimuli" not in settings:
+        stimuli = np.array(list(string.ascii_uppercase)[:n_stim])
+    if selection_prim is None:
+        prims, binaries = select_maps(rng=np.random.default_rng(map_seed))
+        selection_prim = [str(prim) for prim in prims]
+        selection_binary = [[str(prim) for prim in binary] for binary in binaries]
+    elif selection_binary is None:
+        selection_binary = [[str(prim) for prim in binary]
+                            for binary in binary_selection(selection_prim)]
+    if "selection_prim_loc" not in settings:
+        selection_prim_loc = np.tile(selection_prim, n_exposure_loc_quick)
+        selection_prim_loc_query = np.tile(selection_prim, n_exposure_loc_catch)
+        stimuli_loc = np.tile(stimuli, n_exposure_loc_quick)
+        stimuli_loc_query = np.tile(stimuli, n_exposure_loc_catch)
+    if "display_index" not in settings and (
+            (display_size, sep, cache_dir) != (old["display_index"].display_size,
+                                               old["display_index"].sep,
+                                               old["display_index"].cache_dir)
+            or not np.array_equal(stimuli, old["display_index"].stimuli)):
+        display_index = DisplayIndex(stimuli, display_size, cache_dir=cache_dir,
+                                     sep=sep)
+    return old
+
+
+def load_config(fname):
+    ''' configure the settings of a TOML or JSON file (see GenerationConfig),
+        returns them with the drawn map selections, e.g. for configuring
+        worker processes'''
+    config = GenerationConfig.load(fname, base=current_config())
+    configure(config.settings(), map_seed=config.map_seed)
+    return {name: globals()[name] for name in config.settings()}
+
+
+@contextmanager
+def configured(settings, map_seed=0):
+    ''' user settings set for the duration of the context, see configure'''
+    old = configure(settings, map_seed=map_seed)
+    try:
+        yield
+    finally:
+        configure(old)
+
 
 # ============================================================================
 # Generate Blocks
-with open(stim_dir + os.sep + "spell_names.csv", newline='') as f:
-    reader = csv.reader(f)
-    tcue_list = list(reader)[0]
-vcue_list = glob.glob(stim_dir + os.sep + "c_*.png")
-vcue_list = [Path(fname).stem for fname in vcue_list]  # remove trunk
-stim_list = glob.glob(stim_dir + os.sep + "s_*.png")
-stim_list = [Path(fname).stem for fname in stim_list]
-
-
-
-for i in range(first_participant, first_participant+n_participants):
-    print(f"Generating trial lists for participant {i}...")
-    
-    # ========================================================================
-    # 0. Mappings between cues and stimuli
-    tcue_list = np.random.permutation(tcue_list)
-    vcue_list = np.random.permutation(vcue_list)
-    stim_list = np.random.permutation(stim_list)
-    fname = f"{trial_list_dir}{os.sep}{str(i).zfill(2)}_mappinglists"
-    data = {'tcue': tcue_list, 'vcue': vcue_list, 'stim': stim_list}
-    if save_this:
-        save_object(data, fname, ending=ending)
-    
-    
-    # ========================================================================
-    # 1. Practice blocks
-    # 1.1 Cue Memory
-    df_list = []
+# Block generators yield the trials of a block in chunks (lists of trial dicts
+# or TrialTables, the mapping lists as one dict), so that long blocks can be
+# streamed to disk, see block_chunks
+def load_cue_lists():
+    ''' names of the textual cues, visual cues and stimulus images'''
+    with open(stim_dir + os.sep + "spell_names.csv", newline='') as f:
+        reader = csv.reader(f)
+        tcue_list = list(reader)[0]
+    vcue_list = sorted(glob.glob(stim_dir + os.sep + "c_*.png"))
+    vcue_list = [Path(fname).stem for fname in vcue_list]  # remove trunk
+    stim_list = sorted(glob.glob(stim_dir + os.sep + "s_*.png"))
+    stim_list = [Path(fname).stem for fname in stim_list]
+    return tcue_list, vcue_list, stim_list
+
+
+def partition_runs(trials, labels, sequence=None, first_run=0, rng=None):
+    ''' order of trials (dicts) partitioned into runs of about run_length s
+        that are balanced over labels (dict factor -> value per trial), see
+        RunPartition; sets the "run" of each trial, counted from first_run'''
+    durations = RunPartition.expected_durations(trials, trial_durations)
+    runs = RunPartition.partition(
+        labels, RunPartition.n_runs(durations, run_length), rng=rng)
+    for trial, run in zip(trials, runs):
+        trial["run"] = first_run + int(run)
+    return RunPartition.run_order(runs, sequence=sequence, rng=rng)
+
+
+def gen_block_mappinglists(rng, participant=None):
+    ''' 0. Mappings between cues and stimuli, counterbalanced across the
+        cohort (see CohortAssignment) if the participant is given'''
+    tcue_list, vcue_list, stim_list = load_cue_lists()
+    if mapping_assignment == "latin-square" and participant is not None:
+        yield CohortAssignment.assign_mappinglists(
+            {'tcue': tcue_list, 'vcue': vcue_list, 'stim': stim_list},
+            participant, seed=cohort_seed)
+        return
+    yield {'tcue': rng.permutation(tcue_list),
+           'vcue': rng.permutation(vcue_list),
+           'stim': rng.permutation(stim_list)}
+
+
+def gen_block_prim_cue(rng):
+    ''' 1.1 Cue Memory, one chunk per repetition'''
+    last_map = None  # no repeat across sub-block junctions
     for _ in range(maxn_repeats):
         cue_list_prim = get_map_list(
             selection_prim,
             n_repeats=n_exposure_practice*2,
             allow_repeats=False,
+            exclude_first=last_map,
+            rng=rng,
             )
-        trials = gen_cue_trials(cue_list_prim, stimuli)
-        df_list.append(trials)
-    trials_prim_cue = [item for sublist in df_list for item in sublist]
-    fname = f"{trial_list_dir}{os.sep}{str(i).zfill(2)}_trials_prim_cue"
-    if save_this:
-        save_object(trials_prim_cue, fname, ending=ending)
-
-    # 1.2 Test Practice
-    for test_type in ["count", "position"]:
-        df_list = []
-        for _ in range(maxn_repeats):
-            map_list_prim = get_map_list(
-                selection_prim,
-                n_repeats=n_exposure_practice,
-                allow_repeats=False,
+        last_map = cue_list_prim[-1]
+        yield gen_cue_trials(cue_list_prim, stimuli, rng=rng)
+
+
+def gen_block_prim_practice(rng, test_type):
+    ''' 1.2 Test Practice, one chunk per repetition'''
+    last_map = None  # no repeat across sub-block junctions
+    for _ in range(maxn_repeats):
+        map_list_prim = get_map_list(
+            selection_prim,
+            n_repeats=n_exposure_practice,
+            allow_repeats=False,
+            exclude_first=last_map,
+            rng=rng,
+            )
+        last_map = map_list_prim[-1]
+        yield gen_trials(
+            stimuli,
+            map_list_prim,
+            resp_list=resp_list,
+            trial_type="test_practice",
+            test_type=test_type,
+            display_size=display_size,
+            sep=sep,
+            index=display_index,
+            rng=rng,
+            )
+
+
+def gen_block_generic(rng, spell_type):
+    ''' 2. Generic blocks
+        generate trials twice with n_exposure/2 and each test display type,
+        then partition both generated lists into balanced runs in random
+        order, one chunk per repetition (trials are counterbalanced within a
+        chunk)'''
+    test_types = ["count", "position"]
+    n_exposure = n_exposure_prim if spell_type == "prim" else n_exposure_binary
+    selection = selection_prim if spell_type == "prim" else selection_binary
+    first_run = 0
+    for _ in range(maxn_repeats//2):
+        block_list = []
+        for test_type in test_types:
+            map_list = get_map_list(
+                selection,
+                n_repeats=n_exposure,
+                inary_maps=(spell_type == "binary"),
+                allow_repeats=True,
+                rng=rng,
                 )
             trials = gen_trials(
                 stimuli,
-                map_list_prim,
+                map_list,
                 resp_list=resp_list,
-                trial_type="test_practice",
                 test_type=test_type,
                 display_size=display_size,
                 sep=sep,
+                index=display_index,
+                rng=rng,
                 )
-            df_list.append(trials)
-        trials_prim_practice_c = [item for sublist in df_list for item in sublist]
-        fname = f"{trial_list_dir}{os.sep}{str(i).zfill(2)}_trials_prim_prac_{test_type[0]}"
-        if save_this:
-            save_object(trials_prim_practice_c, fname, ending=ending)
-      
-    
-    # ========================================================================
-    # 2. Generic blocks
-    # generate trials twice with n_exposure/2 and each test display type,
-    # then randomly permute both generated lists
-    spell_types = ["prim", "binary"]
-    test_types = ["count", "position"]
-    for spell_type in spell_types:
-        n_exposure = n_exposure_prim if spell_type == "prim" else n_exposure_binary
-        selection = selection_prim if spell_type == "prim" else selection_binary
-        df_list = []
-        for _ in range(maxn_repeats//2):
-            block_list = []
-            for test_type in test_types:
-                map_list = get_map_list(
-                    selection,
-                    n_repeats=n_exposure,
-                    inary_maps=(spell_type == "binary"),
-                    allow_repeats=True,
-                    )
-                trials = gen_trials(
-                    stimuli,
-                    map_list,
-                    resp_list=resp_list,
-                    test_type=test_type,
-                    display_size=display_size,
-                    sep=sep,
-                    )
-                block_list.append(trials)
-            trials_flat = [item for sublist in block_list for item in sublist]
-            df_list.append(np.random.permutation(trials_flat).tolist())
-        trials_prim = [item for sublist in df_list for item in sublist]
-        fname = f"{trial_list_dir}{os.sep}{str(i).zfill(2)}_trials_{spell_type}"
-        if save_this:
-            save_object(trials_prim, fname, ending=ending)
-    
-        
-    # ========================================================================
-    # 3. Object decoder blocks
-    df_list = []
-    
-    for catch in [False, True]:
-        n_exp = n_exposure_loc_catch if catch else n_exposure_loc_quick
-    
-        for _ in range(n_exp):
-            for stim_idx in range(len(stimuli)):
-                for pos_idx in range(display_size):
-                    trial = gen_trial_dict_object_dec(stimuli, stim_idx, pos_idx, catch=catch)
-                    df_list.append(trial)
-    
-    trials_localizer = np.random.permutation(df_list).tolist()
-    fname = f"{trial_list_dir}{os.sep}{str(i).zfill(2)}_trials_obj_dec"
-    if save_this:
-        save_object(trials_localizer, fname, ending=ending)
-
-
-    # ========================================================================
-    # 4. Spell decoder blocks
-    df_list = []
-    
-    jitter_interval = range(-30, 30)
-    n_prim_decoder_trials = int(np.ceil(n_exposure_prim_dec/(display_size * 4)))
-    
-    for prim in selection_prim:
-        for pos in range(display_size):
-            for correct_resp in [0, 1, 2, 3]:
-                for applicable in [True, False]:
-                    if applicable:
-                        input, output = prim[0], prim[2]
-                    else:
-                        stim_tmp = stimuli.copy().tolist()
-                        stim_tmp.remove(prim[0])
-                        input = np.random.choice(stim_tmp)
-                        output = input
-                    input_disp = [''] * display_size
-                    input_disp[pos] = input
-                    output_disp = input_disp.copy()
-                    output_disp[pos] = output
-                    resp_options = np.random.permutation(stimuli)
-                    
-                    # if the desired response is not at the correct location
-                    # swap the two response options
-                    if resp_options[correct_resp] != output:
-                        idx = np.where(resp_options == output)[0][0]
-                        resp_options[idx] = resp_options[correct_resp]
-                        resp_options[correct_resp] = output
-
-                    trial = {'trial_type': 'prim_decoder',
-                            'input_disp': np.array(input_disp),
-                            'output_disp': np.array(output_disp),
-                            'map': [prim],
-                            'applicable': applicable,
-                            'test_type': 'position',
-                            'resp_options': resp_options,
-                            'correct_resp': correct_resp,
-                            'target': pos,
-                            'map_type': 'primitive',
-                            'jitter': np.random.choice(
-                                jitter_interval, 3, replace=True)/1000
-                            }
-                    df_list.append(trial)
-    
-    trials_prim_decoder = np.random.permutation(df_list).tolist()
-    fname = f"{trial_list_dir}{os.sep}{str(i).zfill(2)}_trials_prim_dec"
-    if save_this:
-        save_object(trials_prim_decoder, fname, ending=ending)
-                    
-    # ========================================================================
-    # 5. Autonomous blocks
-    df_list = [gen_autonomous_trials(test_type, 60, discriminative=True) for test_type in ["count", "position"]]
-    trials_auto = [item for sublist in df_list for item in sublist]
-    trials_auto = np.random.permutation(trials_auto).tolist()
-    fname = f"{trial_list_dir}{os.sep}{str(i).zfill(2)}_trials_auto"
-    if save_this:
-        save_object(trials_auto, fname, ending=ending)
-   
-        
-        
+            block_list.append(trials)
+        trials_flat = [item for sublist in block_list for item in sublist]
+        labels = {name: [trial[name] for trial in trials_flat] for name in
+                  ["map", "test_type", "correct_resp", "target"]}
+        order = partition_runs(trials_flat, labels, first_run=first_run, rng=rng)
+        first_run = trials_flat[order[-1]]["run"] + 1
+        yield [trials_flat[k] for k in order]
+
+
+def gen_block_obj_dec(rng):
+    ''' 3. Object decoder blocks: stimulus x position, crossed n_exposure_loc
+        times, of which n_exposure_loc_catch times as catch trials'''
+    factors = {"stim": np.arange(len(stimuli)), "pos": np.arange(display_size)}
+    design = FactorialDesign.concat(
+        FactorialDesign.factorial(dict(is_catch_trial=[False], **factors),
+                                  repeats=n_exposure_loc_quick),
+        FactorialDesign.factorial(dict(is_catch_trial=[True], **factors),
+                                  repeats=n_exposure_loc_catch))
+    n = FactorialDesign.n_rows(design)
+    catch, stim = design["is_catch_trial"], design["stim"]
+    design["input_disp"] = FactorialDesign.place_items(
+        n, display_size, design["pos"], stimuli[stim], None)
+    # catch trials ask whether the target was shown
+    correct = FactorialDesign.bernoulli(n, rng=rng)
+    other = FactorialDesign.draw_other(len(stimuli), stim, rng=rng)
+    design["target"] = np.full(n, None, dtype=object)
+    design["target"][catch] = stimuli[np.where(correct, stim, other)][catch]
+    design["correct_resp"] = np.full(n, None, dtype=object)
+    design["correct_resp"][catch] = correct[catch].tolist()
+    design["jitter"] = FactorialDesign.jitter(n, rng=rng)
+
+    trials = FactorialDesign.to_dicts(
+        {key: design[key] for key in ["input_disp", "is_catch_trial", "target",
+                                      "correct_resp", "jitter"]},
+        constants={"trial_type": "object_decoder"})
+    for trial in trials:
+        trial["input_disp"] = trial["input_disp"].tolist()
+    # balanced runs, transitions between the decoded stimuli balanced within
+    order = partition_runs(trials, {"stim": stim, "pos": design["pos"],
+                                    "is_catch_trial": catch},
+                           sequence=stim.tolist(), rng=rng)
+    yield TrialTable.from_dicts(trials, alphabet=stimuli, sep=sep,
+                                dtypes=FIELD_DTYPES).take(order)
+
+
+def gen_block_prim_dec(rng):
+    ''' 4. Spell decoder blocks: map x position x correct response x
+        applicable, the map is applicable if its input is on the display'''
+    design = FactorialDesign.factorial({
+        "map": np.arange(len(selection_prim)),
+        "target": np.arange(display_size),
+        "correct_resp": np.asarray(resp_list),
+        "applicable": [True, False]})
+    n = FactorialDesign.n_rows(design)
+    codes = {item: k for k, item in enumerate(stimuli)}
+    prim_in = np.array([codes[prim.split(sep)[0]] for prim in selection_prim])
+    prim_out = np.array([codes[prim.split(sep)[1]] for prim in selection_prim])
+    applicable = design["applicable"]
+    # inapplicable maps get any other input, which the map leaves unchanged
+    item_in = np.where(applicable, prim_in[design["map"]],
+                       FactorialDesign.draw_other(len(stimuli),
+                                                  prim_in[design["map"]], rng=rng))
+    item_out = np.where(applicable, prim_out[design["map"]], item_in)
+    design["input_disp"] = FactorialDesign.place_items(
+        n, display_size, design["target"], stimuli[item_in], '')
+    design["output_disp"] = FactorialDesign.place_items(
+        n, display_size, design["target"], stimuli[item_out], '')
+    # the correct item is within the len(resp_list) response slots
+    design["resp_options"] = stimuli[FactorialDesign.options_with_correct(
+        len(stimuli), item_out, design["correct_resp"], rng=rng)[:, :len(resp_list)]]
+    design["jitter"] = FactorialDesign.jitter(n, size=(3,), rng=rng)
+
+    trials = FactorialDesign.to_dicts(design, constants={
+        "trial_type": "prim_decoder", "test_type": "position",
+        "map_type": "primitive"})
+    for trial in trials:
+        trial["map"] = [selection_prim[trial["map"]]]
+    # balanced runs, transitions between the decoded maps balanced within
+    labels = {name: design[name] for name in
+              ["map", "target", "correct_resp", "applicable"]}
+    order = partition_runs(trials, labels, sequence=design["map"].tolist(),
+                           rng=rng)
+    yield TrialTable.from_dicts(trials, alphabet=stimuli, sep=sep,
+                                dtypes=FIELD_DTYPES).take(order)
+
+
+def gen_block_auto(rng):
+    ''' 5. Autonomous blocks, shuffled as a whole (see SHUFFLED_BLOCKS)'''
+    # one chunk, the target column mixes stimuli (count) and positions
+    yield [trial for test_type in ["count", "position"]
+           for trial in gen_autonomous_trials(test_type, 60, discriminative=True,
+                                              rng=rng)]
+
+
+# Block name (file suffix) -> generator, the position of a block is part of
+# its random stream, so only append new blocks at the end
+BLOCKS = {
+    "mappinglists": gen_block_mappinglists,
+    "trials_prim_cue": gen_block_prim_cue,
+    "trials_prim_prac_c": partial(gen_block_prim_practice, test_type="count"),
+    "trials_prim_prac_p": partial(gen_block_prim_practice, test_type="position"),
+    "trials_prim": partial(gen_block_generic, spell_type="prim"),
+    "trials_binary": partial(gen_block_generic, spell_type="binary"),
+    "trials_obj_dec": gen_block_obj_dec,
+    "trials_prim_dec": gen_block_prim_dec,
+    "trials_auto": gen_block_auto,
+}
+
+# Settings (module globals) each block reads, a block is rebuilt only if one
+# of them changes, keep in sync with the block generators
+BLOCK_SETTINGS = {
+    "mappinglists": ["mapping_assignment", "cohort_seed"],
+    "trials_prim_cue": ["stimuli", "selection_prim", "maxn_repeats",
+                        "n_exposure_practice"],
+    "trials_prim_prac_c": ["stimuli", "selection_prim", "maxn_repeats",
+                           "n_exposure_practice", "resp_list", "display_size",
+                           "sep"],
+    "trials_prim_prac_p": ["stimuli", "selection_prim", "maxn_repeats",
+                           "n_exposure_practice", "resp_list", "display_size",
+                           "sep"],
+    "trials_prim": ["stimuli", "selection_prim", "maxn_repeats",
+                    "n_exposure_prim", "resp_list", "display_size", "sep",
+                    "run_length", "trial_durations"],
+    "trials_binary": ["stimuli", "selection_binary", "maxn_repeats",
+                      "n_exposure_binary", "resp_list", "display_size", "sep",
+                      "run_length", "trial_durations"],
+    "trials_obj_dec": ["stimuli", "display_size", "n_exposure_loc_quick",
+                       "n_exposure_loc_catch", "run_length", "trial_durations"],
+    "trials_prim_dec": ["stimuli", "selection_prim", "display_size", "sep",
+                        "run_length", "trial_durations"],
+    "trials_auto": ["stimuli", "selection_prim", "display_size", "sep"],
+}
+
+# Blocks whose trials are shuffled as a whole, through n_buckets buckets
+# (on disk while a block is streamed), so that memory stays bounded
+SHUFFLED_BLOCKS = ["trials_auto"]
+n_buckets = 16
+
+# Blocks counterbalanced across the cohort, their generators also get the
+# participant number
+COHORT_BLOCKS = ["mappinglists"]
+
+# Types of integer fields whose values grow from chunk to chunk, the others
+# are as narrow as the values of a block's first chunk allow
+FIELD_DTYPES = {"run": np.int32}
+
+# bump whenever a change of the generator code changes its output, this
+# invalidates all cached and generated blocks
+GENERATOR_VERSION = 11
+
+
+def encode_chunks(chunks, on_chunk=None):
+    ''' chunks as TrialTables, each encoded compatibly with the previous
+        one (other chunks are passed through) and passed to on_chunk if
+        given'''
+    like = None
+    for chunk in chunks:
+        if isinstance(chunk, list):
+            chunk = TrialTable.from_dicts(chunk, alphabet=stimuli, sep=sep,
+                                          like=like, dtypes=FIELD_DTYPES)
+        if isinstance(chunk, TrialTable):
+            like = chunk
+        if on_chunk is not None:
+            on_chunk(chunk)
+        yield chunk
+
+
+def block_chunks(block, rng, participant=None, tmp_dir=None, on_chunk=None):
+    ''' the chunks of a block as consistently encoded TrialTables (or the
+        mapping lists), shuffled if the block is in SHUFFLED_BLOCKS; buckets
+        are kept in tmp_dir if given, the result does not depend on it.
+        on_chunk is called with every chunk as generated (before shuffling)'''
+    if block in COHORT_BLOCKS:
+        chunks = encode_chunks(BLOCKS[block](rng, participant=participant),
+                               on_chunk=on_chunk)
+    else:
+        chunks = encode_chunks(BLOCKS[block](rng), on_chunk=on_chunk)
+    if block in SHUFFLED_BLOCKS:
+        shuffle = BucketShuffle(n_buckets, rng=rng, tmp_dir=tmp_dir)
+        for chunk in chunks:
+            shuffle.add(chunk)
+        chunks = shuffle.tables()
+    return chunks
+
+
+def generate_block(block, rng, participant=None):
+    ''' a whole block in memory, as a TrialTable (or the mapping lists),
+        raises ValueError for designs its generator does not support'''
+    chunks = list(block_chunks(block, rng, participant=participant))
+    if not isinstance(chunks[0], TrialTable):
+        return chunks[0]
+    return TrialTable.concat(chunks)
+
+
+def stream_block(block, rng, path, participant=None, tmp_dir=None,
+                 on_chunk=None):
+    ''' write a block chunk by chunk to the TrialTable directory path (see
+        block_chunks for on_chunk)'''
+    with TrialTableWriter(path) as writer:
+        for chunk in block_chunks(block, rng, participant=participant,
+                                  tmp_dir=tmp_dir, on_chunk=on_chunk):
+            writer.append(chunk)
+    if tmp_dir is not None and os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+
+
+# ============================================================================
+# Participants
+def block_rng(i, block, entropy):
+    ''' independent random generator for a block of participant i, spawned
+        from the root SeedSequence, so that blocks can be (re)generated
+        individually'''
+    block_id = list(BLOCKS).index(block)
+    seed_seq = np.random.SeedSequence(entropy, spawn_key=(i, block_id))
+    return np.random.default_rng(seed_seq)
+
+
+def block_ending(block):
+    return "npz" if block == "mappinglists" else ending
+
+
+def block_fname(i, block, trial_list_dir=trial_list_dir, ending=None):
+    if ending is None:
+        ending = block_ending(block)
+    return f"{trial_list_dir}{os.sep}{str(i).zfill(2)}_{block}.{ending}"
+
+
+def legacy_block_fname(i, block, trial_list_dir=trial_list_dir):
+    ''' pickled block written by earlier versions'''
+    return block_fname(i, block, trial_list_dir=trial_list_dir, ending="pkl")
+
+
+def bundle_fname(i, trial_list_dir=trial_list_dir):
+    return f"{trial_list_dir}{os.sep}{str(i).zfill(2)}_trials.bundle"
+
+
+def open_bundle(i, trial_list_dir=trial_list_dir, preload=False):
+    ''' trial bundle of participant i (None if there is none), preload
+        reads it at once instead of memory-mapping it'''
+    try:
+        return TrialBundle(bundle_fname(i, trial_list_dir), preload=preload)
+    except FileNotFoundError:
+        return None
+
+
+def manifest_fname(i, trial_list_dir=trial_list_dir):
+    return f"{trial_list_dir}{os.sep}{str(i).zfill(2)}_seed.json"
+
+
+def load_manifest(i, trial_list_dir=trial_list_dir):
+    ''' recorded entropy, block keys and content hashes of participant i'''
+    fname = manifest_fname(i, trial_list_dir=trial_list_dir)
+    if not os.path.exists(fname):
+        return {}
+    return load_spec(fname)
+
+
+def load_spec(fname):
+    ''' trial specification (the _seed.json of a participant), from which
+        its blocks can be regenerated'''
+    with open(fname) as f:
+        return json.load(f)
+
+
+def save_manifest(i, manifest, trial_list_dir=trial_list_dir):
+    with open(manifest_fname(i, trial_list_dir=trial_list_dir), "w") as f:
+        json.dump(manifest, f, indent=1)
+
+
+def block_inputs(block):
+    ''' values of everything block depends on, except for the seed'''
+    inputs = {name: globals()[name] for name in BLOCK_SETTINGS[block]}
+    if block == "mappinglists":
+        inputs["cue_lists"] = load_cue_lists()
+    return inputs
+
+
+def block_key(i, block, entropy):
+    ''' hash of the inputs of a block of participant i'''
+    inputs = block_inputs(block)
+    inputs.update(block=block, participant=i, entropy=entropy,
+                  generator_version=GENERATOR_VERSION)
+    key = json.dumps(inputs, sort_keys=True,
+                     default=lambda x: x.tolist() if hasattr(x, "tolist") else str(x))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def default_cache_dir(trial_list_dir):
+    ''' cache directory of the trial lists in trial_list_dir'''
+    return os.path.join(trial_list_dir, ".cache")
+
+
+def block_cache_fname(block, key, cache_dir=cache_dir):
+    return os.path.join(cache_dir, "blocks",
+                        f"{block}_{key[:16]}.{block_ending(block)}")
+
+
+def certificate_fname(fname):
+    ''' balance certificate archived next to a block file'''
+    return f"{os.path.splitext(fname)[0]}.balance.json"
+
+
+def legacy_block_exists(i, block, trial_list_dir=trial_list_dir):
+    ''' whether block was saved as a file of its own by earlier versions'''
+    return os.path.exists(block_fname(i, block, trial_list_dir=trial_list_dir)) \
+        or os.path.exists(legacy_block_fname(i, block, trial_list_dir))
+
+
+def block_status(i, block, key, manifest, trial_list_dir=trial_list_dir,
+                 bundle=None, seed_only=False):
+    ''' "missing", "edited" (changed after generation, see record_block),
+        "stale" (generated from other inputs) or "ok", with seed_only a
+        block is present if its content hash is recorded; blocks without a
+        recorded key (e.g. block files of earlier versions) are kept, their
+        inputs are unknown'''
+    if seed_only:
+        present = block in manifest.get("sha256", {})
+    else:
+        present = (bundle is not None and block in bundle) or \
+            legacy_block_exists(i, block, trial_list_dir)
+    if not present:
+        return "missing"
+    if manifest.get("edited", {}).get(block):
+        return "edited"
+    if manifest.get("blocks", {}).get(block, key) != key:
+        return "stale"
+    return "ok"
+
+
+def build_block(i, block, entropy, key, force=False, cache_dir=cache_dir):
+    ''' generate a block into the block cache unless it was generated from
+        the same inputs before, returns the name of the cached file (test
+        blocks get a balance certificate next to it)'''
+    cache_fname = block_cache_fname(block, key, cache_dir=cache_dir)
+    if force or not os.path.exists(cache_fname):
+        rng = block_rng(i, block, entropy)
+        # write atomically, other processes may read the cache
+        os.makedirs(os.path.dirname(cache_fname), exist_ok=True)
+        tmp_fname = f"{os.path.splitext(cache_fname)[0]}.{os.getpid()}.tmp"
+        certificate = {}
+        if block_ending(block) == "trials":
+            # the certificate is tallied chunk by chunk
+            chunk_tallies = []
+            stream_block(block, rng, f"{tmp_fname}.trials", participant=i,
+                         tmp_dir=f"{tmp_fname}.buckets",
+                         on_chunk=lambda chunk: chunk_tallies.append(
+                             TrialAllocation.tally(chunk)))
+            certificate = TrialAllocation.balance_certificate(chunk_tallies)
+        else:
+            trials = generate_block(block, rng, participant=i)
+            save_object(trials, tmp_fname, ending=block_ending(block))
+        if certificate:
+            with open(f"{tmp_fname}.json", "w") as f:
+                json.dump(certificate, f, indent=1)
+            os.replace(f"{tmp_fname}.json", certificate_fname(cache_fname))
+        remove_block(cache_fname)
+        os.replace(f"{tmp_fname}.{block_ending(block)}", cache_fname)
+    return cache_fname
+
+
+def remove_block(fname):
+    if os.path.isdir(fname):
+        shutil.rmtree(fname)
+    elif os.path.exists(fname):
+        os.remove(fname)
+
+
+def read_block_file(fname, mmap_mode='r'):
+    ''' block saved as a TrialTable directory, .npz or pickle (legacy)'''
+    if os.path.isdir(fname):
+        return TrialTable.load(fname, mmap_mode=mmap_mode)
+    if fname.endswith(".npz"):
+        with np.load(fname, allow_pickle=False) as f:
+            return {key: f[key] for key in f.files}
+    with open(fname, "rb") as f:
+        return pickle.load(f)
+
+
+def load_legacy_block(i, block, trial_list_dir=trial_list_dir, mmap_mode='r'):
+    ''' block saved as a file of its own by earlier versions'''
+    fname = block_fname(i, block, trial_list_dir=trial_list_dir)
+    if not os.path.exists(fname):
+        fname = legacy_block_fname(i, block, trial_list_dir)
+    return read_block_file(fname, mmap_mode=mmap_mode)
+
+
+def load_block(i, block, trial_list_dir=trial_list_dir, bundle=None):
+    ''' trial list (list of TrialTable rows) or mapping lists (dict) of
+        participant i from its bundle (opened unless given), falls back to
+        the block files of earlier versions and then to regenerating the
+        block from the trial specification'''
+    if bundle is None:
+        bundle = open_bundle(i, trial_list_dir=trial_list_dir)
+    if bundle is not None and block in bundle:
+        return bundle[block]
+    spec = load_manifest(i, trial_list_dir=trial_list_dir)
+    if not legacy_block_exists(i, block, trial_list_dir) and \
+            block in spec.get("sha256", {}):
+        return as_trial_list(regenerate_block(spec, block))
+    return as_trial_list(load_legacy_block(i, block, trial_list_dir))
+
+
+def regenerate_block(spec, block):
+    ''' block (TrialTable or dict of arrays) of the participant described by
+        spec, regenerated from its seed and checked against the recorded
+        content hash, raises ValueError if it cannot be reproduced with the
+        current generator and settings'''
+    if block not in spec.get("sha256", {}):
+        raise ValueError(f"No content hash recorded for block '{block}'")
+    version = spec.get("versions", {}).get(block, GENERATOR_VERSION)
+    if version != GENERATOR_VERSION:
+        raise ValueError(f"Block '{block}' was generated by generator version "
+                         f"{version}, this is version {GENERATOR_VERSION}")
+    i, entropy = spec["participant"], spec["entropy"]
+    if spec["blocks"][block] != block_key(i, block, entropy):
+        raise ValueError(f"Block '{block}' was generated with other settings")
+    trials = generate_block(block, block_rng(i, block, entropy), participant=i)
+    if block_digest(trials) != spec["sha256"][block]:
+        raise ValueError(f"Regenerated block '{block}' does not match its "
+                         "content hash")
+    return trials
+
+
+def regenerate_participant(spec, blocks=None):
+    ''' all (or the given) blocks recorded in spec as trial lists, e.g. to
+        reconstruct the presented trials for analysis'''
+    blocks = list(spec.get("sha256", {})) if blocks is None else blocks
+    return {block: as_trial_list(regenerate_block(spec, block))
+            for block in blocks}
+
+
+def record_block(manifest, block, key, digest, force=False):
+    ''' record key and content hash of a generated block, raises ValueError
+        if a block generated from the same inputs before had other contents,
+        unless the block was marked as edited ("edited" entry of the
+        specification, e.g. by a script that changed the block afterwards)
+        or force is set; the regenerated block replaces the edited one'''
+    edited = manifest.get("edited", {})
+    if manifest["blocks"].get(block) == key and \
+            manifest["sha256"].get(block, digest) != digest and \
+            not (force or edited.get(block)):
+        raise ValueError(f"Block '{block}' of participant "
+                         f"{manifest['participant']} does not match its "
+                         "recorded content hash (use --force to replace it)")
+    manifest["blocks"][block] = key
+    manifest["sha256"][block] = digest
+    manifest["versions"][block] = GENERATOR_VERSION
+    edited.pop(block, None)
+
+
+def bundle_contents(i, block, trial_list_dir=trial_list_dir, bundle=None):
+    ''' block as it is stored in a bundle (TrialTable or dict of arrays)
+        and its bundle entries, None if it cannot be bundled'''
+    if bundle is not None and block in bundle:
+        info = {key: value for key, value in bundle.info(block).items()
+                if key in ["key", "certificate"]}
+        return bundle.block(block), info
+    if not legacy_block_exists(i, block, trial_list_dir):
+        return None
+    contents = load_legacy_block(i, block, trial_list_dir, mmap_mode=None)
+    if isinstance(contents, list):
+        # pickled lists keep their float64 jitters
+        dtypes = {name: np.float64 for name, value in contents[0].items()
+                  if np.asarray(value).dtype.kind == "f"} if contents else {}
+        try:
+            contents = TrialTable.from_dicts(contents, alphabet=stimuli, sep=sep,
+                                             dtypes=dtypes)
+        except ValueError:
+            return None
+    return contents, {}
+
+
+def generate_participant(i, entropy=None, trial_list_dir=trial_list_dir,
+                         blocks=None, only_missing=False, force=False,
+                         cache_dir=None, seed_only=False, log=None,
+                         bundle=None):
+    ''' generate the missing or stale trial lists of participant i and save
+        all lists in its bundle, returns the names of the generated and of
+        the skipped blocks; blocks are built in cache_dir (by default the
+        .cache of trial_list_dir), edited blocks are only regenerated with
+        force; block files of earlier versions are kept as they are and
+        moved into the bundle
+
+        the root entropy of a participant is recorded on first generation
+        (fresh if None) and reused afterwards, unless entropy is given;
+        together with the key and content hash of each block it forms the
+        trial specification (_seed.json), with seed_only only that is saved
+        and blocks are regenerated from it when they are loaded; progress is
+        reported to log (e.g. print) if given. bundle is the participant's
+        bundle if the caller has read it already (with preload, the file
+        may be replaced)'''
+    os.makedirs(trial_list_dir, exist_ok=True)
+    if cache_dir is None:
+        cache_dir = default_cache_dir(trial_list_dir)
+    blocks = list(BLOCKS) if blocks is None else blocks
+    manifest = load_manifest(i, trial_list_dir=trial_list_dir)
+    if entropy is None:
+        entropy = manifest.get("entropy", np.random.SeedSequence().entropy)
+    if manifest.get("entropy") != entropy:
+        manifest = {"entropy": entropy}
+    manifest.update(format="trial-spec", participant=i)
+    for entry in ["blocks", "sha256", "versions"]:
+        manifest.setdefault(entry, {})
+    # read at once, the bundle is replaced below
+    if bundle is None:
+        bundle = open_bundle(i, trial_list_dir=trial_list_dir, preload=True)
+
+    todo_status = ["missing"] if only_missing else ["missing", "stale"]
+    keys = {block: block_key(i, block, entropy) for block in blocks}
+    todo = [block for block in blocks if force or block_status(
+        i, block, keys[block], manifest, trial_list_dir, bundle=bundle,
+        seed_only=seed_only) in todo_status]
+    skipped = [block for block in blocks if block not in todo]
+    # block files of earlier versions that are kept move into the bundle
+    legacy = [block for block in BLOCKS if block not in todo and
+              (bundle is None or block not in bundle) and
+              legacy_block_exists(i, block, trial_list_dir)]
+    if not (todo or legacy):
+        return todo, skipped
+
+    if todo and log is not None:
+        log(f"Generating trial lists for participant {i}...")
+    if not save_this:
+        for block in todo:
+            for _ in block_chunks(block, block_rng(i, block, entropy),
+                                  participant=i):
+                pass
+        return todo, skipped
+    contents, info = {}, {}
+    for block in BLOCKS:
+        if block in todo:
+            cache_fname = build_block(i, block, entropy, keys[block],
+                                      force=force, cache_dir=cache_dir)
+            # memory-mapped, the bundle is written piece by piece
+            trials = read_block_file(cache_fname)
+            record_block(manifest, block, keys[block], block_digest(trials),
+                         force=force)
+            if seed_only:
+                continue
+            contents[block] = trials
+            info[block] = {"key": keys[block]}
+            if os.path.exists(certificate_fname(cache_fname)):
+                with open(certificate_fname(cache_fname)) as f:
+                    info[block]["certificate"] = json.load(f)
+        else:
+            kept = bundle_contents(i, block, trial_list_dir, bundle=bundle)
+            if kept is not None:
+                contents[block], info[block] = kept
+                if block in manifest["blocks"]:
+                    manifest["sha256"].setdefault(block, block_digest(kept[0]))
+    # with seed_only, regenerated blocks are dropped from an existing bundle
+    if contents:
+        write_bundle(bundle_fname(i, trial_list_dir), contents, info=info,
+                     meta={"participant": i, "entropy": entropy})
+    else:
+        remove_block(bundle_fname(i, trial_list_dir))
+    # block files of earlier versions are replaced once they are bundled,
+    # those of regenerated blocks are left alone
+    for block in legacy:
+        if block not in contents:
+            continue
+        remove_block(block_fname(i, block, trial_list_dir=trial_list_dir))
+        remove_block(legacy_block_fname(i, block, trial_list_dir))
+        remove_block(certificate_fname(block_fname(
+            i, block, trial_list_dir=trial_list_dir)))
+    save_manifest(i, manifest, trial_list_dir=trial_list_dir)
+    return todo, skipped
+
+
+def prune_cache(trial_list_dir=trial_list_dir, cache_dir=None):
+    ''' remove the cached blocks (and certificates) that no trial
+        specification in trial_list_dir refers to, returns their file names;
+        files other processes are writing are left alone'''
+    if cache_dir is None:
+        cache_dir = default_cache_dir(trial_list_dir)
+    referenced = set()
+    for fname in glob.glob(os.path.join(trial_list_dir, "*_seed.json")):
+        for block, key in load_spec(fname).get("blocks", {}).items():
+            referenced.add(os.path.splitext(
+                block_cache_fname(block, key, cache_dir=cache_dir))[0])
+    removed = []
+    for fname in sorted(glob.glob(os.path.join(cache_dir, "blocks", "*"))):
+        if ".tmp" in os.path.basename(fname):
+            continue
+        stem = fname[:-len(".balance.json")] if fname.endswith(".balance.json") \
+            else os.path.splitext(fname)[0]
+        if stem not in referenced:
+            remove_block(fname)
+            removed.append(fname)
+    return removed
+
+
+def verify_participant(i, trial_list_dir=trial_list_dir):
+    ''' blocks of participant i that fail their checksum or do not match
+        the content hash of the trial specification, blocks that are not in
+        the bundle are regenerated from the specification (raises
+        FileNotFoundError if there is neither)'''
+    spec = load_manifest(i, trial_list_dir=trial_list_dir)
+    bundle = open_bundle(i, trial_list_dir=trial_list_dir)
+    if bundle is None and not spec:
+        raise FileNotFoundError(bundle_fname(i, trial_list_dir))
+    corrupted = [] if bundle is None else bundle.verify()
+    for block, digest in spec.get("sha256", {}).items():
+        if block in corrupted:
+            continue
+        if bundle is not None and block in bundle:
+            if block_digest(bundle.block(block)) != digest:
+                corrupted.append(block)
+            continue
+        try:
+            regenerate_block(spec, block)
+        except ValueError:
+            corrupted.append(block)
+    return corrupted
+
+
+def generate_participants(participants, entropy=None, n_workers=1,
+                          settings=None, **kwargs):
+    ''' generate trial lists for several participants, optionally in
+        parallel worker processes (results do not depend on n_workers),
+        returns a report {participant: (generated, skipped)}; settings
+        (see configure) are set in the worker processes as well'''
+    # prebuild the display index, so that workers only read the cache
+    for general_map in selection_prim + selection_binary:
+        display_index.entry(general_map)
+    worker = partial(generate_participant, entropy=entropy, **kwargs)
+    if n_workers > 1:
+        with ProcessPoolExecutor(
+                max_workers=n_workers,
+                initializer=None if settings is None else configure,
+                initargs=() if settings is None else (settings,)) as executor:
+            reports = list(executor.map(worker, participants))
+    else:
+        reports = [worker(i) for i in participants]
+    return dict(zip(participants, reports))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Generate the trial lists of the compositional inference "
+                    "experiment. Only missing or stale blocks are generated.")
+    parser.add_argument("participants", nargs="*", type=int,
+                        help="participant numbers (default: first_participant "
+                             "to first_participant + n_participants - 1)")
+    parser.add_argument("--blocks", nargs="+", choices=list(BLOCKS),
+                        help="only consider these blocks")
+    parser.add_argument("--force", action="store_true",
+                        help="also regenerate up-to-date blocks")
+    parser.add_argument("--only-missing", action="store_true",
+                        help="do not regenerate stale blocks")
+    parser.add_argument("--seed", type=int, default=seed,
+                        help="root seed for newly generated participants")
+    parser.add_argument("--workers", type=int, default=n_workers,
+                        help="number of participants generated in parallel")
+    parser.add_argument("--dir", default=trial_list_dir,
+                        help="output directory")
+    parser.add_argument("--seed-only", action="store_true",
+                        help="only save the trial specifications (seeds and "
+                             "content hashes), blocks are regenerated on load")
+    parser.add_argument("--verify", action="store_true",
+                        help="only check the bundles against their checksums "
+                             "and the trial specifications")
+    parser.add_argument("--config",
+                        help="TOML or JSON file overriding the user settings "
+                             "(see GenerationConfig)")
+    args = parser.parse_args(argv)
+
+    settings = None
+    if args.config:
+        # with the drawn map selections, for the worker processes
+        settings = load_config(args.config)
+    if os.path.abspath(args.dir) != os.path.abspath(trial_list_dir):
+        # the display index is cached next to the trial lists as well
+        settings = dict(settings or {}, cache_dir=default_cache_dir(args.dir))
+        configure({"cache_dir": settings["cache_dir"]})
+
+    participants = args.participants or list(
+        range(first_participant, first_participant+n_participants))
+    if args.verify:
+        failed = False
+        for i in participants:
+            try:
+                corrupted = verify_participant(i, trial_list_dir=args.dir)
+            except (OSError, ValueError) as error:
+                corrupted = [str(error)]
+            failed = failed or bool(corrupted)
+            print(f"Participant {str(i).zfill(2)}: "
+                  + (f"FAILED ({', '.join(corrupted)})" if corrupted else "ok"))
+        raise SystemExit(1 if failed else 0)
+    entropy = None if args.seed is None else np.random.SeedSequence(args.seed).entropy
+    print("Primitives:", selection_prim)
+    print("Binaries:", selection_binary)
+    report = generate_participants(participants, entropy=entropy,
+                                   n_workers=args.workers,
+                                   trial_list_dir=args.dir,
+                                   blocks=args.blocks,
+                                   only_missing=args.only_missing,
+                                   force=args.force,
+                                   seed_only=args.seed_only,
+                                   settings=settings, log=print)
+    for i, (generated, skipped) in report.items():
+        print(f"Participant {str(i).zfill(2)}: generated {len(generated)}, "
+              f"skipped {len(skipped)} up-to-date block(s)"
+              + (f" ({', '.join(skipped)})" if skipped else ""))
+    removed = prune_cache(trial_list_dir=args.dir)
+    if removed:
+        print(f"Removed {len(removed)} unused file(s) from the block cache")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the trial list generation: the hot paths of GenerateTrialLists
+and the generation of a whole participant, timed over a grid of design
+parameters (n_stim, display_size, n_primitives, n_exposure) to get scaling
+curves. Results are saved as JSON with the machine and commit they were
+measured on; compare two result files to flag regressions.
+
+    python GenerationBenchmarks.py run --n-stim 4 5 6 --display-size 4 5
+    python GenerationBenchmarks.py compare old.json new.json
+"""
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from itertools import product
+import numpy as np
+import SpellEngine
+import GenerateTrialLists as G
+
+# ==============================================================================
+# Settings
+n_repeats = 5  # timed runs per benchmark and parameter set, after a warm-up
+threshold = 0.2  # relative slow-down that counts as a regression
+results_dir = os.path.join(G.main_dir, "benchmark-results")
+# study design, exposures of the other blocks scale with n_exposure
+defaults = {"n_stim": G.n_stim, "display_size": G.display_size,
+            "n_primitives": G.n_primitives, "n_exposure": G.n_exposure_prim}
+
+
+# =============================================================================
+# Design parameters
+@contextmanager
+def design(n_stim, display_size, n_primitives, n_exposure, seed=0):
+    ''' configure GenerateTrialLists for a design (see GenerationConfig)
+        for the duration of the context; maps are selected anew (from seed)
+        unless the study's selection fits the design'''
+    base = G.current_config()
+    scale = n_exposure / base.n_exposure_prim
+    config = base.replace(
+        n_stim=n_stim, display_size=display_size, n_primitives=n_primitives,
+        n_exposure_prim=n_exposure,
+        n_exposure_binary=max(round(base.n_exposure_binary * scale), 1),
+        n_exposure_practice=max(round(base.n_exposure_practice * scale), 1),
+        n_exposure_loc=base.n_exposure_loc * scale,
+        map_seed=seed)
+    with G.configured(config.settings(), map_seed=config.map_seed):
+        yield
+
+
+# =============================================================================
+# Benchmarks
+# name -> setup function, called inside the design context, that returns
+# the timed function and the number of calls it makes
+def bench_apply_tables(rng):
+    tables = SpellEngine.composition_tables(G.selection_binary[0], G.stimuli,
+                                           sep=G.sep)
+    displays = rng.choice(len(G.stimuli), size=(1000, G.display_size))
+
+    def run():
+        SpellEngine.apply_tables(displays, tables)
+    return run, 1
+
+
+def bench_gen_trials(rng):
+    map_list = G.get_map_list(G.selection_prim, n_repeats=G.n_exposure_prim,
+                              allow_repeats=True, rng=rng)
+
+    def run():
+        for test_type in ["count", "position"]:
+            G.gen_trials(G.stimuli, map_list, resp_list=G.resp_list,
+                         test_type=test_type, display_size=G.display_size,
+                         sep=G.sep, index=G.display_index, rng=rng)
+    return run, 1
+
+
+def bench_get_map_list(rng):
+    def run():
+        G.get_map_list(G.selection_prim, n_repeats=G.n_exposure_practice*2,
+                       allow_repeats=False, rng=rng)
+    return run, 1
+
+
+def bench_gen_binary_compositions(rng):
+    unique_prim = G.cartesian_product(G.stimuli, sep=G.sep)
+
+    def run():
+        G.gen_binary_compositions(unique_prim, n_primitives=G.n_primitives,
+                                  min_type=G.min_type, sep=G.sep, rng=rng)
+    return run, 1
+
+
+def bench_select_binary_compositions(rng):
+    _, comps = G.gen_binary_compositions(
+        G.cartesian_product(G.stimuli, sep=G.sep), n_primitives=G.n_primitives,
+        min_type=G.min_type, sep=G.sep, rng=rng)
+
+    def run():
+        G.select_binary_compositions(comps)
+    return run, 1
+
+
+def bench_gen_autonomous_trials(rng):
+    def run():
+        for test_type in ["count", "position"]:
+            G.gen_autonomous_trials(test_type, 60, discriminative=True, rng=rng)
+    return run, 1
+
+
+def bench_participant(rng):
+    entropy = int(rng.integers(2**32))
+
+    def run():
+        for block in G.BLOCKS:
+            G.generate_block(block, G.block_rng(1, block, entropy), participant=1)
+    return run, 1
+
+
+BENCHMARKS = {
+    "apply_tables": bench_apply_tables,
+    "gen_trials": bench_gen_trials,
+    "get_map_list": bench_get_map_list,
+    "gen_binary_compositions": bench_gen_binary_compositions,
+    "select_binary_compositions": bench_select_binary_compositions,
+    "gen_autonomous_trials": bench_gen_autonomous_trials,
+    "participant": bench_participant,
+}
+
+
+def time_benchmark(name, n_repeats=n_repeats, seed=0):
+    ''' seconds per call of each timed run (after one warm-up run, which
+        fills the lazily built caches)'''
+    rng = np.random.default_rng(seed)
+    run, n_calls = BENCHMARKS[name](rng)
+    run()
+    times = []
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        run()
+        times.append((time.perf_counter() - start) / n_calls)
+    return times
+
+
+def run_benchmarks(grid, names=None, n_repeats=n_repeats, log=print):
+    ''' time the benchmarks (all by default) for every parameter set of the
+        grid (dict parameter -> values), returns the list of results'''
+    names = list(BENCHMARKS) if names is None else names
+    results = []
+    for values in product(*grid.values()):
+        params = dict(zip(grid, (int(v) for v in values)))
+        try:
+            with design(**params):
+                for name in names:
+                    try:
+                        times = time_benchmark(name, n_repeats=n_repeats)
+                        result = {"min": min(times),
+                                  "median": float(np.median(times)),
+                                  "times": times}
+                    except ValueError as error:
+                        # designs the generators do not support
+                        result = {"error": str(error)}
+                    results.append(dict(benchmark=name, params=params, **result))
+                    log(format_result(results[-1]))
+        except ValueError as error:
+            # no maps can be selected for this design
+            for name in names:
+                results.append({"benchmark": name, "params": params,
+                                "error": str(error)})
+                log(format_result(results[-1]))
+    return results
+
+
+# =============================================================================
+# Results
+def git_commit():
+    ''' current commit (with a "-dirty" suffix for local changes), None
+        outside of a git checkout'''
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=G.main_dir,
+                                capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--", "."],
+                               cwd=G.main_dir, capture_output=True, text=True,
+                               check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+
+def metadata():
+    return {"date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "machine": {"node": platform.node(),
+                        "platform": platform.platform(),
+                        "processor": platform.processor() or platform.machine(),
+                        "cpu_count": os.cpu_count(),
+                        "python": platform.python_version(),
+                        "numpy": np.__version__}}
+
+
+def params_label(params):
+    return " ".join(f"{name}={value}" for name, value in params.items())
+
+
+def format_result(result):
+    name = f"{result['benchmark']:<28} {params_label(result['params'])}"
+    if "error" in result:
+        return f"{name}  failed: {result['error']}"
+    return f"{name}  {result['min']*1000:10.3f} ms (median " \
+           f"{result['median']*1000:.3f} ms)"
+
+
+def compare(old, new, threshold=threshold):
+    ''' relative change of the fastest run of every benchmark and parameter
+        set measured in both result files, returns (benchmark, params,
+        ratio new/old, flag) rows, flag is "regression" above 1 + threshold
+        and "faster" below 1 - threshold'''
+    def index(results):
+        return {(r["benchmark"], json.dumps(r["params"], sort_keys=True)): r
+                for r in results["results"] if "error" not in r}
+    old_index, new_index = index(old), index(new)
+    rows = []
+    for key, result in new_index.items():
+        if key not in old_index:
+            continue
+        ratio = result["min"] / old_index[key]["min"]
+        flag = "regression" if ratio > 1 + threshold else \
+            "faster" if ratio < 1 - threshold else ""
+        rows.append((result["benchmark"], result["params"], ratio, flag))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the trial list generation.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="run benchmarks and save the results")
+    for name, value in defaults.items():
+        run.add_argument(f"--{name.replace('_', '-')}", nargs="+", type=int,
+                         default=[value], help=f"values of {name} (default "
+                                               f"{value})")
+    run.add_argument("--benchmarks", nargs="+", choices=list(BENCHMARKS),
+                     help="only run these benchmarks")
+    run.add_argument("--repeats", type=int, default=n_repeats,
+                     help="timed runs per benchmark")
+    run.add_argument("--output", help="result file (default: "
+                                      "benchmark-results/<date>_<commit>.json)")
+    comp = commands.add_parser("compare", help="flag regressions between runs")
+    comp.add_argument("old")
+    comp.add_argument("new")
+    comp.add_argument("--threshold", type=float, default=threshold,
+                      help="relative slow-down flagged as a regression")
+    args = parser.parse_args(argv)
+
+    if args.command == "compare":
+        with open(args.old) as f:
+            old = json.load(f)
+        with open(args.new) as f:
+            new = json.load(f)
+        rows = compare(old, new, threshold=args.threshold)
+        for benchmark, params, ratio, flag in rows:
+            print(f"{benchmark:<28} {params_label(params)}  {ratio:6.2f}x  {flag}")
+        n_regressions = sum(flag == "regression" for *_, flag in rows)
+        print(f"{len(rows)} benchmark(s) compared, {n_regressions} regression(s)")
+        raise SystemExit(1 if n_regressions else 0)
+
+    grid = {name: getattr(args, name) for name in defaults}
+    meta = metadata()
+    results = run_benchmarks(grid, names=args.benchmarks, n_repeats=args.repeats)
+    fname = args.output
+    if fname is None:
+        stamp = meta["date"][:19].replace(":", "").replace("-", "")
+        fname = os.path.join(results_dir,
+                             f"{stamp}_{(meta['commit'] or 'nocommit')[:8]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+    with open(fname, "w") as f:
+        json.dump({"meta": dict(meta, argv=sys.argv[1:] if argv is None else argv,
+                                grid=grid, n_repeats=args.repeats),
+                   "results": results}, f, indent=1)
+    print(f"Saved {fname}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Typed configuration of the trial list generation: the user settings of
+GenerateTrialLists as a dataclass, checked on creation and loadable from TOML
+or JSON files that override some of them, e.g.
+
+    n_stim = 5
+    display_size = 5
+    n_exposure_prim = 20
+    trial_durations = {generic = 6.0}
+
+Apply a configuration with GenerateTrialLists.configured(config.settings()),
+or pass the file to `GenerateTrialLists.py --config`.
+"""
+import os
+import json
+import dataclasses
+from dataclasses import dataclass
+from typing import Dict, List, Optional, get_type_hints
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    tomllib = None
+
+# designs with fewer stimuli have no parallelizable compositions
+MIN_STIMULI = 4
+MAPPING_ASSIGNMENTS = ["latin-square", "random"]
+
+
+@dataclass
+class GenerationConfig:
+    ''' design parameters the block generators read (see the user settings
+        of GenerateTrialLists), map selections of None are drawn anew from
+        map_seed'''
+    n_stim: int
+    display_size: int
+    n_primitives: int
+    n_exposure_prim: int
+    n_exposure_binary: int
+    n_exposure_practice: int
+    maxn_repeats: int
+    n_exposure_loc: float
+    percentage_catch: float
+    resp_list: List[int]
+    sep: str
+    run_length: float
+    trial_durations: Dict[str, float]
+    mapping_assignment: str
+    cohort_seed: int
+    selection_prim: Optional[List[str]] = None
+    selection_binary: Optional[List[List[str]]] = None
+    map_seed: int = 0
+
+    def __post_init__(self):
+        for name, hint in get_type_hints(type(self)).items():
+            setattr(self, name, check_type(name, getattr(self, name), hint))
+        if self.n_stim < MIN_STIMULI:
+            raise ValueError(f"n_stim must be at least {MIN_STIMULI}")
+        for name in ["display_size", "n_primitives", "maxn_repeats"]:
+            if getattr(self, name) < 1:
+                raise ValueError(f"{name} must be positive")
+        if not 0 <= self.percentage_catch <= 1:
+            raise ValueError("percentage_catch must be between 0 and 1")
+        if self.mapping_assignment not in MAPPING_ASSIGNMENTS:
+            raise ValueError(f"mapping_assignment must be one of "
+                             f"{MAPPING_ASSIGNMENTS}")
+        if not self.selection_fits():
+            raise ValueError("selection_prim does not fit n_stim and "
+                             "n_primitives")
+        if self.selection_binary is not None and (
+                self.selection_prim is None or any(
+                    prim not in self.selection_prim
+                    for binary in self.selection_binary for prim in binary)):
+            raise ValueError("selection_binary must be composed of the maps "
+                             "in selection_prim")
+
+    @classmethod
+    def names(cls):
+        return [field.name for field in dataclasses.fields(cls)]
+
+    @classmethod
+    def from_dict(cls, values, base=None):
+        ''' configuration from values (dict name -> value), the others taken
+            from base (configuration or dict), tables (trial_durations) update
+            those of base; selections of base that no longer fit the design
+            are drawn anew, binary maps are selected anew from given
+            primitives unless given as well'''
+        unknown = set(values) - set(cls.names())
+        if unknown:
+            raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+        if isinstance(base, GenerationConfig):
+            base = base.to_dict()
+        merged = dict(base or {}, **values)
+        for name, value in values.items():
+            if isinstance(value, dict) and isinstance((base or {}).get(name), dict):
+                merged[name] = dict(base[name], **value)
+        if "selection_prim" in values and "selection_binary" not in values:
+            merged["selection_binary"] = None
+        if "selection_prim" in values or merged.get("selection_prim") is None:
+            return cls(**merged)
+        config = cls(**dict(merged, selection_prim=None, selection_binary=None))
+        if selection_fits(merged["selection_prim"], config.n_stim,
+                          config.n_primitives, config.sep):
+            config = cls(**merged)
+        return config
+
+    @classmethod
+    def load(cls, fname, base=None):
+        ''' configuration from a TOML or JSON file (overriding base)'''
+        if os.path.splitext(fname)[1] == ".toml":
+            if tomllib is None:
+                raise ImportError("Reading TOML needs Python 3.11 (tomllib), "
+                                  "use a JSON file instead")
+            with open(fname, "rb") as f:
+                values = tomllib.load(f)
+        else:
+            with open(fname) as f:
+                values = json.load(f)
+        return cls.from_dict(values, base=base)
+
+    def to_dict(self):
+        return dataclasses.asdict(self)
+
+    def save(self, fname):
+        with open(fname, "w") as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def replace(self, **values):
+        ''' copy with some values changed, see from_dict'''
+        return GenerationConfig.from_dict(values, base=self)
+
+    def selection_fits(self):
+        return self.selection_prim is None or selection_fits(
+            self.selection_prim, self.n_stim, self.n_primitives, self.sep)
+
+    def settings(self):
+        ''' module settings of GenerateTrialLists (see configure), None
+            selections are drawn anew there'''
+        settings = self.to_dict()
+        settings.pop("map_seed")
+        return settings
+
+
+def selection_fits(selection_prim, n_stim, n_primitives, sep):
+    ''' whether there are n_primitives primitive maps, which only use the
+        first n_stim stimuli'''
+    stimuli = [chr(65 + k) for k in range(n_stim)]
+    return len(selection_prim) == n_primitives and all(
+        item in stimuli for prim in selection_prim for item in prim.split(sep))
+
+
+def check_type(name, value, hint):
+    ''' value checked against a type hint (int, float, str, List, Dict,
+        Optional), ints are accepted as floats and arrays as lists'''
+    origin = getattr(hint, "__origin__", None)
+    args = getattr(hint, "__args__", ())
+    if origin is not None and type(None) in args:
+        if value is None:
+            return None
+        return check_type(name, value, [a for a in args if a is not type(None)][0])
+    if origin is list:
+        if hasattr(value, "tolist"):
+            value = value.tolist()
+        if not isinstance(value, (list, tuple)):
+            raise TypeError(f"{name} must be a list, not {type(value).__name__}")
+        return [check_type(name, item, args[0]) for item in value]
+    if origin is dict:
+        if not isinstance(value, dict):
+            raise TypeError(f"{name} must be a table, not {type(value).__name__}")
+        return {check_type(name, k, args[0]): check_type(name, v, args[1])
+                for k, v in value.items()}
+    if hint is float and isinstance(value, (int, float)) and not isinstance(value, bool):
+        # kept as given, the block keys hash the JSON of the settings
+        return value
+    if hint is int and hasattr(value, "dtype") and value.dtype.kind in "iu":
+        return int(value)
+    if not isinstance(value, hint) or (hint is int and isinstance(value, bool)):
+        raise TypeError(f"{name} must be {hint.__name__}, not "
+                        f"{type(value).__name__}")
+    return value
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Design exploration: generate all blocks for every configuration of a grid of
+GenerationConfig values, in a process pool, and collect the list sizes,
+generation time, peak memory and design diagnostics (balance spreads,
+transitions, runs, validation) into one table.
+
+    python ParameterSweep.py --grid n_stim=4,5 display_size=4,5
+    python ParameterSweep.py --config base.toml --grid n_exposure_prim=10,20,30 \
+        --participants 3 --output sweep.csv
+
+Grid values are JSON (strings without quotes are fine), the other settings
+come from --config or the user settings of GenerateTrialLists.
+"""
+import os
+import csv
+import json
+import time
+import argparse
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+import numpy as np
+import GenerateTrialLists as G
+from GenerationConfig import GenerationConfig
+from TrialTable import TrialTable
+import TrialValidation
+import TrialDiagnostics
+
+# ==============================================================================
+# Settings
+n_participants = 1  # participants generated per configuration
+n_workers = os.cpu_count() or 1
+# columns printed by the command line, all are saved
+summary_columns = ["n_trials", "time_s", "peak_mb", "map_spread",
+                   "correct_resp_spread", "target_spread", "transition_spread",
+                   "n_runs", "violations", "error"]
+
+
+# =============================================================================
+# Grid
+def parse_values(text):
+    ''' grid values of "v1,v2,...": JSON values, or strings'''
+    try:
+        return json.loads(f"[{text}]")
+    except json.JSONDecodeError:
+        return text.split(",")
+
+
+def parse_grid(items):
+    ''' {name: values} from "name=v1,v2,..." items'''
+    grid = {}
+    for item in items:
+        name, sep, text = item.partition("=")
+        if not sep:
+            raise ValueError(f"Grid item '{item}' is not name=values")
+        grid[name] = parse_values(text)
+    return grid
+
+
+def grid_configs(base, grid):
+    ''' (params, configuration or error message) for every combination of
+        the grid values'''
+    configs = []
+    for values in product(*grid.values()):
+        params = dict(zip(grid, values))
+        try:
+            configs.append((params, base.replace(**params)))
+        except (TypeError, ValueError) as error:
+            configs.append((params, str(error)))
+    return configs
+
+
+# =============================================================================
+# Evaluation
+def spread(counts):
+    ''' max - min of value counts, trials without a value (None) aside'''
+    counts = [n for value, n in counts.items() if value != "None"]
+    return max(counts) - min(counts) if counts else 0
+
+
+def block_diagnostics(table, block, alphabet):
+    ''' balance spreads (per test type), transitions (between different
+        maps or stimuli), runs and validation of a block'''
+    summary = TrialDiagnostics.summarize_table(table, alphabet)
+    row = {name + "_spread": max(spread(group.get(name, {}))
+                                 for group in summary["groups"].values())
+           for name in ["map", "correct_resp", "target"]}
+    if "transitions" in summary:
+        counts = np.array(summary["transitions"]["counts"])
+        if len(counts) > 1:
+            counts = counts[~np.eye(len(counts), dtype=bool)]
+        row["transition_spread"] = int(counts.max() - counts.min())
+    if "run" in table.columns:
+        row["n_runs"] = int(np.max(table.data["run"])) + 1
+    violations = TrialValidation.validate_table(
+        table, block, alphabet, auto_maps=G.selection_prim)
+    row["violations"] = sum(len(rows) for rows in violations.values())
+    return row
+
+
+def generate(participants, entropy):
+    ''' all trial blocks of the participants, yields (block, table)'''
+    for i in participants:
+        for block in G.BLOCKS:
+            trials = G.generate_block(block, G.block_rng(i, block, entropy),
+                                      participant=i)
+            if isinstance(trials, TrialTable):
+                yield block, trials
+
+
+def evaluate(config, n_participants=n_participants, seed=0):
+    ''' list sizes (per participant), generation time (s per participant),
+        peak memory (MB, generating the first participant) and design
+        diagnostics under config, per block and over all blocks: spreads are
+        the worst over participants (and blocks), runs and violations are
+        per participant (and summed over blocks)'''
+    row = {}
+    entropy = np.random.SeedSequence(seed).entropy
+    participants = range(1, n_participants + 1)
+    try:
+        with G.configured(config.settings(), map_seed=config.map_seed):
+            alphabet = G.stimuli.tolist()
+            start = time.perf_counter()
+            tables = list(generate(participants, entropy))
+            row["time_s"] = (time.perf_counter() - start) / n_participants
+            for block, table in tables:
+                key = f"{block}.n_trials"
+                row[key] = row.get(key, 0) + len(table) / n_participants
+                for name, value in block_diagnostics(table, block, alphabet).items():
+                    key = f"{block}.{name}"
+                    if name in ["n_runs", "violations"]:
+                        value = value / n_participants
+                        row[key] = row.get(key, 0) + value
+                        row[name] = row.get(name, 0) + value
+                    else:
+                        row[key] = max(row.get(key, 0), value)
+                        row[name] = max(row.get(name, 0), value)
+            row["n_trials"] = sum(len(table) for _, table in tables) / n_participants
+            del tables
+            # the peak of a second, traced run, tracing slows generation down
+            tracemalloc.start()
+            for _ in generate(participants[:1], entropy):
+                pass
+            row["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+    except ValueError as error:
+        # designs the generators do not support
+        row["error"] = str(error)
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+    return row
+
+
+def run_sweep(configs, n_participants=n_participants, n_workers=n_workers,
+              seed=0, log=print):
+    ''' evaluate (params, configuration) pairs in parallel, returns one row
+        per configuration: its params followed by the results'''
+    valid = [config for _, config in configs if isinstance(config, GenerationConfig)]
+    args = dict(n_participants=n_participants, seed=seed)
+    if n_workers > 1 and len(valid) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(valid))) as executor:
+            futures = [executor.submit(evaluate, config, **args) for config in valid]
+            results = iter([future.result() for future in futures])
+    else:
+        results = (evaluate(config, **args) for config in valid)
+    rows = []
+    for params, config in configs:
+        result = next(results) if isinstance(config, GenerationConfig) \
+            else {"error": config}
+        rows.append(dict(params, **result))
+        log(format_row(rows[-1], list(params)))
+    return rows
+
+
+# =============================================================================
+# Results
+def format_value(value):
+    if isinstance(value, float):
+        return f"{value:.3g}"
+    return str(value)
+
+
+def format_row(row, params):
+    return "  ".join(f"{name}={format_value(row[name])}"
+                     for name in params + summary_columns if name in row)
+
+
+def save_rows(rows, fname, meta=None):
+    ''' rows as CSV (all columns) or, for .json, with meta'''
+    os.makedirs(os.path.dirname(os.path.abspath(fname)), exist_ok=True)
+    if fname.endswith(".json"):
+        with open(fname, "w") as f:
+            json.dump({"meta": meta, "rows": rows}, f, indent=1)
+        return
+    columns = list(dict.fromkeys(name for row in rows for name in row))
+    with open(fname, "w", newline='') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows({name: json.dumps(value) if isinstance(value, (list, dict))
+                          else value for name, value in row.items()} for row in rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Evaluate a grid of trial list designs.")
+    parser.add_argument("--grid", nargs="+", default=[],
+                        help="swept settings as name=v1,v2,...")
+    parser.add_argument("--config", help="TOML or JSON file with the settings "
+                                         "that are not swept")
+    parser.add_argument("--participants", type=int, default=n_participants,
+                        help="participants generated per configuration")
+    parser.add_argument("--workers", type=int, default=n_workers,
+                        help="configurations evaluated in parallel")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="root seed of the generated participants")
+    parser.add_argument("--output", help="save the table as CSV (or .json)")
+    args = parser.parse_args(argv)
+
+    base = G.current_config()
+    if args.config:
+        base = GenerationConfig.load(args.config, base=base)
+    try:
+        grid = parse_grid(args.grid)
+    except ValueError as error:
+        parser.error(str(error))
+    configs = grid_configs(base, grid)
+    print(f"{len(configs)} configuration(s), {args.participants} participant(s) each")
+    rows = run_sweep(configs, n_participants=args.participants,
+                     n_workers=args.workers, seed=args.seed)
+    if args.output:
+        save_rows(rows, args.output, meta={"base": base.to_dict(), "grid": grid,
+                                           "participants": args.participants,
+                                           "seed": args.seed})
+        print(f"Saved {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Partitioning of trial lists into runs (the MEG recordings between two
+pauses): the number of runs follows from the expected trial durations, each
+run gets the same share of every design cell and factor level (maps,
+positions, responses, ...), and the trials of a run are ordered within it, so
+that every run can serve as a fold for cross-validated decoding.
+"""
+import numpy as np
+import BalancedSequences
+
+
+def expected_durations(trials, model):
+    ''' expected duration (s) of each trial (dicts): model[trial_type] plus
+        the trial's jitter, plus model["binary"] for compositions of several
+        maps and model["catch"] for catch trials'''
+    durations = np.empty(len(trials))
+    for k, trial in enumerate(trials):
+        durations[k] = model[trial["trial_type"]] + np.sum(trial.get("jitter", 0.))
+        # the map type names the kind of composition, its depth is the number
+        # of maps
+        if np.size(trial.get("map", ())) > 1:
+            durations[k] += model.get("binary", 0.)
+        if trial.get("is_catch_trial"):
+            durations[k] += model.get("catch", 0.)
+    return durations
+
+
+def n_runs(durations, run_length):
+    ''' number of runs of at most run_length s (expected)'''
+    return max(int(np.ceil(np.sum(durations) / run_length)), 1)
+
+
+def level_codes(values):
+    ''' integer code of each value (any values, lists compare by content)'''
+    keys = [repr(np.ravel(value).tolist()) if isinstance(value, (list, np.ndarray))
+            else repr(value) for value in values]
+    levels = list(dict.fromkeys(keys))
+    return np.array([levels.index(key) for key in keys], dtype=np.intp)
+
+
+def level_counts(runs, levels, n_runs, n_levels):
+    ''' counts (run x level) of the levels of all factors (levels: one row
+        of level indices per factor, numbered across factors)'''
+    counts = np.zeros((n_runs, n_levels), dtype=np.int64)
+    for x in levels:
+        np.add.at(counts, (runs, x), 1)
+    return counts
+
+
+def move_costs(trials, source, target, levels, weights, counts):
+    ''' linear part of the change of the objective (see swap_gains) when
+        trials (all of run source) move to run target'''
+    delta = 2 * weights * (counts[target] - counts[source])
+    return delta[levels[:, trials]].sum(axis=0)
+
+
+def swap_gains(a, b, runs, levels, weights, counts):
+    ''' change of sum over levels of weights * squared counts (run x level)
+        when trial a[i] (all of one run) and trial b[j] (all of another run)
+        swap runs, shape (len(a), len(b))'''
+    r, s = runs[a[0]], runs[b[0]]
+    xa, xb = levels[:, a], levels[:, b]
+    gains = move_costs(a, r, s, levels, weights, counts)[:, None] + \
+        move_costs(b, s, r, levels, weights, counts)[None, :]
+    # the squares of levels that both leave or enter a run grow
+    return gains + 4 * np.sum(weights[xa][:, :, None] *
+                              (xa[:, :, None] != xb[:, None, :]), axis=0)
+
+
+def pair_bounds(counts, offsets, weights):
+    ''' lower bound of the gains of swaps between each pair of runs (r, s):
+        per factor, a swap moves a level x present in r to s and a level y
+        present in s to r, which changes the objective by
+        2 * weight * (e[x] - e[y] + 2) with e = counts[s] - counts[r], or not
+        at all if x == y'''
+    n_runs = len(counts)
+    factor_weights = weights[offsets[:-1]]
+    bounds = np.zeros((n_runs, n_runs))
+    for r in range(n_runs):
+        e = counts - counts[r]
+        low = np.minimum.reduceat(np.where(counts[r] > 0, e, np.inf),
+                                  offsets[:-1], axis=1)
+        high = np.maximum.reduceat(np.where(counts > 0, e, -np.inf),
+                                   offsets[:-1], axis=1)
+        bounds[r] = np.minimum(2 * factor_weights * (low - high + 2), 0).sum(axis=1)
+    return bounds
+
+
+def swap(a, b, runs, levels, counts):
+    ''' swap the runs of trials a and b, updating the level counts'''
+    r, s = runs[a], runs[b]
+    np.add.at(counts, (r, levels[:, a]), -1)
+    np.add.at(counts, (s, levels[:, a]), 1)
+    np.add.at(counts, (s, levels[:, b]), -1)
+    np.add.at(counts, (r, levels[:, b]), 1)
+    runs[a], runs[b] = s, r
+
+
+def partition(labels, n_runs, rng=None, max_swaps=10000):
+    ''' run (0..n_runs-1) of each trial, given the labels of each factor
+        (dict factor -> value per trial): the trials are dealt to the runs in
+        turn, cell by cell (combinations of all factors, in random order), so
+        runs and cells differ by at most one trial between runs; pairs of
+        trials then swap runs as long as this evens out the counts of the
+        factor levels. Swaps are searched run pair by run pair, only in
+        pairs where pair_bounds allows a gain, so memory grows with the size
+        of the runs only'''
+    if rng is None:
+        rng = np.random
+    codes = np.array([level_codes(values) for values in labels.values()],
+                     dtype=np.intp)
+    n = codes.shape[1] if codes.size else 0
+    if n == 0:
+        return np.zeros(0, dtype=np.intp)
+    _, cells = np.unique(codes.T, axis=0, return_inverse=True)
+    cells = cells.ravel()
+    dealt = np.concatenate([rng.permutation(np.flatnonzero(cells == cell))
+                            for cell in rng.permutation(cells.max() + 1)])
+    start = rng.integers(n_runs) if hasattr(rng, "integers") else rng.randint(n_runs)
+    runs = np.empty(n, dtype=np.intp)
+    runs[dealt] = (start + np.arange(n)) % n_runs
+    # cells weigh more than all factors together, so that swaps keep them
+    # balanced; levels are numbered across factors
+    factors = list(codes) + [cells]
+    offsets = np.cumsum([0] + [c.max() + 1 for c in factors])
+    levels = np.array([c + offset for c, offset in zip(factors, offsets)])
+    weights = np.repeat([1.] * len(codes) + [len(factors)], np.diff(offsets))
+    counts = level_counts(runs, levels, n_runs, offsets[-1])
+    n_swaps, improved = 0, True
+    while improved and n_swaps < max_swaps:
+        # the bounds of pairs with runs changed by a swap are stale until the
+        # next pass, a pass without swaps ends the search
+        improved = False
+        members = [np.flatnonzero(runs == r) for r in range(n_runs)]
+        bounds = pair_bounds(counts, offsets, weights)
+        for r, s in np.argwhere(np.triu(bounds < 0, 1)):
+            while n_swaps < max_swaps:
+                a, b = members[r], members[s]
+                gains = swap_gains(a, b, runs, levels, weights, counts)
+                i, j = np.unravel_index(np.argmin(gains), gains.shape)
+                if gains[i, j] >= 0:
+                    break
+                swap(a[i], b[j], runs, levels, counts)
+                a[i], b[j] = b[j], a[i]
+                n_swaps += 1
+                improved = True
+    return runs
+
+
+def run_order(runs, sequence=None, rng=None):
+    ''' trial order run by run, within a run carryover-balanced over the
+        labels in sequence (see BalancedSequences.balanced_order) or random'''
+    if rng is None:
+        rng = np.random
+    order = []
+    for run in np.unique(runs):
+        idx = np.flatnonzero(runs == run)
+        if sequence is None:
+            order.append(rng.permutation(idx))
+        else:
+            order.append(idx[BalancedSequences.balanced_order(
+                [sequence[k] for k in idx], rng=rng)])
+    return np.concatenate(order) if order else np.zeros(0, dtype=np.intp)
+
+
+def margins(runs, labels):
+    ''' spread (max - min over runs) of the trial counts of each level, per
+        factor, 0 or 1 for balanced runs'''
+    spreads = {}
+    n_runs = runs.max() + 1 if len(runs) else 0
+    for name, values in labels.items():
+        codes = level_codes(values)
+        counts = np.zeros((n_runs, codes.max() + 1 if len(codes) else 0), dtype=int)
+        np.add.at(counts, (runs, codes), 1)
+        spreads[name] = int((counts.max(axis=0) - counts.min(axis=0)).max()) \
+            if counts.size else 0
+    return spreads
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Spell algebra for compositions of any depth: a composition is reduced to its
+canonical pattern (items relabeled in order of appearance). Classification is
+memoized per composition, so repeated calls are dictionary hits; the effect of
+a composition on displays (and its compiled-down number of transformations)
+comes from the cached lookup tables of SpellEngine.
+"""
+from functools import lru_cache
+import numpy as np
+
+# composition types of binary maps by canonical pattern
+BINARY_TYPES = {
+    "AAAA": "first-only", "AAAB": "first-only", "ABAA": "first-only",
+    "ABAB": "first-only", "ABAC": "first-only",
+    "ABBA": "second-only",
+    "ABBB": "transitive", "ABBC": "transitive",
+    "AABA": "rotation", "ABCA": "rotation",
+    "ABCB": "OR",
+    "ABCD": "generic",
+    "AABB": "unclear", "AABC": "unclear", "ABCC": "unclear",
+}
+
+
+def as_key(general_map):
+    ''' hashable form of a map or a composition of maps'''
+    if isinstance(general_map, str):
+        return (general_map,)
+    if isinstance(general_map, (list, tuple)) and \
+            all(isinstance(m, str) for m in general_map):
+        return tuple(general_map)
+    return tuple(str(m) for m in np.ravel(general_map))
+
+
+@lru_cache(maxsize=None)
+def _parse(key, sep):
+    items = [item for m in key for item in m.split(sep)]
+    labels = list(dict.fromkeys(items))
+    return np.array([labels.index(item) for item in items]).reshape(-1, 2)
+
+
+def pattern(general_map, sep='-'):
+    ''' canonical pattern, e.g. ['C-D', 'D-A'] -> "ABBC"'''
+    codes = _parse(as_key(general_map), sep)
+    return "".join(chr(ord("A") + c) for c in codes.ravel())
+
+
+@lru_cache(maxsize=None)
+def _classify(key, sep):
+    codes = _parse(key, sep)
+    if len(codes) == 1:
+        return "primitive"
+    p = pattern(key, sep=sep)
+    if len(codes) == 2:
+        return BINARY_TYPES[p]
+    return p
+
+
+def classify(general_map, sep='-'):
+    ''' composition type: "primitive", the binary types of BINARY_TYPES or
+        the canonical pattern for deeper compositions'''
+    return _classify(as_key(general_map), sep)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Vectorized spell engine: stimuli are encoded as uint8 codes, compositions of
+maps as lookup tables, so that a whole batch of displays can be transformed at
+once by fancy indexing
+"""
+from functools import lru_cache
+import numpy as np
+
+PAD = 255  # code for padded (no-op) steps in compositions of unequal depth
+# bump whenever a change of the engine changes its outcomes, this invalidates
+# the cached display indices
+ENGINE_VERSION = 1
+
+
+# =============================================================================
+# Encoding
+# =============================================================================
+def encode(items, alphabet):
+    ''' map stimulus labels to uint8 codes (their index in alphabet)'''
+    alphabet = np.asarray(alphabet)
+    items = np.asarray(items)
+    order = np.argsort(alphabet)
+    pos = np.searchsorted(alphabet, items, sorter=order)
+    codes = order[np.clip(pos, 0, len(alphabet) - 1)]
+    if not np.array_equal(alphabet[codes], items):
+        unknown = np.setdiff1d(items, alphabet)
+        raise ValueError(f"Items {unknown} are not part of the alphabet")
+    return codes.astype(np.uint8)
+
+
+def decode(codes, alphabet):
+    ''' map uint8 codes back to stimulus labels'''
+    return np.asarray(alphabet)[np.asarray(codes)]
+
+
+def parse_map(general_map, alphabet, sep='-'):
+    ''' takes a map or a composition of maps (e.g. ['A-B', 'C-D']) and
+        returns a (depth, 2) array of (input, output) codes'''
+    if isinstance(general_map, str):
+        general_map = [general_map]
+    if len(general_map) == 0:
+        return np.zeros((0, 2), dtype=np.uint8)
+    pairs = [m.split(sep) for m in general_map]
+    return encode(pairs, alphabet).reshape(-1, 2)
+
+
+def parse_maps(map_list, alphabet, sep='-'):
+    ''' encode a list of compositions, returns the unique compositions as a
+        (n_unique, max_depth, 2) array (padded with PAD) and the index of
+        each list entry into it'''
+    keys = [tuple([m] if isinstance(m, str) else m) for m in map_list]
+    unique_keys = list(dict.fromkeys(keys))
+    lookup = {key: i for i, key in enumerate(unique_keys)}
+    map_idx = np.array([lookup[key] for key in keys], dtype=np.intp)
+    depth = max(len(key) for key in unique_keys)
+    codes = np.full((len(unique_keys), depth, 2), PAD, dtype=np.uint8)
+    for i, key in enumerate(unique_keys):
+        codes[i, :len(key)] = parse_map(list(key), alphabet, sep=sep)
+    return codes, map_idx
+
+
+# =============================================================================
+# Lookup tables
+# =============================================================================
+def map_tables(compositions, n_stim):
+    ''' precompute for each composition (a (depth, 2) code array) the final
+        image of every stimulus, its image after the first map and the number
+        of transformations it undergoes along the way'''
+    n_comp = len(compositions)
+    identity = np.arange(n_stim, dtype=np.uint8)
+    final = np.tile(identity, (n_comp, 1))
+    first = final.copy()
+    n_trans = np.zeros((n_comp, n_stim), dtype=np.int64)
+    for m, codes in enumerate(compositions):
+        table = identity.copy()
+        for step, (t_in, t_out) in enumerate(codes):
+            if t_in != PAD:
+                hit = table == t_in
+                n_trans[m] += hit
+                table[hit] = t_out
+            if step == 0:
+                first[m] = table
+        final[m] = table
+    return final, first, n_trans
+
+
+@lru_cache(maxsize=None)
+def _composition_tables(general_map, alphabet, sep):
+    codes = parse_map(list(general_map), np.array(alphabet), sep=sep)
+    return map_tables([codes], len(alphabet))
+
+
+def composition_tables(general_map, alphabet, sep='-'):
+    ''' cached lookup tables of a single composition (treat as read-only)'''
+    if isinstance(general_map, str):
+        general_map = [general_map]
+    return _composition_tables(tuple(general_map), tuple(alphabet), sep)
+
+
+# =============================================================================
+# Application
+# =============================================================================
+def apply_tables(displays, tables, map_idx=None):
+    ''' apply precomputed lookup tables to an (N, display_size) code matrix,
+        row i is transformed by composition map_idx[i] (default: the first)
+
+        returns output displays, intermediate displays (after the first map),
+        the number of transformations (trans_ub) and the number of
+        transformations of the compiled-down composition (trans_lb)'''
+    final, first, n_trans = tables
+    displays = np.asarray(displays, dtype=np.intp)
+    if map_idx is None:
+        map_idx = np.zeros(len(displays), dtype=np.intp)
+    rows = np.asarray(map_idx, dtype=np.intp)[:, None]
+    display_out = final[rows, displays]
+    intermediate_display = first[rows, displays]
+    trans_ub = n_trans[rows, displays].sum(axis=1)
+
+    # A composition compiles down to a single primitive if at most one of the
+    # items present in the display is changed by it. Then the lower bound is
+    # the number of changed items, otherwise no steps can be skipped.
+    changed = display_out != displays
+    n_changed = changed.sum(axis=1)
+    present = np.zeros((len(displays), final.shape[1]), dtype=bool)
+    present[np.arange(len(displays))[:, None], displays] = True
+    moved = final[rows[:, 0]] != np.arange(final.shape[1])
+    n_sources = np.count_nonzero(present & moved, axis=1)
+    trans_lb = np.where(n_sources <= 1, n_changed, trans_ub)
+    return display_out, intermediate_display, trans_ub, trans_lb
+
+
+# =============================================================================
+# Displays
+# =============================================================================
+def count_items(displays, n_stim):
+    ''' number of instances of each stimulus per display, shape (N, n_stim)'''
+    displays = np.asarray(displays)
+    return (displays[:, :, None] == np.arange(n_stim)).sum(axis=1)
+
+
+def random_displays(n, display_size, n_stim, necessary=None, rng=None):
+    ''' draw n random displays (rows) that contain the necessary item codes
+        at random positions, remaining positions are filled uniformly'''
+    if rng is None:
+        rng = np.random
+    if necessary is None:
+        necessary = np.zeros(0, dtype=np.uint8)
+    n_other = display_size - len(necessary)
+    displays = np.concatenate(
+        (np.tile(np.asarray(necessary, dtype=np.uint8), (n, 1)),
+         rng.choice(n_stim, size=(n, n_other)).astype(np.uint8)),
+        axis=1)
+    order = np.argsort(rng.random((n, display_size)), axis=1)
+    return np.take_along_axis(displays, order, axis=1)
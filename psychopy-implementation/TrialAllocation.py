@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Exact counterbalancing of test trials: the number of trials per map, correct
+response and target is allocated up front as two small max-flow problems
+(map -> correct response, then map x response -> target) over the cells that
+are known to be feasible, so that display generation only fills cells.
+"""
+from collections import deque, Counter
+from collections.abc import Mapping
+from itertools import combinations, islice
+import numpy as np
+
+
+def max_flow(capacity, source, sink):
+    ''' Edmonds-Karp on a dense capacity matrix, returns the flow matrix'''
+    n = len(capacity)
+    residual = np.array(capacity, dtype=np.int64)
+    while True:
+        parent = np.full(n, -1)
+        parent[source] = source
+        queue = deque([source])
+        while queue and parent[sink] < 0:
+            node = queue.popleft()
+            for nxt in np.flatnonzero((residual[node] > 0) & (parent < 0)):
+                parent[nxt] = node
+                queue.append(nxt)
+        if parent[sink] < 0:
+            break
+        # bottleneck along the augmenting path
+        path, node = [], sink
+        while node != source:
+            path.append((parent[node], node))
+            node = parent[node]
+        push = min(residual[a, b] for a, b in path)
+        for a, b in path:
+            residual[a, b] -= push
+            residual[b, a] += push
+    flow = np.maximum(np.array(capacity, dtype=np.int64) - residual, 0)
+    return flow
+
+
+def bipartite_flow(supply, feasible, col_caps, edge_caps):
+    ''' route supply[i] units from row i to the feasible columns, returns the
+        (n_rows, n_cols) allocation and whether all supply was routed'''
+    n_rows, n_cols = feasible.shape
+    source, sink = n_rows + n_cols, n_rows + n_cols + 1
+    capacity = np.zeros((n_rows + n_cols + 2,) * 2, dtype=np.int64)
+    capacity[source, :n_rows] = supply
+    capacity[:n_rows, n_rows:n_rows + n_cols] = feasible * edge_caps[:, None]
+    capacity[n_rows:n_rows + n_cols, sink] = col_caps
+    flow = max_flow(capacity, source, sink)
+    allocation = flow[:n_rows, n_rows:n_rows + n_cols]
+    return allocation, allocation.sum() == np.sum(supply)
+
+
+def balanced_allocation(supply, feasible, rng=None):
+    ''' integer allocation of supply[i] units of each row to its feasible
+        columns, such that column totals are as equal as possible (exactly
+        floor or ceil of the mean if that is feasible, water-filled
+        otherwise) and each row is spread as evenly as possible over its
+        feasible columns. Raises ValueError if a row has supply but no
+        feasible column.'''
+    if rng is None:
+        rng = np.random
+    supply = np.asarray(supply, dtype=np.int64)
+    feasible = np.asarray(feasible, dtype=bool)
+    n_rows, n_cols = feasible.shape
+    if np.any((supply > 0) & ~feasible.any(axis=1)):
+        raise ValueError("A row with supply has no feasible column")
+    total = supply.sum()
+    degree = np.maximum(feasible.sum(axis=1), 1)
+    unlimited = np.full(n_rows, total)
+
+    # column capacities: floor of the mean, plus one for rem random columns
+    base, rem = divmod(total, n_cols)
+    col_caps = None
+    for extra in islice(combinations(rng.permutation(n_cols), rem), 256):
+        caps = np.full(n_cols, base)
+        caps[list(extra)] += 1
+        if bipartite_flow(supply, feasible, caps, unlimited)[1]:
+            col_caps = caps
+            break
+    if col_caps is None:
+        # water-filling: raise the common level until everything fits
+        level = base + 1
+        while not bipartite_flow(supply, feasible,
+                                 np.full(n_cols, level), unlimited)[1]:
+            level += 1
+        col_caps = np.full(n_cols, level)
+
+    # spread each row evenly: raise the per-edge level until everything fits
+    slack = 0
+    while True:
+        edge_caps = -(-supply // degree) + slack
+        allocation, ok = bipartite_flow(supply, feasible, col_caps, edge_caps)
+        if ok:
+            return allocation
+        slack += 1
+
+
+def allocate_trials(map_idx, n_resp, feasible, rng=None):
+    ''' allocate a correct response and a target to every trial
+
+        map_idx: the map of each trial (index into the unique maps)
+        feasible: bool array (n_maps, n_resp, n_targets), whether a display
+        exists for map, correct response and target
+
+        returns resp and target per trial and the (n_maps, n_resp,
+        n_targets) allocation counts'''
+    if rng is None:
+        rng = np.random
+    map_idx = np.asarray(map_idx)
+    n_maps, _, n_targets = feasible.shape
+    map_counts = np.bincount(map_idx, minlength=n_maps)
+    # maps -> correct responses
+    resp_counts = balanced_allocation(map_counts, feasible.any(axis=2), rng=rng)
+    # (map, correct response) -> targets
+    cell_counts = balanced_allocation(
+        resp_counts.ravel(), feasible.reshape(n_maps * n_resp, n_targets),
+        rng=rng).reshape(n_maps, n_resp, n_targets)
+
+    resp = np.zeros(len(map_idx), dtype=np.intp)
+    targets = np.zeros(len(map_idx), dtype=np.intp)
+    for u in range(n_maps):
+        rows = rng.permutation(np.flatnonzero(map_idx == u))
+        r, t = np.nonzero(cell_counts[u])
+        n = cell_counts[u][r, t]
+        resp[rows] = np.repeat(r, n)
+        targets[rows] = np.repeat(t, n)
+    return resp, targets, cell_counts
+
+
+def spread(counts):
+    ''' max - min of a count vector (0 for exact balance)'''
+    counts = np.asarray(counts)
+    return int(counts.max() - counts.min()) if counts.size else 0
+
+
+def tally(trials, tallies=None):
+    ''' add the number of test trials per map, correct response and target
+        in trials (e.g. a chunk of a block) to tallies (dict test type ->
+        Counter), trials are read one at a time'''
+    tallies = {} if tallies is None else tallies
+    fields = ["test_type", "map", "correct_resp", "target"]
+    if not set(fields) <= set(getattr(trials, "columns", fields)):
+        return tallies
+    for trial in trials:
+        if isinstance(trial, Mapping) and all(key in trial for key in fields):
+            cell = ("+".join(np.ravel(trial["map"])), int(trial["correct_resp"]),
+                    str(trial["target"]))
+            tallies.setdefault(trial["test_type"], Counter())[cell] += 1
+    return tallies
+
+
+def cell_counts(counter, maps, resps, targets):
+    ''' (maps, resps, targets) count array of a tally'''
+    counts = np.zeros((len(maps), len(resps), len(targets)), dtype=int)
+    for (m, r, t), n in counter.items():
+        counts[maps.index(m), resps.index(r), targets.index(t)] = n
+    return counts
+
+
+def margin_spreads(counts):
+    ''' spread of each margin of a (maps, resps, targets) count array'''
+    return {"map": spread(counts.sum(axis=(1, 2))),
+            "correct_resp": spread(counts.sum(axis=(0, 2))),
+            "target": spread(counts.sum(axis=(0, 1))),
+            "correct_resp_per_map": [spread(c) for c in counts.sum(axis=2)],
+            "target_per_map": [spread(c) for c in counts.sum(axis=1)]}
+
+
+def balance_certificate(chunk_tallies):
+    ''' tally of map x correct response x target of the test trials of a
+        block, per test type, with the spread of each margin, given the
+        tallies of its chunks (see tally)
+
+        Correct responses and targets are allocated chunk by chunk (one
+        repetition of the maps), so the balance is exact within a chunk
+        (margins differ by at most one trial where the feasible cells allow
+        it): "chunk_spread" holds the largest spreads within any chunk,
+        "spread" those of the whole block, over which the chunks add up.'''
+    totals = {}
+    for tallies in chunk_tallies:
+        for test_type, counter in tallies.items():
+            totals.setdefault(test_type, Counter()).update(counter)
+    certificate = {}
+    for test_type in sorted(totals):
+        maps = sorted({m for m, _, _ in totals[test_type]})
+        resps = sorted({r for _, r, _ in totals[test_type]})
+        targets = sorted({t for _, _, t in totals[test_type]})
+        counts = cell_counts(totals[test_type], maps, resps, targets)
+        chunk_spreads = [margin_spreads(cell_counts(tallies[test_type], maps,
+                                                    resps, targets))
+                         for tallies in chunk_tallies if test_type in tallies]
+        certificate[test_type] = {
+            "n_trials": int(counts.sum()),
+            "maps": maps,
+            "correct_resp": resps,
+            "targets": targets,
+            "counts": counts.tolist(),
+            "spread": margin_spreads(counts),
+            "n_chunks": len(chunk_spreads),
+            "chunk_spread": {name: np.max([s[name] for s in chunk_spreads],
+                                          axis=0).tolist()
+                             for name in chunk_spreads[0]},
+            }
+    return certificate
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Per-participant trial bundle: all trial blocks and the mapping lists of a
+participant in one file. A JSON table of contents is followed by the raw
+field data of each block (aligned for memory mapping), every block carries a
+sha256 checksum. Blocks are decoded lazily by name, opening a bundle is one
+open, one stat and (with preload) one sequential read.
+
+    magic (8 bytes) | TOC length (uint64, little endian) | TOC (JSON) |
+    padding | block data ...
+"""
+import os
+import mmap
+import json
+import struct
+import hashlib
+from collections.abc import Mapping
+import numpy as np
+from TrialTable import TrialTable
+
+MAGIC = b"TRIALBDL"
+FORMAT_VERSION = 1
+ALIGN = 64
+# blocks are hashed and written in pieces of about this size, so that
+# (memory-mapped) blocks need not be held in memory at once
+CHUNK_BYTES = 1 << 24
+
+
+def _align(n):
+    return -(-n // ALIGN) * ALIGN
+
+
+def _field_layout(arrays):
+    ''' field layout (relative offsets) of the concatenated, aligned data'''
+    fields, offset = {}, 0
+    for name, column in arrays.items():
+        if column.dtype.hasobject:
+            raise ValueError(f"Field '{name}' holds Python objects")
+        fields[name] = {"offset": offset, "dtype": column.dtype.str,
+                        "shape": list(column.shape)}
+        offset += _align(column.nbytes)
+    return fields
+
+
+def _iter_data(arrays, chunk_bytes=CHUNK_BYTES):
+    ''' the data of arrays in the layout of _field_layout, in pieces'''
+    for column in arrays.values():
+        step = max(chunk_bytes // max(column[:1].nbytes, 1), 1)
+        for start in range(0, len(column), step):
+            yield np.ascontiguousarray(column[start:start + step]).tobytes()
+        padding = _align(column.nbytes) - column.nbytes
+        if padding:
+            yield b"\0" * padding
+
+
+def encode_block(block):
+    ''' table of contents entry (without offset and checksum) and the field
+        arrays of a block (TrialTable or dict of arrays)'''
+    if isinstance(block, TrialTable):
+        entry = {"kind": "table", "header": block.header()}
+        arrays = {field: block.data[field] for field in block.fields}
+    else:
+        entry = {"kind": "arrays"}
+        arrays = dict(block)
+    arrays = {name: np.asarray(column) for name, column in arrays.items()}
+    entry["fields"] = _field_layout(arrays)
+    return entry, arrays
+
+
+def _hash_data(arrays, digest=None):
+    ''' sha256 of the data of arrays (updating digest) and their size'''
+    digest = hashlib.sha256() if digest is None else digest
+    nbytes = 0
+    for piece in _iter_data(arrays):
+        digest.update(piece)
+        nbytes += len(piece)
+    return digest.hexdigest(), nbytes
+
+
+def block_digest(block):
+    ''' content hash of a block (its schema and data), independent of where
+        and how it is stored'''
+    entry, arrays = encode_block(block)
+    digest = hashlib.sha256(json.dumps(entry, sort_keys=True).encode())
+    return _hash_data(arrays, digest)[0]
+
+
+def write_bundle(path, blocks, info=None, meta=None):
+    ''' write blocks (dict name -> TrialTable or dict of arrays) to path,
+        atomically; info holds extra JSON entries per block (e.g. its key
+        and balance certificate), meta entries for the whole bundle'''
+    info = {} if info is None else info
+    toc = {"format": "trial-bundle", "version": FORMAT_VERSION,
+           "meta": {} if meta is None else meta, "blocks": {}}
+    # checksums first (the table of contents precedes the data), then the
+    # data is written piece by piece
+    regions, offset = [], 0
+    for name, block in blocks.items():
+        entry, arrays = encode_block(block)
+        sha256, nbytes = _hash_data(arrays)
+        entry.update(offset=offset, nbytes=nbytes, sha256=sha256,
+                     **info.get(name, {}))
+        toc["blocks"][name] = entry
+        regions.append(arrays)
+        offset += nbytes
+    toc_bytes = json.dumps(toc).encode()
+    head = MAGIC + struct.pack("<Q", len(toc_bytes)) + toc_bytes
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(head + b"\0" * (_align(len(head)) - len(head)))
+        for arrays in regions:
+            for piece in _iter_data(arrays):
+                f.write(piece)
+    os.replace(tmp_path, path)
+
+
+class TrialBundle(Mapping):
+    ''' read-only mapping block name -> trial list (list of TrialTable rows)
+        or dict of arrays (mapping lists)'''
+
+    def __init__(self, path, preload=False):
+        self.path = path
+        with open(path, "rb") as f:
+            self.size = os.fstat(f.fileno()).st_size
+            if preload:
+                self._buffer = f.read()
+            else:
+                self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        head = bytes(self._buffer[:len(MAGIC) + 8])
+        if len(head) < len(MAGIC) + 8 or head[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"'{path}' is not a trial bundle")
+        (toc_length,) = struct.unpack("<Q", head[len(MAGIC):])
+        toc = json.loads(bytes(self._buffer[len(head):len(head) + toc_length]))
+        if toc.get("format") != "trial-bundle" or \
+                toc.get("version") != FORMAT_VERSION:
+            raise ValueError(f"'{path}' is not a trial bundle of format "
+                             f"version {FORMAT_VERSION}")
+        self.toc = toc
+        self.meta = toc["meta"]
+        self._data_start = _align(len(head) + toc_length)
+        self._cache = {}
+
+
+    def __getitem__(self, block):
+        if self.toc["blocks"][block]["kind"] != "table":
+            return self.arrays(block)
+        if block not in self._cache:
+            self._cache[block] = self.table(block).rows()
+        return self._cache[block]
+
+
+    def __iter__(self):
+        return iter(self.toc["blocks"])
+
+
+    def __contains__(self, block):
+        return block in self.toc["blocks"]
+
+
+    def __len__(self):
+        return len(self.toc["blocks"])
+
+
+    def info(self, block):
+        ''' table of contents entry of block'''
+        return self.toc["blocks"][block]
+
+
+    def arrays(self, block):
+        ''' fields of block as read-only arrays (views into the bundle)'''
+        entry = self.toc["blocks"][block]
+        start = self._data_start + entry["offset"]
+        if start + entry["nbytes"] > self.size:
+            raise ValueError(f"Block '{block}' of '{self.path}' is truncated")
+        arrays = {}
+        for name, field in entry["fields"].items():
+            dtype = np.dtype(field["dtype"])
+            count = int(np.prod(field["shape"]))
+            arrays[name] = np.frombuffer(
+                self._buffer, dtype=dtype, count=count,
+                offset=start + field["offset"]).reshape(field["shape"])
+        return arrays
+
+
+    def table(self, block):
+        ''' block as a TrialTable backed by the bundle'''
+        entry = self.toc["blocks"][block]
+        return TrialTable.from_header(entry["header"], self.arrays(block),
+                                      source=f"Block '{block}' of '{self.path}'")
+
+
+    def verify(self, blocks=None):
+        ''' names of the blocks whose data do not match their checksum'''
+        corrupted = []
+        for block in (self if blocks is None else blocks):
+            entry = self.toc["blocks"][block]
+            start = self._data_start + entry["offset"]
+            data = self._buffer[start:start + entry["nbytes"]]
+            if len(data) != entry["nbytes"] or \
+                    hashlib.sha256(data).hexdigest() != entry["sha256"]:
+                corrupted.append(block)
+        return corrupted
+
+
+    def block(self, block):
+        ''' block decoded as stored (TrialTable or dict of arrays), e.g. to
+            rewrite the bundle with other blocks replaced'''
+        if self.info(block)["kind"] == "table":
+            return self.table(block)
+        return self.arrays(block)
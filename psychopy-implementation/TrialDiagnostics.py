@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Design diagnostics of the generated trial lists: per block (and test type)
+the distribution of every design column (map, map_type, test_type,
+correct_resp, target, trans_ub/trans_lb, catch trials, ...), the positions of
+single items and the first-order transitions between maps (stimuli in the
+object decoder), for each participant and summed over the cohort.
+
+Every file is summarized in one pass over its stored columns, summaries are
+cached in trial-lists/.cache/diagnostics and only recomputed for files that
+changed since.
+"""
+import os
+import json
+import argparse
+import numpy as np
+from TrialTable import NONE
+import TrialValidation
+import GenerateTrialLists
+
+# bump whenever the summary changes, this invalidates cached summaries
+DIAGNOSTICS_VERSION = 2
+# fields with more distinct values are reported by their range of counts
+max_listed_values = 12
+# columns that are not part of the design
+ignored_columns = ["jitter", "input_disp", "intermediate_disp", "output_disp",
+                   "resp_options"]
+diagnostics_dir = os.path.join(GenerateTrialLists.cache_dir, "diagnostics")
+
+
+# =============================================================================
+# Summaries
+def column_keys(table, name):
+    ''' (n, k) integer matrix identifying the value of column name per row'''
+    raw = np.asarray(table.data[name])
+    keys = raw.reshape(len(table), -1).astype(np.int64)
+    if name + ".tag" in table.fields:
+        tags = np.asarray(table.data[name + ".tag"]).reshape(len(table), -1)
+        keys = np.concatenate([tags.astype(np.int64), keys], axis=1)
+    return keys
+
+
+def label(value):
+    if isinstance(value, (list, np.ndarray)):
+        return "+".join(str(v) for v in np.ravel(value))
+    return str(value)
+
+
+def sort_key(name):
+    return (0, int(name), "") if name.lstrip("-").isdigit() else (1, 0, name)
+
+
+def counts_dict(labels, counts):
+    return {name: int(n) for name, n in sorted(zip(labels, counts),
+                                              key=lambda x: sort_key(x[0]))}
+
+
+def value_counts(table, name, rows):
+    ''' {value: count} of column name over rows (bool mask), values are
+        decoded once per distinct value'''
+    keys = column_keys(table, name)[rows]
+    if len(keys) == 0:
+        return {}
+    _, first, counts = np.unique(keys, axis=0, return_index=True,
+                                 return_counts=True)
+    row_idx = np.flatnonzero(rows)[first]
+    return counts_dict([label(table.value(i, name)) for i in row_idx], counts)
+
+
+def item_positions(table, alphabet):
+    ''' position of the single item of displays with blanks (object and
+        spell decoder), None if the displays are full'''
+    if "input_disp" not in table.columns:
+        return None
+    stim = TrialValidation.column_values(table, "input_disp", alphabet)["stim"]
+    if "input_disp.tag" in table.fields:
+        stim = np.where(np.asarray(table.data["input_disp.tag"]) == NONE, -1, stim)
+    shown = stim >= 0
+    if shown.all() or np.any(shown.sum(axis=1) != 1):
+        return None
+    return np.argmax(shown, axis=1), stim[shown]
+
+
+def sequence(table, alphabet):
+    ''' labels and per-row codes of the sequence whose transitions are
+        tallied: maps, or the shown stimulus of the object decoder'''
+    if "map" in table.columns:
+        keys = column_keys(table, "map")
+        _, first, codes = np.unique(keys, axis=0, return_index=True,
+                                    return_inverse=True)
+        return [label(table.value(i, "map")) for i in first], codes.ravel()
+    positions = item_positions(table, alphabet)
+    if positions is not None:
+        return list(alphabet), positions[1]
+    return None
+
+
+def transitions(labels, codes):
+    ''' first-order transition counts (from row, to column)'''
+    n = len(labels)
+    counts = np.bincount(codes[:-1] * n + codes[1:], minlength=n * n)
+    return {"labels": labels, "counts": counts.reshape(n, n).tolist()}
+
+
+def summarize_table(table, alphabet):
+    ''' design summary of a block: number of trials, value counts per test
+        type and the transitions of its sequence'''
+    summary = {"n_trials": len(table), "groups": {}}
+    test_type = TrialValidation.categories(table, "test_type")
+    names = [name for name in table.columns if name not in ignored_columns
+             and name != "test_type"]
+    positions = item_positions(table, alphabet)
+    for group in sorted(set(test_type.tolist()), key=str):
+        rows = test_type == group
+        counts = {"n_trials": int(rows.sum())}
+        for name in names:
+            counts[name] = value_counts(table, name, rows)
+        if positions is not None:
+            pos, n = np.unique(positions[0][rows], return_counts=True)
+            counts["position"] = counts_dict(map(str, pos), n)
+        summary["groups"]["all" if group is None else group] = counts
+    if "is_catch_trial" in table.columns:
+        summary["catch_rate"] = float(np.mean(table.data["is_catch_trial"]))
+    seq = sequence(table, alphabet)
+    if seq is not None:
+        summary["transitions"] = transitions(*seq)
+    return summary
+
+
+def summarize_file(fname):
+    ''' summaries of all trial blocks of a bundle or trial specification'''
+    alphabet = GenerateTrialLists.stimuli.tolist()
+    return {block: summarize_table(table, alphabet)
+            for block, table in TrialValidation.file_tables(fname)}
+
+
+# =============================================================================
+# Cache
+def file_stamp(fname):
+    ''' size and modification time of a file, with the version and the
+        stimuli its summary is decoded with'''
+    stat = os.stat(fname)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+            "version": DIAGNOSTICS_VERSION,
+            "stimuli": GenerateTrialLists.stimuli.tolist()}
+
+
+def file_summary(fname, cache_dir=diagnostics_dir):
+    ''' summary of a file, from the cache unless the file changed, returns
+        the summary and whether it was recomputed'''
+    cache_fname = os.path.join(cache_dir, os.path.basename(fname) + ".json")
+    stamp = file_stamp(fname)
+    if os.path.exists(cache_fname):
+        with open(cache_fname) as f:
+            cached = json.load(f)
+        if cached.get("stamp") == stamp:
+            return cached["blocks"], False
+    blocks = summarize_file(fname)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_fname = f"{cache_fname}.{os.getpid()}.tmp"
+    with open(tmp_fname, "w") as f:
+        json.dump({"stamp": stamp, "file": fname, "blocks": blocks}, f)
+    os.replace(tmp_fname, cache_fname)
+    return blocks, True
+
+
+def merge(total, summary):
+    ''' add the counts of summary to total (nested dicts of counts, the
+        catch rate is averaged by trials and transitions merged by label)'''
+    for key, value in summary.items():
+        if key == "transitions":
+            old = total.get(key, {"labels": [], "counts": []})
+            labels = list(dict.fromkeys(old["labels"] + value["labels"]))
+            counts = np.zeros((len(labels), len(labels)), dtype=np.int64)
+            for part in [old, value]:
+                idx = [labels.index(name) for name in part["labels"]]
+                if idx:
+                    counts[np.ix_(idx, idx)] += np.array(part["counts"])
+            total[key] = {"labels": labels, "counts": counts.tolist()}
+        elif key == "catch_rate":
+            continue
+        elif isinstance(value, dict):
+            merge(total.setdefault(key, {}), value)
+        else:
+            total[key] = total.get(key, 0) + value
+    if "catch_rate" in summary:
+        n_catch = total.get("_n_catch", 0) + summary["catch_rate"] * summary["n_trials"]
+        total["_n_catch"] = n_catch
+        total["catch_rate"] = n_catch / total["n_trials"]
+    return total
+
+
+def cohort_summary(fnames, cache_dir=diagnostics_dir):
+    ''' per-file summaries (cached) and their sum per block, returns
+        ({fname: summary}, {block: summary}, names of recomputed files)'''
+    summaries, cohort, updated = {}, {}, []
+    for fname in fnames:
+        summaries[fname], recomputed = file_summary(fname, cache_dir=cache_dir)
+        if recomputed:
+            updated.append(fname)
+        for block, summary in summaries[fname].items():
+            merge(cohort.setdefault(block, {}), summary)
+    for summary in cohort.values():
+        summary.pop("_n_catch", None)
+    return summaries, cohort, updated
+
+
+# =============================================================================
+# Report
+def format_counts(values):
+    ''' counts of the values of a field, listed or by their range if there
+        are more than max_listed_values of them'''
+    spread = max(values.values()) - min(values.values())
+    if len(values) <= max_listed_values:
+        return (", ".join(f"{value} {n}" for value, n in values.items())
+                + f" (spread {spread})")
+    names = list(values)
+    return (f"{len(values)} values {names[0]}..{names[-1]}, "
+            f"{min(values.values())}-{max(values.values())} each "
+            f"(spread {spread})")
+
+
+def format_summary(blocks, indent="  "):
+    lines = []
+    for block, summary in blocks.items():
+        lines.append(f"{block} ({summary['n_trials']} trials"
+                     + (f", catch rate {summary['catch_rate']:.2f}"
+                        if "catch_rate" in summary else "") + ")")
+        for group, counts in summary["groups"].items():
+            if len(summary["groups"]) > 1:
+                lines.append(f"{indent}{group} ({counts['n_trials']} trials)")
+            for name, values in counts.items():
+                if name == "n_trials" or not values:
+                    continue
+                lines.append(f"{indent*2}{name}: " + format_counts(values))
+        if "transitions" in summary:
+            counts = np.array(summary["transitions"]["counts"])
+            lines.append(f"{indent}transitions {counts.shape[0]}x"
+                         f"{counts.shape[0]}: {counts.min()}-{counts.max()} "
+                         f"per cell, {np.trace(counts)} repeats")
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Summarize the design of the generated trial lists.")
+    parser.add_argument("files", nargs="*",
+                        help="bundles or trial specifications (default: all "
+                             "participants in --dir)")
+    parser.add_argument("--dir", default=GenerateTrialLists.trial_list_dir,
+                        help="trial list directory")
+    parser.add_argument("--participants", action="store_true",
+                        help="also report each participant")
+    parser.add_argument("--json", action="store_true",
+                        help="print the summaries as JSON")
+    parser.add_argument("--config",
+                        help="configuration the lists were generated with "
+                             "(see GenerateTrialLists.py --config)")
+    args = parser.parse_args(argv)
+    if args.config:
+        GenerateTrialLists.load_config(args.config)
+
+    fnames = args.files or TrialValidation.participant_files(args.dir)
+    if not fnames:
+        parser.error(f"No trial lists in '{args.dir}'")
+    cache_dir = os.path.join(args.dir, ".cache", "diagnostics")
+    summaries, cohort, updated = cohort_summary(fnames, cache_dir=cache_dir)
+    if args.json:
+        print(json.dumps({"participants": summaries, "cohort": cohort}, indent=1))
+        return
+    if args.participants:
+        for fname, blocks in summaries.items():
+            print(os.path.basename(fname))
+            print("\n".join(format_summary(blocks)))
+    print(f"Cohort of {len(fnames)} participant(s), {len(updated)} summary(ies) "
+          "updated")
+    print("\n".join(format_summary(cohort)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,647 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar trial lists: the trials of a block are stored in one structured
+NumPy array (uint8 stimulus codes, fixed-width map codes, float32 jitters)
+instead of a list of dicts holding small string arrays. Rows are returned as
+TrialRow views, which behave like the trial dicts for data.TrialHandler and
+the experiment code: values are decoded on access, assignments go to a
+per-row overlay and copies are plain dicts.
+
+On disk a table is a directory with one .npy file per field and a JSON
+schema, so that it loads without pickle and can be memory-mapped. Large
+tables are written chunk by chunk (TrialTableWriter), optionally shuffled
+on the way through buckets on disk (BucketShuffle).
+"""
+import os
+import re
+import copy
+import json
+import shutil
+import struct
+from collections.abc import MutableMapping
+import numpy as np
+from SpellEngine import PAD
+
+# tags of item values
+NONE, STR, INT, BOOL = 0, 1, 2, 3
+
+# version of the on-disk format, bump on incompatible changes; tables
+# without ragged columns (new in version 2) are written as version 1, so
+# that earlier versions still read them
+FORMAT_VERSION = 2
+READABLE_VERSIONS = [1, 2]
+SCHEMA_FNAME = "schema.json"
+# fixed size of the .npy headers written by TrialTableWriter, so that they
+# can be rewritten in place once the number of trials is known
+NPY_HEADER_SIZE = 128
+
+
+def _is_bool(value):
+    return isinstance(value, (bool, np.bool_))
+
+
+def _is_int(value):
+    return isinstance(value, (int, np.integer)) and not _is_bool(value)
+
+
+def _is_float(value):
+    return isinstance(value, (float, np.floating))
+
+
+def _is_str(value):
+    return isinstance(value, str)
+
+
+def _is_sequence(value):
+    return isinstance(value, (list, tuple, np.ndarray))
+
+
+def _is_map(value, sep):
+    return _is_str(value) and len(value.split(sep)) == 2
+
+
+def infer_column(name, values, sep='-'):
+    ''' column description (kind, shape, container) of the values of a key
+
+        category: strings, stored as uint8 codes into the column's levels
+        bool / int / float: scalars or arrays of that type (float as float32)
+        map: sequences of maps "X-Y", stored as (depth, 2) stimulus codes
+        item: stimuli, ints, bools or None (scalars or arrays), stored as
+        value and tag
+
+        sequences of unequal length (other than maps, which are padded with
+        PAD) are ragged: padded to the longest one, with the length of each
+        stored in a field of its own'''
+    first = values[0]
+    container = "scalar"
+    if _is_sequence(first):
+        container = "array" if isinstance(first, np.ndarray) else "list"
+        if any(("array" if isinstance(v, np.ndarray) else "list") != container
+               or not _is_sequence(v) for v in values):
+            raise ValueError(f"Column '{name}' mixes containers")
+        elements = [e for v in values for e in v]
+        lengths = {len(v) for v in values}
+        if elements and all(_is_map(e, sep) for e in elements):
+            return {"name": name, "kind": "map", "container": container,
+                    "shape": (max(lengths), 2)}
+        shape = (max(lengths),)
+    else:
+        if any(_is_sequence(v) for v in values):
+            raise ValueError(f"Column '{name}' mixes containers")
+        elements, shape, lengths = values, (), {()}
+    column = {"name": name, "container": container, "shape": shape}
+    if len(lengths) > 1:
+        column["ragged"] = True
+    if elements and all(_is_bool(e) for e in elements):
+        column["kind"] = "bool"
+    elif elements and all(_is_int(e) for e in elements):
+        column["kind"] = "int"
+    elif elements and all(_is_float(e) for e in elements):
+        column["kind"] = "float"
+    elif container == "scalar" and all(_is_str(e) for e in elements):
+        column["kind"] = "category"
+        column["levels"] = list(dict.fromkeys(str(e) for e in elements))
+        if len(column["levels"]) > 255:
+            raise ValueError(f"Column '{name}' has too many levels")
+    elif all(e is None or _is_str(e) or _is_int(e) or _is_bool(e)
+             for e in elements):
+        column["kind"] = "item"
+    else:
+        raise ValueError(f"Column '{name}' holds unsupported values")
+    return column
+
+
+def merge_column(old, new):
+    ''' description of a column that encodes the values described by new
+        (e.g. of a later chunk) compatibly with the column old: category
+        levels are extended, scalars may go into an item column, maps and
+        ragged sequences may be shorter; raises ValueError otherwise'''
+    name = old["name"]
+    shape_ok = tuple(new["shape"]) == tuple(old["shape"]) or \
+        ((old["kind"] == "map" or old.get("ragged", False)) and
+         new["shape"][0] <= old["shape"][0])
+    if new["container"] != old["container"] or not shape_ok or \
+            (new.get("ragged") and not old.get("ragged")):
+        raise ValueError(f"Column '{name}' changes its shape")
+    if new["kind"] == old["kind"]:
+        merged = dict(old)
+        if old["kind"] == "category":
+            merged["levels"] = old["levels"] + [
+                level for level in new["levels"] if level not in old["levels"]]
+            if len(merged["levels"]) > 255:
+                raise ValueError(f"Column '{name}' has too many levels")
+        return merged
+    if old["kind"] == "item" and new["kind"] in ["category", "int", "bool"]:
+        return dict(old)
+    raise ValueError(f"Column '{name}' holds {new['kind']} values, "
+                     f"{old['kind']} before")
+
+
+def _field_fname(k, name):
+    return f"{k:02d}_{re.sub(r'[^0-9A-Za-z_.-]', '_', name)}.npy"
+
+
+def _npy_header(dtype, shape):
+    ''' .npy (version 1.0) header of NPY_HEADER_SIZE bytes'''
+    header = repr({"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                   "fortran_order": False, "shape": tuple(shape)}).encode("latin1")
+    if len(header) + 11 > NPY_HEADER_SIZE:
+        raise ValueError(f"Array header {header} is too long")
+    return np.lib.format.MAGIC_PREFIX + b"\x01\x00" + \
+        struct.pack("<H", NPY_HEADER_SIZE - 10) + \
+        header.ljust(NPY_HEADER_SIZE - 11) + b"\n"
+
+
+class TrialTable:
+    def __init__(self, data, schema, vocab, sep='-'):
+        # data: structured array or dict field name -> array (e.g. memory
+        # mapped columns), indexed the same way by field name
+        self.data = data
+        self._n = len(data) if isinstance(data, np.ndarray) else \
+            len(next(iter(data.values())))
+        self.schema = schema
+        self.vocab = list(vocab)
+        self.sep = sep
+        self._columns = {column["name"]: column for column in schema}
+        self._vocab = np.array(self.vocab)
+
+
+    def __getstate__(self):
+        return {"data": self.data, "schema": self.schema, "vocab": self.vocab,
+                "sep": self.sep}
+
+
+    def __setstate__(self, state):
+        self.__init__(state["data"], state["schema"], state["vocab"],
+                      sep=state["sep"])
+
+
+    @classmethod
+    def from_dicts(cls, trials, alphabet=(), sep='-', like=None, dtypes=None):
+        ''' encode a list of trial dicts with the same keys, stimulus codes
+            follow alphabet (further strings are appended to it); with like
+            (a table, e.g. the previous chunk of a block) the trials are
+            encoded compatibly with it: same columns and field types, its
+            stimulus codes and category levels are kept and only extended.
+            Integer fields are as narrow as their values allow and float
+            fields are float32, unless their type is given in dtypes (dict
+            field -> type), e.g. for values that grow from chunk to chunk'''
+        dtypes = {} if dtypes is None else dtypes
+        trials = list(trials)
+        if not trials:
+            raise ValueError("Cannot build a table without trials")
+        names = list(trials[0]) if like is None else like.columns
+        if any(set(trial) != set(names) for trial in trials):
+            raise ValueError("All trials must have the same keys")
+        if like is not None:
+            alphabet, sep = like.vocab, like.sep
+        vocab = {str(item): k for k, item in enumerate(alphabet)}
+
+        def code(item):
+            return vocab.setdefault(str(item), len(vocab))
+
+        schema, fields, columns = [], [], {}
+        for name in names:
+            values = [trial[name] for trial in trials]
+            column = infer_column(name, values, sep=sep)
+            if like is not None:
+                column = merge_column(like._columns[name], column)
+            kind, shape = column["kind"], tuple(column["shape"])
+            n = len(values)
+            ragged = column.get("ragged", False)
+            if ragged:
+                lengths = np.array([len(v) for v in values], dtype=np.int64)
+                pad = {"bool": False, "int": 0, "float": 0.}.get(kind)
+                values = [list(v) + [pad] * (shape[0] - len(v)) for v in values]
+            if kind == "category":
+                lookup = {level: k for k, level in enumerate(column["levels"])}
+                columns[name] = np.array([lookup[str(v)] for v in values],
+                                         dtype=np.uint8)
+            elif kind in ["bool", "int", "float"]:
+                dtype = {"bool": np.bool_, "int": np.int64,
+                         "float": dtypes.get(name, np.float32)}[kind]
+                columns[name] = np.array(values, dtype=dtype).reshape((n,) + shape)
+            elif kind == "map":
+                codes = np.full((n,) + shape, PAD, dtype=np.int64)
+                for i, value in enumerate(values):
+                    for j, m in enumerate(value):
+                        codes[i, j] = [code(item) for item in m.split(sep)]
+                columns[name] = codes
+            else:
+                elements = np.array(values, dtype=object).reshape((n,) + shape)
+                tags = np.zeros(elements.shape, dtype=np.uint8)
+                codes = np.zeros(elements.shape, dtype=np.int64)
+                for idx, e in np.ndenumerate(elements):
+                    if e is None:
+                        continue
+                    if _is_bool(e):
+                        tags[idx], codes[idx] = BOOL, int(e)
+                    elif _is_int(e):
+                        tags[idx], codes[idx] = INT, int(e)
+                    else:
+                        tags[idx], codes[idx] = STR, code(e)
+                columns[name] = codes
+                columns[name + ".tag"] = tags
+                fields.append((name + ".tag", np.uint8, shape))
+            schema.append(column)
+            fields.append((name, columns[name].dtype, shape))
+            if ragged:
+                columns[name + ".len"] = lengths
+                fields.append((name + ".len", lengths.dtype, ()))
+        if len(vocab) >= PAD:
+            raise ValueError("Too many distinct stimuli for uint8 codes")
+        # integer codes and values as narrow as they fit (as those of like)
+        for k, (name, dtype, shape) in enumerate(fields):
+            values = columns[name]
+            if values.dtype == np.int64:
+                small = values.size == 0 or (values.min() >= 0 and values.max() <= 255)
+                dtype = np.dtype(dtypes.get(name, np.uint8 if small else np.int32))
+                if like is not None:
+                    dtype = like.data[name].dtype
+                info = np.iinfo(dtype)
+                if values.size and (values.min() < info.min or
+                                    values.max() > info.max):
+                    raise ValueError(f"Values of field '{name}' do not "
+                                     f"fit its type {dtype}")
+                values = values.astype(dtype)
+                columns[name] = values
+                fields[k] = (name, values.dtype, shape)
+        data = np.empty(len(trials), dtype=[(name, dtype, shape)
+                                            for name, dtype, shape in fields])
+        for name, _, _ in fields:
+            data[name] = columns[name]
+        return cls(data, schema, sorted(vocab, key=vocab.get), sep=sep)
+
+
+    @classmethod
+    def concat(cls, tables):
+        ''' rows of consistently encoded tables (chunks, see from_dicts with
+            like) in one table with the schema of the last one'''
+        tables = list(tables)
+        last = tables[-1]
+        if len(tables) == 1:
+            return last
+        if all(isinstance(t.data, np.ndarray) and t.data.dtype == last.data.dtype
+               for t in tables):
+            data = np.concatenate([t.data for t in tables])
+        else:
+            data = {name: np.concatenate([np.asarray(t.data[name]) for t in tables])
+                    for name in last.fields}
+        return cls(data, last.schema, last.vocab, sep=last.sep)
+
+
+    @property
+    def columns(self):
+        return list(self._columns)
+
+
+    @property
+    def fields(self):
+        if isinstance(self.data, np.ndarray):
+            return list(self.data.dtype.names)
+        return list(self.data)
+
+
+    @property
+    def nbytes(self):
+        return sum(self.data[name].nbytes for name in self.fields)
+
+
+    def __len__(self):
+        return self._n
+
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            if not -len(self) <= index < len(self):
+                raise IndexError("Trial index out of range")
+            return TrialRow(self, int(index) % len(self))
+        return self.take(index)
+
+
+    def __iter__(self):
+        return (TrialRow(self, i) for i in range(len(self)))
+
+
+    def __repr__(self):
+        return f"TrialTable({len(self)} trials, columns={self.columns})"
+
+
+    def value(self, i, name):
+        ''' decoded value of column name in row i'''
+        column = self._columns[name]
+        kind, container = column["kind"], column["container"]
+        raw = self.data[name][i]
+        length = self.data[name + ".len"][i] if column.get("ragged") else None
+        if length is not None:
+            raw = raw[:length]
+        if kind == "category":
+            return column["levels"][raw]
+        if kind in ["bool", "int", "float"]:
+            if container == "scalar":
+                return {"bool": bool, "int": int, "float": float}[kind](raw)
+            if container == "list":
+                return raw.tolist()
+            return np.asarray(raw) if kind == "float" else np.asarray(raw).astype(
+                {"bool": np.bool_, "int": np.int64}[kind])
+        if kind == "map":
+            maps = [f"{self.vocab[a]}{self.sep}{self.vocab[b]}"
+                    for a, b in raw if a != PAD]
+            return np.array(maps) if container == "array" else maps
+        tags = self.data[name + ".tag"][i]
+        if length is not None:
+            tags = tags[:length]
+        if container == "array" and np.all(tags == STR):
+            return self._vocab[raw]
+        if container == "array" and np.all(tags == INT):
+            return np.asarray(raw).astype(np.int64)
+        items = [self._decode_item(t, v)
+                 for t, v in zip(np.ravel(tags), np.ravel(raw))]
+        if container == "scalar":
+            return items[0]
+        return np.array(items) if container == "array" else items
+
+
+    def _decode_item(self, tag, value):
+        if tag == STR:
+            return self.vocab[value]
+        if tag == INT:
+            return int(value)
+        if tag == BOOL:
+            return bool(value)
+        return None
+
+
+    def take(self, indices):
+        ''' table of the given rows (index array, mask or slice)'''
+        if isinstance(self.data, np.ndarray):
+            data = self.data[indices]
+        else:
+            data = {name: column[indices] for name, column in self.data.items()}
+        return TrialTable(data, self.schema, self.vocab, sep=self.sep)
+
+
+    def shuffled(self, rng=None):
+        ''' rows in random order, a single index permutation'''
+        if rng is None:
+            rng = np.random
+        return self.take(rng.permutation(len(self)))
+
+
+    def rows(self):
+        ''' list of row views, as used by the experiment in place of the list
+            of trial dicts'''
+        return list(self)
+
+
+    def to_dicts(self):
+        return [row.copy() for row in self]
+
+
+    def header(self):
+        ''' JSON description of the table (everything but the field data)'''
+        ragged = any(column.get("ragged") for column in self.schema)
+        return {"format": "trial-table", "version": FORMAT_VERSION if ragged else 1,
+                "n_trials": len(self), "sep": self.sep, "vocab": self.vocab,
+                "columns": [dict(column, shape=list(column["shape"]))
+                            for column in self.schema]}
+
+
+    @classmethod
+    def from_header(cls, header, data, source="table"):
+        ''' table from a header written by header() and the field data'''
+        if header.get("format") != "trial-table" or \
+                header.get("version") not in READABLE_VERSIONS:
+            raise ValueError(f"{source} is not a trial table of format "
+                             f"version {' or '.join(map(str, READABLE_VERSIONS))}")
+        schema = [dict(column, shape=tuple(column["shape"]))
+                  for column in header["columns"]]
+        return cls(data, schema, header["vocab"], sep=header["sep"])
+
+
+    def save(self, path):
+        ''' write the table to directory path, one .npy file per field'''
+        with TrialTableWriter(path) as writer:
+            writer.append(self)
+
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        ''' read a table written by save, columns are memory-mapped (only
+            the pages of accessed trials are read) unless mmap_mode is None'''
+        with open(os.path.join(path, SCHEMA_FNAME)) as f:
+            header = json.load(f)
+        data = {}
+        for name, field in header.get("fields", {}).items():
+            fname = os.path.join(path, field["file"])
+            shape = tuple([header["n_trials"]] + field["shape"])
+            dtype = np.dtype(field["dtype"])
+            if header["n_trials"] == 0:
+                column = np.zeros(shape, dtype=dtype)
+            elif mmap_mode is None:
+                column = np.fromfile(fname, dtype=dtype, offset=field["offset"])
+            else:
+                column = np.memmap(fname, dtype=dtype, mode=mmap_mode,
+                                   offset=field["offset"], shape=shape)
+            if column.size != int(np.prod(shape)):
+                raise ValueError(f"Field '{name}' of '{path}' does not match "
+                                 f"its schema")
+            data[name] = column.reshape(shape)
+        return cls.from_header(header, data, source=f"'{path}'")
+
+
+class TrialTableWriter:
+    ''' write a table to directory path (in the format of TrialTable.save)
+        chunk by chunk, only the chunk being appended is held in memory;
+        chunks must be encoded consistently (see from_dicts with like), the
+        schema is that of the last chunk'''
+
+    def __init__(self, path):
+        self.path = path
+        self.like = None
+        self.n_trials = 0
+        self._files = {}
+        os.makedirs(path, exist_ok=True)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            for f in self._files.values():
+                f.close()
+
+
+    def append(self, table):
+        if self.like is None:
+            for k, name in enumerate(table.fields):
+                f = open(os.path.join(self.path, _field_fname(k, name)), "wb")
+                f.write(_npy_header(table.data[name].dtype,
+                                    (0,) + table.data[name].shape[1:]))
+                self._files[name] = f
+        elif table.fields != self.like.fields or any(
+                table.data[name].dtype != self.like.data[name].dtype or
+                table.data[name].shape[1:] != self.like.data[name].shape[1:]
+                for name in table.fields):
+            raise ValueError("Chunk does not match the fields of the table")
+        for name, f in self._files.items():
+            f.write(np.ascontiguousarray(table.data[name]).tobytes())
+        self.n_trials += len(table)
+        self.like = table
+
+
+    def close(self):
+        ''' complete the .npy headers and write the schema'''
+        if self.like is None:
+            raise ValueError("Cannot write a table without trials")
+        fields = {}
+        for k, (name, f) in enumerate(self._files.items()):
+            column = self.like.data[name]
+            f.seek(0)
+            f.write(_npy_header(column.dtype, (self.n_trials,) + column.shape[1:]))
+            f.close()
+            # the offset lets load skip parsing the header
+            fields[name] = {"file": _field_fname(k, name),
+                            "dtype": column.dtype.str,
+                            "shape": list(column.shape[1:]),
+                            "offset": NPY_HEADER_SIZE}
+        header = dict(self.like.header(), n_trials=self.n_trials, fields=fields)
+        with open(os.path.join(self.path, SCHEMA_FNAME), "w") as f:
+            json.dump(header, f, indent=1)
+
+
+class BucketShuffle:
+    ''' uniformly random order of the rows of a stream of chunks in bounded
+        memory: each row is put into one of n_buckets buckets at random (in
+        memory, or written to tmp_dir if given), then the buckets are
+        permuted one at a time. The result is a uniform random permutation,
+        as with shuffling all rows at once, and does not depend on where
+        the buckets are kept.'''
+
+    def __init__(self, n_buckets=16, rng=None, tmp_dir=None):
+        if rng is None:
+            rng = np.random
+        self.n_buckets = n_buckets
+        self.rng = rng
+        self.tmp_dir = tmp_dir
+        self.like = None
+        self._buckets = [[] if tmp_dir is None else None
+                         for _ in range(n_buckets)]
+
+
+    def add(self, table):
+        rng = self.rng
+        bucket = rng.integers(0, self.n_buckets, size=len(table)) \
+            if hasattr(rng, "integers") else rng.randint(0, self.n_buckets, len(table))
+        for b in np.unique(bucket):
+            part = table.take(np.flatnonzero(bucket == b))
+            if self.tmp_dir is None:
+                self._buckets[b].append(part)
+                continue
+            if self._buckets[b] is None:
+                self._buckets[b] = TrialTableWriter(
+                    os.path.join(self.tmp_dir, f"bucket_{b:04d}"))
+            self._buckets[b].append(part)
+        self.like = table
+
+
+    def tables(self):
+        ''' the shuffled rows, one table per non-empty bucket (with the
+            schema of the last chunk)'''
+        for b, bucket in enumerate(self._buckets):
+            if not bucket:
+                continue
+            if self.tmp_dir is None:
+                table = TrialTable.concat(bucket)
+            else:
+                bucket.close()
+                table = TrialTable.load(bucket.path, mmap_mode=None)
+                shutil.rmtree(bucket.path)
+            self._buckets[b] = None
+            table = TrialTable(table.data, self.like.schema, self.like.vocab,
+                               sep=self.like.sep)
+            yield table.take(self.rng.permutation(len(table)))
+
+
+def as_trial_list(trials):
+    ''' list of trials of a loaded block (row views of a TrialTable, legacy
+        lists of dicts are passed through)'''
+    if isinstance(trials, TrialTable):
+        return trials.rows()
+    return trials
+
+
+class TrialRow(MutableMapping):
+    ''' dict-like view of a row of a TrialTable, assignments and deletions
+        only affect the row view'''
+    __slots__ = ("_table", "_index", "_overlay", "_deleted")
+
+    def __init__(self, table, index):
+        self._table = table
+        self._index = index
+        self._overlay = {}
+        self._deleted = set()
+
+
+    def __getitem__(self, key):
+        if key in self._overlay:
+            return self._overlay[key]
+        if key in self._deleted or key not in self._table._columns:
+            raise KeyError(key)
+        return self._table.value(self._index, key)
+
+
+    def __setitem__(self, key, value):
+        self._overlay[key] = value
+        self._deleted.discard(key)
+
+
+    def __delitem__(self, key):
+        if key in self._overlay:
+            del self._overlay[key]
+            if key in self._table._columns:
+                self._deleted.add(key)
+        elif key in self._table._columns and key not in self._deleted:
+            self._deleted.add(key)
+        else:
+            raise KeyError(key)
+
+
+    def __iter__(self):
+        for key in self._table._columns:
+            if key not in self._deleted:
+                yield key
+        for key in self._overlay:
+            if key not in self._table._columns:
+                yield key
+
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+    def copy(self):
+        return dict(self)
+
+
+    def __copy__(self):
+        return dict(self)
+
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(dict(self), memo)
+
+
+    def __reduce__(self):
+        # pickle (e.g. saved responses) as a plain dict
+        return (dict, (dict(self),))
+
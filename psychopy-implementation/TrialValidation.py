@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Validation of generated trial lists: the invariants the generators promise
+(output displays are the map applied to the input display, correct responses
+match the count or position of the target, at most max_duplicates instances
+per stimulus, no immediate map repeats, runs in one piece each) are
+re-derived from the stored stimulus codes, column-wise per block. Bundles are
+validated in parallel, run `python TrialValidation.py` before a session day.
+"""
+import os
+import glob
+import json
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import SpellEngine
+from SpellEngine import PAD
+from TrialTable import TrialTable, STR, INT, BOOL
+from TrialBundle import TrialBundle
+import GenerateTrialLists
+
+# ==============================================================================
+# Settings
+max_duplicates = 3  # default of GenerateTrialLists.gen_trials_batch
+# blocks whose map lists are drawn without immediate repeats (get_map_list
+# with allow_repeats=False), the generic blocks shuffle maps freely
+no_repeat_blocks = ["trials_prim_cue", "trials_prim_prac_c",
+                    "trials_prim_prac_p"]
+n_workers = os.cpu_count() or 1
+
+
+# =============================================================================
+# Columns as codes
+def column_values(table, name, alphabet):
+    ''' stimulus codes (index into alphabet), integers and booleans of a
+        column, each -1 where a value is of another type'''
+    column = {c["name"]: c for c in table.schema}[name]
+    kind = column["kind"]
+    raw = np.asarray(table.data[name])
+    none = np.full(raw.shape, -1, dtype=np.int64)
+    values = {"stim": none, "int": none, "bool": none}
+    alphabet = list(alphabet)
+    lookup = np.array([alphabet.index(item) if item in alphabet else -1
+                       for item in table.vocab] + [-1], dtype=np.int64)
+    if kind == "category":
+        levels = np.array([alphabet.index(level) if level in alphabet else -1
+                           for level in column["levels"]], dtype=np.int64)
+        values["stim"] = levels[raw]
+    elif kind in ["int", "bool"]:
+        values[kind] = raw.astype(np.int64)
+    elif kind == "item":
+        tags = np.asarray(table.data[name + ".tag"])
+        raw = raw.astype(np.int64)
+        values["stim"] = np.where(tags == STR,
+                                  lookup[np.where(tags == STR, raw, -1)], -1)
+        values["int"] = np.where(tags == INT, raw, -1)
+        values["bool"] = np.where(tags == BOOL, raw, -1)
+    return values
+
+
+def map_codes(table, alphabet):
+    ''' maps of all trials as (n, depth, 2) stimulus codes, padded with PAD'''
+    alphabet = list(alphabet)
+    lookup = np.array([alphabet.index(item) if item in alphabet else PAD
+                       for item in table.vocab] + [PAD], dtype=np.uint8)
+    raw = np.asarray(table.data["map"]).astype(np.intp)
+    return lookup[np.where(raw == PAD, -1, raw)]
+
+
+def categories(table, name):
+    ''' decoded values of a category column (None if there is none)'''
+    column = {c["name"]: c for c in table.schema}.get(name)
+    if column is None or column["kind"] != "category":
+        return np.full(len(table), None)
+    return np.array(column["levels"])[np.asarray(table.data[name])]
+
+
+def transform(displays, final, map_idx):
+    ''' displays (stimulus codes, -1 for blanks) mapped by the lookup tables
+        final[map_idx[i]], blanks stay blank'''
+    stim = displays >= 0
+    return np.where(stim, final[map_idx[:, None], np.where(stim, displays, 0)],
+                    displays)
+
+
+def count_target(displays, target):
+    ''' instances of target[i] in display i'''
+    return np.sum((displays == target[:, None]) & (target[:, None] >= 0), axis=1)
+
+
+def pick(values, index):
+    ''' values[i, index[i]], -1 where index is out of range'''
+    ok = (index >= 0) & (index < values.shape[1])
+    picked = values[np.arange(len(values)), np.where(ok, index, 0)]
+    return np.where(ok, picked, -1)
+
+
+# =============================================================================
+# Checks
+def check_outputs(table, alphabet, auto_maps=()):
+    ''' rows whose output (and intermediate) displays differ from the map(s)
+        applied to the input display'''
+    fields = table.columns
+    bad = np.zeros(len(table), dtype=bool)
+    if "input_disp" not in fields:
+        return bad
+    displays_in = column_values(table, "input_disp", alphabet)["stim"]
+    if "map" in fields and "output_disp" in fields:
+        unique, map_idx = np.unique(map_codes(table, alphabet), axis=0,
+                                    return_inverse=True)
+        final, first, _ = SpellEngine.map_tables(unique, len(alphabet))
+        map_idx = map_idx.ravel()
+        for name, tables in [("output_disp", final),
+                             ("intermediate_disp", first)]:
+            if name in fields:
+                expected = transform(displays_in, tables, map_idx)
+                values = column_values(table, name, alphabet)["stim"]
+                bad |= np.any(values != expected, axis=1)
+    for k, general_map in enumerate(auto_maps):
+        name = f"output_disp_{k}"
+        if name not in fields:
+            continue
+        codes, _ = SpellEngine.parse_maps([general_map], np.array(alphabet),
+                                          sep=table.sep)
+        final = SpellEngine.map_tables(codes, len(alphabet))[0]
+        expected = transform(displays_in, final,
+                             np.zeros(len(table), dtype=np.intp))
+        bad |= np.any(column_values(table, name, alphabet)["stim"] != expected,
+                      axis=1)
+    return bad
+
+
+def check_responses(table, alphabet):
+    ''' rows whose correct response does not match the count or position of
+        the target (or the cued map, or whether the target was shown), blocks
+        without targets are only checked against the cued map'''
+    fields = table.columns
+    bad = np.zeros(len(table), dtype=bool)
+    if "correct_resp" not in fields and "correct_resp_0" not in fields:
+        return bad
+    test_type = categories(table, "test_type")
+    trial_type = categories(table, "trial_type")
+    has_target = "target" in fields
+    if has_target:
+        target = column_values(table, "target", alphabet)
+    if has_target and "output_disp" in fields:
+        output = column_values(table, "output_disp", alphabet)["stim"]
+        correct = column_values(table, "correct_resp", alphabet)["int"]
+        count = test_type == "count"
+        bad |= count & (count_target(output, target["stim"]) != correct)
+        position = test_type == "position"
+        options = column_values(table, "resp_options", alphabet)["stim"]
+        bad |= position & ((pick(options, correct) != pick(output, target["int"]))
+                           | (pick(options, correct) < 0))
+    for name in [f for f in fields if has_target and f.startswith("correct_resp_")]:
+        output = column_values(table, f"output_disp_{name.split('_')[-1]}",
+                               alphabet)["stim"]
+        correct = column_values(table, name, alphabet)
+        bad |= (test_type == "count") & \
+            (count_target(output, target["stim"]) != correct["int"])
+        bad |= (test_type == "position") & \
+            ((pick(output, target["int"]) != correct["stim"])
+             | (correct["stim"] < 0))
+    cue = trial_type == "cue_memory"
+    if cue.any():
+        options = column_values(table, "resp_options", alphabet)["stim"]
+        correct = column_values(table, "correct_resp", alphabet)["int"]
+        cued = map_codes(table, alphabet)[:, 0, :]
+        for j in range(cued.shape[1]):
+            bad |= cue & (pick(options, correct[:, j]) != cued[:, j])
+    if has_target and "is_catch_trial" in fields:
+        catch = np.asarray(table.data["is_catch_trial"]).astype(bool)
+        shown = np.any(column_values(table, "input_disp", alphabet)["stim"]
+                       == target["stim"][:, None], axis=1)
+        correct = column_values(table, "correct_resp", alphabet)["bool"]
+        bad |= catch & (correct != shown)
+    return bad
+
+
+def check_duplicates(table, alphabet, max_duplicates=max_duplicates):
+    ''' rows whose output display holds a stimulus more than max_duplicates
+        times (only displays generated by applying a map)'''
+    if "map" not in table.columns or "output_disp" not in table.columns:
+        return np.zeros(len(table), dtype=bool)
+    output = column_values(table, "output_disp", alphabet)["stim"]
+    counts = SpellEngine.count_items(np.where(output >= 0, output, len(alphabet)),
+                                     len(alphabet) + 1)[:, :len(alphabet)]
+    return counts.max(axis=1) > max_duplicates
+
+
+def check_repeats(table, alphabet):
+    ''' rows with the same map as the preceding row'''
+    bad = np.zeros(len(table), dtype=bool)
+    if "map" in table.columns and len(table) > 1:
+        maps = map_codes(table, alphabet)
+        bad[1:] = np.all(maps[1:] == maps[:-1], axis=(1, 2))
+    return bad
+
+
+def check_runs(table):
+    ''' rows whose run precedes the run of the preceding row, runs are
+        presented one after the other'''
+    bad = np.zeros(len(table), dtype=bool)
+    if "run" in table.columns and len(table) > 1:
+        runs = np.asarray(table.data["run"])
+        bad[1:] = runs[1:] < runs[:-1]
+    return bad
+
+
+def validate_table(table, block, alphabet, auto_maps=(),
+                   max_duplicates=max_duplicates,
+                   no_repeat_blocks=no_repeat_blocks):
+    ''' violations of a block, dict check -> row indices'''
+    checks = {"output_disp": check_outputs(table, alphabet, auto_maps),
+              "correct_resp": check_responses(table, alphabet),
+              "max_duplicates": check_duplicates(table, alphabet,
+                                                 max_duplicates),
+              "runs": check_runs(table)}
+    if block in no_repeat_blocks:
+        checks["repeats"] = check_repeats(table, alphabet)
+    return {check: np.flatnonzero(bad).tolist()
+            for check, bad in checks.items() if bad.any()}
+
+
+# =============================================================================
+# Files
+def participant_files(trial_list_dir=GenerateTrialLists.trial_list_dir):
+    ''' bundles and, for participants without one, trial specifications'''
+    bundles = sorted(glob.glob(os.path.join(trial_list_dir, "*_trials.bundle")))
+    have_bundle = {os.path.basename(f).split("_")[0] for f in bundles}
+    specs = [f for f in sorted(glob.glob(os.path.join(trial_list_dir, "*_seed.json")))
+             if os.path.basename(f).split("_")[0] not in have_bundle]
+    return bundles + specs
+
+
+def file_tables(fname):
+    ''' trial blocks of a bundle, or regenerated from a trial specification,
+        as (block, TrialTable)'''
+    if fname.endswith(".json"):
+        spec = GenerateTrialLists.load_spec(fname)
+        for block in spec.get("sha256", {}):
+            contents = GenerateTrialLists.regenerate_block(spec, block)
+            if isinstance(contents, TrialTable):
+                yield block, contents
+        return
+    bundle = TrialBundle(fname)
+    for block in bundle:
+        if bundle.info(block)["kind"] == "table":
+            yield block, bundle.table(block)
+
+
+def validate_file(fname, max_duplicates=max_duplicates,
+                  no_repeat_blocks=no_repeat_blocks):
+    ''' violations per block of a bundle or trial specification, dict block
+        -> check -> row indices; files that cannot be read are reported
+        under the block "file"'''
+    alphabet = GenerateTrialLists.stimuli.tolist()
+    report = {}
+    try:
+        for block, table in file_tables(fname):
+            violations = validate_table(
+                table, block, alphabet,
+                auto_maps=GenerateTrialLists.selection_prim,
+                max_duplicates=max_duplicates,
+                no_repeat_blocks=no_repeat_blocks)
+            if violations:
+                report[block] = violations
+    except (OSError, ValueError) as error:
+        report["file"] = {str(error): []}
+    return report
+
+
+def validate_files(fnames, n_workers=n_workers, settings=None, **kwargs):
+    ''' validate files in parallel, returns {fname: violations}; settings
+        (see GenerateTrialLists.configure) are set in the worker processes'''
+    if n_workers > 1 and len(fnames) > 1:
+        with ProcessPoolExecutor(
+                max_workers=min(n_workers, len(fnames)),
+                initializer=None if settings is None else GenerateTrialLists.configure,
+                initargs=() if settings is None else (settings,)) as executor:
+            futures = [executor.submit(validate_file, fname, **kwargs)
+                       for fname in fnames]
+            reports = [future.result() for future in futures]
+    else:
+        reports = [validate_file(fname, **kwargs) for fname in fnames]
+    return dict(zip(fnames, reports))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Check the generated trial lists of all participants.")
+    parser.add_argument("files", nargs="*",
+                        help="bundles or trial specifications (default: all "
+                             "participants in --dir)")
+    parser.add_argument("--dir", default=GenerateTrialLists.trial_list_dir,
+                        help="trial list directory")
+    parser.add_argument("--workers", type=int, default=n_workers,
+                        help="number of files validated in parallel")
+    parser.add_argument("--max-duplicates", type=int, default=max_duplicates,
+                        help="maximum instances of a stimulus per output display")
+    parser.add_argument("--json", action="store_true",
+                        help="print the full report as JSON")
+    parser.add_argument("--config",
+                        help="configuration the lists were generated with "
+                             "(see GenerateTrialLists.py --config)")
+    args = parser.parse_args(argv)
+
+    # the stimuli and maps the lists are checked against
+    settings = None
+    if args.config:
+        settings = GenerateTrialLists.load_config(args.config)
+    fnames = args.files or participant_files(args.dir)
+    if not fnames:
+        parser.error(f"No trial lists in '{args.dir}'")
+    report = validate_files(fnames, n_workers=args.workers, settings=settings,
+                            max_duplicates=args.max_duplicates)
+    if args.json:
+        print(json.dumps(report, indent=1))
+    else:
+        for fname, violations in report.items():
+            print(f"{os.path.basename(fname)}: "
+                  + ("FAILED" if violations else "ok"))
+            for block, checks in violations.items():
+                for check, rows in checks.items():
+                    print(f"  {block}: {check} violated in {len(rows)} "
+                          f"trial(s) {rows[:10]}")
+    raise SystemExit(1 if any(report.values()) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,35 @@
-import pickle
 import os
+import sys
+import json
+import numpy as np
 leaf = os.path.join("component-tests", "set-mapping-lists-for-piloting.py")
 trunk = os.path.abspath(__file__).replace(leaf, "")
-fname = os.path.join(trunk, "trial-lists", "01_mappinglists.pkl")
-print("Path to mapping lists:", fname)
-m = pickle.load(open(fname, "rb"))
-m["stim"] = ['s_heart', 's_shoe', 's_frog', 's_puzzle',
-             's_globe', 's_banana', 's_signpost', 's_rocket']
-m["tcue"] = ['Virnas', 'Stites', 'Probus',
-             'Ramys', 'Locris', 'Tyges']
-m["vcue"] = ['c_F', 'c_A', 'c_E',
-             'c_D', 'c_B', 'c_C']
+sys.path.insert(0, trunk)
+from TrialBundle import TrialBundle, write_bundle, block_digest
+fname = os.path.join(trunk, "trial-lists", "01_trials.bundle")
+spec_fname = os.path.join(trunk, "trial-lists", "01_seed.json")
+print("Path to trial bundle:", fname)
+bundle = TrialBundle(fname, preload=True)
+contents = {block: bundle.block(block) for block in bundle}
+info = {block: {key: value for key, value in bundle.info(block).items()
+                if key in ["key", "certificate"]} for block in bundle}
+m = dict(contents["mappinglists"])
+m["stim"] = np.array(['s_heart', 's_shoe', 's_frog', 's_puzzle',
+                      's_globe', 's_banana', 's_signpost', 's_rocket'])
+m["tcue"] = np.array(['Virnas', 'Stites', 'Probus',
+                      'Ramys', 'Locris', 'Tyges'])
+m["vcue"] = np.array(['c_F', 'c_A', 'c_E',
+                      'c_D', 'c_B', 'c_C'])
+contents["mappinglists"] = m
 
-with open(fname, "wb") as f:
-    pickle.dump(m, f)
-    print("Changed mapping lists successfully.")
\ No newline at end of file
+write_bundle(fname, contents, info=info, meta=bundle.meta)
+# the trial specification records what is presented, the edited lists can no
+# longer be regenerated from the seed and are kept unless forced
+if os.path.exists(spec_fname):
+    with open(spec_fname) as f:
+        spec = json.load(f)
+    spec.setdefault("sha256", {})["mappinglists"] = block_digest(m)
+    spec.setdefault("edited", {})["mappinglists"] = True
+    with open(spec_fname, "w") as f:
+        json.dump(spec, f, indent=1)
+print("Changed mapping lists successfully.")
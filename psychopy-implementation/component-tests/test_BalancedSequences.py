@@ -0,0 +1,61 @@
+import os
+import sys
+import numpy as np
+import pytest
+trunk = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, trunk)
+import BalancedSequences
+
+
+def test_equal_counts_balance_every_transition():
+    rng = np.random.default_rng(0)
+    sequence = BalancedSequences.balanced_sequence([8, 8, 8, 8], rng=rng)
+    assert np.all(np.bincount(sequence, minlength=4) == 8)
+    transitions = BalancedSequences.transition_matrix(sequence, 4)
+    # a cycle would have every transition twice, the open end drops one
+    assert transitions.sum() == 31
+    assert np.all((transitions == 2) | (transitions == 1))
+    assert np.sum(transitions == 1) == 1
+
+
+def test_unequal_counts_follow_the_expected_transitions():
+    rng = np.random.default_rng(1)
+    counts = np.array([12, 6, 6])
+    cycle = BalancedSequences.balanced_cycle(counts, rng=rng)
+    assert np.all(np.bincount(cycle, minlength=3) == counts)
+    # the transitions of the cycle (back to its start) are rounded from the
+    # expected ones
+    transitions = BalancedSequences.transition_matrix(
+        np.append(cycle, cycle[0]), 3)
+    expected = np.outer(counts, counts) / counts.sum()
+    assert np.all(np.abs(transitions - expected) < 1)
+    assert np.all(transitions.sum(axis=0) == counts)
+    assert np.all(transitions.sum(axis=1) == counts)
+
+
+def test_sequences_without_repeats():
+    rng = np.random.default_rng(2)
+    counts = np.array([5, 3, 2])
+    sequence = BalancedSequences.balanced_sequence(counts, allow_repeats=False,
+                                                   rng=rng)
+    assert np.all(np.bincount(sequence, minlength=3) == counts)
+    assert np.all(sequence[1:] != sequence[:-1])
+    with pytest.raises(ValueError):
+        BalancedSequences.balanced_sequence([5, 1, 1], allow_repeats=False)
+
+
+def test_debruijn_sequence_has_every_pair_once():
+    rng = np.random.default_rng(3)
+    sequence = BalancedSequences.debruijn_sequence(4, rng=rng)
+    assert len(sequence) == 17
+    assert np.all(BalancedSequences.transition_matrix(sequence, 4) == 1)
+
+
+def test_balanced_order_permutes_the_trials():
+    rng = np.random.default_rng(4)
+    labels = ["A-B", "B-A", "C-D"] * 6
+    order = BalancedSequences.balanced_order(labels, rng=rng)
+    assert sorted(order) == list(range(len(labels)))
+    _, transitions = BalancedSequences.label_transitions(
+        [labels[i] for i in order])
+    assert transitions.max() - transitions.min() <= 1
@@ -0,0 +1,45 @@
+import os
+import sys
+import numpy as np
+trunk = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, trunk)
+import CohortAssignment
+
+lists = {"tcue": ["Tyges", "Virnas", "Stites", "Probus", "Locris", "Ramys"],
+         "vcue": ["c_A", "c_B", "c_C", "c_D", "c_E", "c_F"],
+         "stim": ["s_banana", "s_puzzle", "s_shoe", "s_heart", "s_rocket",
+                  "s_signpost", "s_globe", "s_frog"]}
+
+
+def is_latin_square(square):
+    n = len(square)
+    return all(sorted(row) == list(range(n)) for row in square) and \
+        all(sorted(col) == list(range(n)) for col in np.transpose(square))
+
+
+def test_latin_square():
+    rng = np.random.default_rng(0)
+    for n in [1, 2, 5, 8]:
+        assert is_latin_square(CohortAssignment.latin_square(n, rng=rng))
+
+
+def test_every_cycle_takes_every_position_once():
+    for name, items in lists.items():
+        n = len(items)
+        assignments = [[str(item) for item in CohortAssignment.assign(
+            items, participant, seed=7, stream=CohortAssignment.LISTS.index(name))]
+            for participant in range(1, 2 * n + 1)]
+        for cycle in [assignments[:n], assignments[n:]]:
+            _, counts = CohortAssignment.position_counts(cycle)
+            assert np.all(counts == 1), name
+        # the cycles have squares of their own
+        assert assignments[:n] != assignments[n:]
+
+
+def test_assignment_depends_only_on_seed_and_participant():
+    first = CohortAssignment.assign_mappinglists(lists, 3, seed=11)
+    again = CohortAssignment.assign_mappinglists(lists, 3, seed=11)
+    other = CohortAssignment.assign_mappinglists(lists, 3, seed=12)
+    assert all(np.array_equal(first[name], again[name]) for name in lists)
+    assert any(not np.array_equal(first[name], other[name]) for name in lists)
+    assert all(sorted(first[name]) == sorted(lists[name]) for name in lists)
@@ -0,0 +1,46 @@
+import os
+import sys
+import json
+import pytest
+trunk = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, trunk)
+import GenerateTrialLists
+from TrialBundle import block_digest
+
+
+def test_seed_only_specification_regenerates_the_blocks(tmp_path):
+    seed_dir, full_dir = str(tmp_path / "seed"), str(tmp_path / "full")
+    GenerateTrialLists.generate_participant(1, entropy=5, trial_list_dir=seed_dir,
+                                            seed_only=True)
+    GenerateTrialLists.generate_participant(1, entropy=5, trial_list_dir=full_dir)
+    assert GenerateTrialLists.open_bundle(1, trial_list_dir=seed_dir) is None
+    spec = GenerateTrialLists.load_manifest(1, trial_list_dir=seed_dir)
+    assert set(spec["sha256"]) == set(GenerateTrialLists.BLOCKS)
+    # the hashes match those of the stored blocks
+    bundle = GenerateTrialLists.open_bundle(1, trial_list_dir=full_dir)
+    for block, digest in spec["sha256"].items():
+        assert block_digest(bundle.block(block)) == digest
+        assert block_digest(GenerateTrialLists.regenerate_block(spec, block)) \
+            == digest
+    trials = GenerateTrialLists.load_block(1, "trials_prim",
+                                           trial_list_dir=seed_dir)
+    assert len(trials) == len(bundle["trials_prim"])
+    assert GenerateTrialLists.verify_participant(1, trial_list_dir=seed_dir) == []
+
+
+def test_regeneration_rejects_a_wrong_hash(tmp_path):
+    trial_list_dir = str(tmp_path)
+    GenerateTrialLists.generate_participant(
+        2, entropy=5, trial_list_dir=trial_list_dir, seed_only=True,
+        blocks=["mappinglists", "trials_prim"])
+    fname = GenerateTrialLists.manifest_fname(2, trial_list_dir=trial_list_dir)
+    with open(fname) as f:
+        spec = json.load(f)
+    spec["sha256"]["trials_prim"] = "0" * 64
+    with open(fname, "w") as f:
+        json.dump(spec, f)
+    spec = GenerateTrialLists.load_manifest(2, trial_list_dir=trial_list_dir)
+    with pytest.raises(ValueError):
+        GenerateTrialLists.regenerate_block(spec, "trials_prim")
+    assert GenerateTrialLists.verify_participant(
+        2, trial_list_dir=trial_list_dir) == ["trials_prim"]
@@ -0,0 +1,31 @@
+import os
+import sys
+import numpy as np
+trunk = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, trunk)
+import RunPartition
+
+model = {"generic": 5., "binary": 0.5, "catch": 1.5}
+
+
+def test_expected_durations_count_binary_maps():
+    trials = [{"trial_type": "generic", "map_type": "generic",
+               "map": np.array(["A-B"]), "jitter": np.array([0.1, 0.2])},
+              {"trial_type": "generic", "map_type": "second-only",
+               "map": np.array(["A-B", "B-C"]), "jitter": np.array([0.1, 0.2])},
+              {"trial_type": "generic", "map_type": "generic",
+               "map": np.array(["A-B", "C-D"]), "jitter": np.zeros(2),
+               "is_catch_trial": True}]
+    durations = RunPartition.expected_durations(trials, model)
+    assert np.allclose(durations, [5.3, 5.8, 7.])
+
+
+def test_partition_balances_every_label():
+    rng = np.random.default_rng(0)
+    labels = {"map": np.repeat(np.arange(6), 24),
+              "resp": np.tile(np.arange(4), 36)}
+    runs = RunPartition.partition(labels, 4, rng=rng)
+    assert np.all(np.bincount(runs) == 36)
+    # every map and response divides into the runs
+    spreads = RunPartition.margins(runs, labels)
+    assert max(spreads.values()) == 0
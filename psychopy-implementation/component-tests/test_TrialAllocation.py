@@ -0,0 +1,62 @@
+import os
+import sys
+import numpy as np
+import pytest
+trunk = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, trunk)
+import TrialAllocation
+
+
+def test_allocation_is_exact_when_every_cell_is_feasible():
+    rng = np.random.default_rng(0)
+    map_idx = rng.permutation(np.repeat(np.arange(3), 16))
+    feasible = np.ones((3, 4, 4), dtype=bool)
+    resp, targets, counts = TrialAllocation.allocate_trials(map_idx, 4, feasible,
+                                                            rng=rng)
+    # every map gets every response and every target equally often
+    assert np.all(counts.sum(axis=2) == 4)
+    assert np.all(counts.sum(axis=1) == 4)
+    for u in range(3):
+        assert np.all(np.bincount(resp[map_idx == u], minlength=4) == 4)
+        assert np.all(np.bincount(targets[map_idx == u], minlength=4) == 4)
+
+
+def test_allocation_keeps_to_the_feasible_cells():
+    rng = np.random.default_rng(1)
+    map_idx = np.repeat(np.arange(3), 10)
+    feasible = rng.random((3, 4, 4)) < 0.6
+    feasible[:, :, 0] = True
+    resp, targets, counts = TrialAllocation.allocate_trials(map_idx, 4, feasible,
+                                                            rng=rng)
+    assert np.all(feasible[map_idx, resp, targets])
+    assert np.all(counts.sum(axis=(1, 2)) == 10)
+    # the margins are as equal as the feasible cells allow
+    assert TrialAllocation.spread(np.bincount(resp, minlength=4)) <= 1
+
+
+def test_allocation_rejects_rows_without_feasible_columns():
+    feasible = np.array([[True, False], [False, False]])
+    with pytest.raises(ValueError):
+        TrialAllocation.balanced_allocation([2, 1], feasible)
+
+
+def test_certificate_adds_up_the_chunks():
+    rng = np.random.default_rng(2)
+    maps, feasible = ["A-B", "B-A", "C-D"], np.ones((3, 4, 4), dtype=bool)
+    chunk_tallies = []
+    for _ in range(3):
+        map_idx = rng.permutation(np.repeat(np.arange(3), 8))
+        resp, targets, _ = TrialAllocation.allocate_trials(map_idx, 4, feasible,
+                                                           rng=rng)
+        trials = [{"test_type": "count", "map": np.array([maps[u]]),
+                   "correct_resp": r, "target": "ABCD"[t]}
+                  for u, r, t in zip(map_idx, resp, targets)]
+        chunk_tallies.append(TrialAllocation.tally(trials))
+    certificate = TrialAllocation.balance_certificate(chunk_tallies)["count"]
+    assert certificate["n_trials"] == 72 and certificate["n_chunks"] == 3
+    assert certificate["maps"] == maps
+    assert np.sum(certificate["counts"]) == 72
+    for spreads in [certificate["spread"], certificate["chunk_spread"]]:
+        assert spreads["map"] == 0
+        assert spreads["correct_resp"] == 0 and spreads["target"] == 0
+        assert max(spreads["correct_resp_per_map"]) == 0
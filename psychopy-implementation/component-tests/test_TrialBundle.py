@@ -0,0 +1,66 @@
+import os
+import sys
+import numpy as np
+trunk = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, trunk)
+from TrialTable import TrialTable
+from TrialBundle import TrialBundle, write_bundle, block_digest
+
+
+def example_blocks():
+    rng = np.random.default_rng(0)
+    trials = [{"trial_type": "generic", "map": np.array([m]),
+               "input_disp": rng.choice(list("ABCD"), 4),
+               "correct_resp": int(rng.integers(4)),
+               "jitter": rng.uniform(-0.03, 0.03, 3)}
+              for m in ["A-B", "B-A", "C-D"] * 20]
+    return {"mappinglists": {"tcue": np.array(["Tyges", "Virnas", "Stites"]),
+                             "stim": np.array(["s_frog", "s_shoe"])},
+            "trials_prim": TrialTable.from_dicts(trials, alphabet="ABCD")}
+
+
+def corrupt(path, offset):
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        byte = f.read(1)
+        f.seek(offset)
+        f.write(bytes([byte[0] ^ 0xff]))
+
+
+def test_bundle_round_trip(tmp_path):
+    blocks = example_blocks()
+    path = str(tmp_path / "01_trials.bundle")
+    write_bundle(path, blocks, info={"trials_prim": {"key": "abc"}})
+    for preload in [False, True]:
+        bundle = TrialBundle(path, preload=preload)
+        assert list(bundle) == list(blocks)
+        assert bundle.verify() == []
+        assert bundle.info("trials_prim")["key"] == "abc"
+        assert np.array_equal(bundle["mappinglists"]["tcue"],
+                              blocks["mappinglists"]["tcue"])
+        assert bundle["trials_prim"][5]["correct_resp"] == \
+            blocks["trials_prim"].value(5, "correct_resp")
+        # the content hash does not depend on where the block is stored
+        assert block_digest(bundle.block("trials_prim")) == \
+            block_digest(blocks["trials_prim"])
+
+
+def test_verify_detects_corrupted_blocks(tmp_path):
+    path = str(tmp_path / "01_trials.bundle")
+    write_bundle(path, example_blocks())
+    bundle = TrialBundle(path)
+    entry = bundle.info("trials_prim")
+    offset = bundle._data_start + entry["offset"] + entry["nbytes"] // 2
+    del bundle
+    corrupt(path, offset)
+    assert TrialBundle(path).verify() == ["trials_prim"]
+    assert TrialBundle(path, preload=True).verify(["mappinglists"]) == []
+
+
+def test_verify_detects_truncated_bundles(tmp_path):
+    path = str(tmp_path / "01_trials.bundle")
+    write_bundle(path, example_blocks())
+    size = os.path.getsize(path)
+    with open(path, "r+b") as f:
+        f.truncate(size - 16)
+    assert "trials_prim" in TrialBundle(path, preload=True).verify()
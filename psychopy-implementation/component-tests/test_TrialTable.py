@@ -0,0 +1,113 @@
+import os
+import sys
+import numpy as np
+trunk = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, trunk)
+from TrialTable import TrialTable
+
+alphabet = ["A", "B", "C", "D"]
+
+# trials as the original generator built them, one block per kind
+baseline_blocks = {
+    "trials_prim": [
+        {"trial_type": "generic", "map_type": "primitive", "test_type": "count",
+         "map": np.array(["C-D"]), "input_disp": np.array(["A", "B", "A", "C"]),
+         "intermediate_disp": np.array(["A", "B", "A", "D"]),
+         "output_disp": np.array(["A", "B", "A", "D"]),
+         "target": np.str_("A"), "resp_options": np.array([0, 1, 2, 3]),
+         "correct_resp": np.int64(2), "trans_ub": np.int64(1),
+         "trans_lb": np.int64(1), "jitter": np.array([-0.025, -0.026, -0.008])},
+        {"trial_type": "generic", "map_type": "primitive", "test_type": "position",
+         "map": np.array(["B-A"]), "input_disp": np.array(["A", "C", "B", "B"]),
+         "intermediate_disp": np.array(["A", "C", "A", "A"]),
+         "output_disp": np.array(["A", "C", "A", "A"]),
+         "target": np.int64(0),
+         "resp_options": np.array(["B", "D", "C", np.str_("A")], dtype=object),
+         "correct_resp": np.int64(3), "trans_ub": np.int64(2),
+         "trans_lb": np.int64(2), "jitter": np.array([0.008, -0.019, 0.005])}],
+    "trials_binary": [
+        {"trial_type": "generic", "map_type": "generic", "test_type": "position",
+         "map": np.array(["A-B", "C-D"]), "input_disp": np.array(["A", "C", "B", "A"]),
+         "intermediate_disp": np.array(["B", "C", "B", "B"]),
+         "output_disp": np.array(["B", "D", "B", "B"]),
+         "target": np.int64(1),
+         "resp_options": np.array(["B", "A", "C", np.str_("D")], dtype=object),
+         "correct_resp": np.int64(3), "trans_ub": np.int64(3),
+         "trans_lb": np.int64(3), "jitter": np.array([-0.009, 0.015, -0.009])}],
+    "trials_prim_cue": [
+        {"trial_type": "cue_memory", "map": ["B-A"],
+         "resp_options": np.array(["A", "C", "D", "B"]),
+         "correct_resp": [np.int64(3), np.int64(0)]},
+        {"trial_type": "cue_memory", "map": ["C-D"],
+         "resp_options": np.array(["D", "C", "A", "B"]),
+         "correct_resp": [np.int64(1), np.int64(0)]}],
+    "trials_obj_dec": [
+        {"trial_type": "object_decoder", "input_disp": [None, None, np.str_("C"), None],
+         "is_catch_trial": False, "target": None, "correct_resp": None,
+         "jitter": np.float64(-0.009)},
+        {"trial_type": "object_decoder", "input_disp": [np.str_("A"), None, None, None],
+         "is_catch_trial": True, "target": None, "correct_resp": None,
+         "jitter": np.float64(0.016)}],
+    "trials_prim_dec": [
+        {"trial_type": "prim_decoder", "input_disp": np.array(["C", "", "", ""]),
+         "output_disp": np.array(["D", "", "", ""]), "map": ["C-D"],
+         "applicable": True, "test_type": "position",
+         "resp_options": np.array(["B", "D", "A", "C"]), "correct_resp": 1,
+         "target": 0, "map_type": "primitive",
+         "jitter": np.array([-0.007, -0.004, -0.022])}],
+    "trials_auto": [
+        {"trial_type": "autonomous", "map_type": "primitive", "test_type": "count",
+         "input_disp": np.array(["D", "B", "A", "C"]),
+         "output_disp_0": np.array(["D", "B", "B", "C"]),
+         "output_disp_1": np.array(["D", "A", "A", "C"]),
+         "output_disp_2": np.array(["D", "B", "A", "D"]),
+         "target": np.str_("B"), "resp_options": np.array([0, 1, 2, 3]),
+         "correct_resp_0": np.int64(2), "correct_resp_1": np.int64(0),
+         "correct_resp_2": np.int64(1), "jitter": np.array([0., -0.024, 0.021])},
+        {"trial_type": "autonomous", "map_type": "primitive", "test_type": "position",
+         "input_disp": np.array(["A", "B", "C", "C"]),
+         "output_disp_0": np.array(["B", "B", "C", "C"]),
+         "output_disp_1": np.array(["A", "A", "C", "C"]),
+         "output_disp_2": np.array(["A", "B", "D", "D"]),
+         "target": np.int64(1), "resp_options": np.array(["D", "C", "A", "B"]),
+         "correct_resp_0": np.str_("B"), "correct_resp_1": np.str_("A"),
+         "correct_resp_2": np.str_("B"), "jitter": np.array([0.009, -0.026, 0.011])}],
+    }
+
+
+def assert_same_value(value, expected, where):
+    if expected is None:
+        assert value is None, where
+    elif isinstance(expected, (list, np.ndarray)):
+        value, expected = list(value), list(expected)
+        assert len(value) == len(expected), where
+        for v, e in zip(value, expected):
+            assert_same_value(v, e, where)
+    elif isinstance(expected, (float, np.floating)):
+        assert np.isclose(value, expected, atol=1e-6), where
+    else:
+        # strings stay strings and numbers numbers
+        assert value == expected, where
+        assert isinstance(value, str) == isinstance(expected, str), where
+
+
+def test_round_trip_of_baseline_trials():
+    for block, trials in baseline_blocks.items():
+        table = TrialTable.from_dicts(trials, alphabet=alphabet)
+        decoded = table.to_dicts()
+        assert len(decoded) == len(trials)
+        for i, (trial, expected) in enumerate(zip(decoded, trials)):
+            assert set(trial) == set(expected), block
+            for name in expected:
+                assert_same_value(trial[name], expected[name],
+                                  f"{block}[{i}]['{name}']")
+
+
+def test_rows_index_like_the_dicts():
+    trials = baseline_blocks["trials_prim"]
+    table = TrialTable.from_dicts(trials, alphabet=alphabet)
+    rows = table.rows()
+    assert rows[1]["target"] == 0 and rows[0]["target"] == "A"
+    assert list(rows[0]["map"]) == ["C-D"]
+    shuffled = table.shuffled(rng=np.random.default_rng(1))
+    assert sorted(row["correct_resp"] for row in shuffled.rows()) == [2, 3]